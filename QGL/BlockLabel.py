@@ -1,5 +1,7 @@
 import string
 
+from . import CompileContexts
+
 
 class BlockLabel(object):
     def __init__(self, label):
@@ -43,8 +45,13 @@ def endlabel(seq):
 
 
 def newlabel():
-    label = BlockLabel(asciibase(newlabel.numlabels))
-    newlabel.numlabels += 1
+    ctx = CompileContexts.current()
+    if ctx is None:
+        label = BlockLabel(asciibase(newlabel.numlabels))
+        newlabel.numlabels += 1
+    else:
+        label = BlockLabel(asciibase(ctx.numlabels))
+        ctx.numlabels += 1
     return label
 
 
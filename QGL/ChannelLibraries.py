@@ -53,6 +53,7 @@ from ipywidgets import Layout, VBox, HBox
 
 from . import config
 from . import Channels
+from . import CompileContexts
 from . import PulseShapes
 
 from ipywidgets import Layout, HTML
@@ -135,8 +136,24 @@ class ChannelLibrary(object):
 
     def update_channelDict(self):
         self.channelDict = {c.label: c for c in self.get_current_channels()}
+        # logical channels by label, for the factories (see find_channels)
+        self.channelIndex = {}
+        for c in self.channelDatabase.channels:
+            self.channelIndex.setdefault(c.label, []).append(c)
         self.build_connectivity_graph()
 
+    def find_channels(self, label, chan_type):
+        """The channels of the working database with this label and type. The
+        index is kept by update_channelDict (on commit, load, new_* and set_*);
+        it is refreshed when it does not give a single channel, in case
+        channels were added to the database directly."""
+        cs = [c for c in self.channelIndex.get(label, [])
+              if c.label == label and isinstance(c, chan_type)]
+        if len(cs) != 1:
+            self.update_channelDict()
+            cs = [c for c in self.channelIndex.get(label, []) if isinstance(c, chan_type)]
+        return cs
+
     def ls(self):
         cdb = Channels.ChannelDatabase
         q = self.session.query(cdb.label, cdb.time, cdb.id, cdb.notes).\
@@ -460,6 +477,18 @@ class ChannelLibrary(object):
     def revert(self):
         self.session.rollback()
 
+    def reload(self):
+        """Reads the working database again, e.g. after another process changed
+        it. Uncommitted changes are lost."""
+        self.session.rollback()
+        self.session.expire_all()
+        working_dbs = self.query(Channels.ChannelDatabase, label="working").all()
+        if len(working_dbs) != 1:
+            raise Exception(f"Expected a single working database but found {len(working_dbs)}")
+        self.channelDatabase = working_dbs[0]
+        self.connectivityG = nx.DiGraph()
+        self.update_channelDict()
+
     @check_session_dirty
     def save_as(self, name, notes = ''):
         if name == "working":
@@ -860,11 +889,10 @@ class ChannelLibrary(object):
 # retrieve a Qubit from the CL without accessing the CL directly
 def QubitFactory(label):
     ''' Return a saved qubit channel'''
+    channelLib = CompileContexts.channel_library()
     if channelLib is None:
         raise Exception("No channel library initialized")
-    channelLib.update_channelDict()
-#    cs = [c for c in channelLib.channelDatabase.channels if c.label==label]
-    cs = [c for c in channelLib.channelDatabase.channels if c.label==label and isinstance(c, Channels.Qubit)]
+    cs = channelLib.find_channels(label, Channels.Qubit)
     # q = channelLib.session.query(Channels.Qubit).filter(Channels.Qubit.label==label and Channels.Qubit.channel_db==channelLib.channelDatabase).all()
     if len(cs) == 1:
         return cs[0]
@@ -873,11 +901,10 @@ def QubitFactory(label):
 
 def MeasFactory(label):
     ''' Return a saved measurement channel.'''
+    channelLib = CompileContexts.channel_library()
     if channelLib is None:
         raise Exception("No channel library initialized")
-    channelLib.update_channelDict()
-#    cs = [c for c in channelLib.channelDatabase.channels if c.label==label]
-    cs = [c for c in channelLib.channelDatabase.channels if c.label==label and isinstance(c, Channels.Measurement)]
+    cs = channelLib.find_channels(label, Channels.Measurement)
     # q = channelLib.session.query(Channels.Qubit).filter(Channels.Qubit.label==label and Channels.Qubit.channel_db==channelLib.channelDatabase).all()
     if len(cs) == 1:
         return cs[0]
@@ -886,11 +913,10 @@ def MeasFactory(label):
 
 def MarkerFactory(label):
     ''' Return a saved Marker channel with this label. '''
+    channelLib = CompileContexts.channel_library()
     if channelLib is None:
         raise Exception("No channel library initialized")
-#    cs = [c for c in channelLib.channelDatabase.channels if c.label==label]
-    cs = [c for c in channelLib.channelDatabase.channels if c.label==label and isinstance(c, Channels.LogicalMarkerChannel)]
-    channelLib.update_channelDict()
+    cs = channelLib.find_channels(label, Channels.LogicalMarkerChannel)
     # q = channelLib.session.query(Channels.Qubit).filter(Channels.Qubit.label==label and Channels.Qubit.channel_db==channelLib.channelDatabase).all()
     if len(cs) == 1:
         return cs[0]
@@ -898,9 +924,14 @@ def MarkerFactory(label):
         raise Exception(f"Expected to find a single marker '{label}' but found {len(cs)} markers with the same label instead.")
 
 def EdgeFactory(source, target):
+    channelLib = CompileContexts.channel_library()
     if channelLib is None:
         raise Exception("No channel library initialized")
-    channelLib.update_channelDict()
+    if not (channelLib.connectivityG.has_edge(source, target) or
+            channelLib.connectivityG.has_edge(target, source)):
+        # the graph is kept by update_channelDict, refresh it in case edges
+        # were added to the database directly
+        channelLib.update_channelDict()
     if channelLib.connectivityG.has_edge(source, target):
         return channelLib.connectivityG[source][target]['channel']
     elif channelLib.connectivityG.has_edge(target, source):
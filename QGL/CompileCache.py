@@ -0,0 +1,469 @@
+'''
+Content-addressed cache of compiled experiments.
+
+compile_to_hardware fingerprints its inputs (the sequences, the channel library,
+the translator/compiler sources and the driver flags) and stores the files it
+writes under config.AWGDir/.qgl_cache/<fingerprint>. Compiling the same inputs
+again restores those files instead of recompiling.
+
+For incremental compilation (compile_to_hardware(..., incremental=True)) the
+inputs are fingerprinted per AWG instead, so that only the sequence files of
+the AWGs whose inputs changed are rebuilt.
+
+Copyright 2020 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import marshal
+import logging
+import tempfile
+import threading
+from importlib import import_module
+
+import numpy as np
+import sqlalchemy
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+from . import config
+from . import Channels
+from . import CompileContexts
+from . import ControlFlow
+from .BlockLabel import BlockLabel
+from .PatternUtils import flatten
+from .PulseSequencer import Pulse, CompositePulse, PulseBlock
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = '.qgl_cache'
+MANIFEST = 'manifest.json'
+
+# modules whose source determines the compiled output, besides the translators
+COMPILER_MODULES = ['QGL.Compiler', 'QGL.PatternUtils', 'QGL.PulseSequencer',
+                    'QGL.PulseShapes', 'QGL.ControlFlow', 'QGL.TdmInstructions',
+                    'QGL.CompositeShapes', 'QGL.WireArrays', 'QGL.WaveformCache']
+
+# config options that change the compiled output
+CONFIG_OPTIONS = ['dedup_sequences', 'wire_arrays', 'sample_lengths', 'merge_idle',
+                  'waveform_cache_enabled', 'waveform_cache_size', 'waveform_cache_disk']
+
+# library attributes that do not affect the compiled output
+IGNORED_ATTRIBUTES = ['id', 'channel_db_id', 'extra_meta']
+
+stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'uncacheable': 0}
+_store_lock = threading.Lock()
+
+
+class Uncacheable(Exception):
+    pass
+
+
+def cache_dir():
+    return os.path.join(CompileContexts.awg_dir(), CACHE_DIR)
+
+
+def cache_stats():
+    '''
+    Returns the hit/miss/eviction counts for this session together with the
+    number of entries and the total size (in bytes) of the cache on disk.
+    '''
+    entries = list_entries()
+    return dict(stats, entries=len(entries),
+                size=sum(entry['size'] for entry in entries))
+
+
+def clear_cache():
+    if os.path.exists(cache_dir()):
+        shutil.rmtree(cache_dir())
+
+
+def reset_stats():
+    for key in stats:
+        stats[key] = 0
+
+
+def fingerprint(seqs, **compile_args):
+    '''
+    Digest of everything that determines the output of compile_to_hardware.
+    Returns None if the sequences contain something we cannot fingerprint
+    reliably (e.g. a closure as a shape function).
+    '''
+    digest = hashlib.sha256()
+    try:
+        digest.update(sequence_fingerprint(seqs).encode())
+    except Uncacheable as e:
+        logger.info("Not caching compilation: {}".format(e))
+        stats['uncacheable'] += 1
+        return None
+    for label, obj_digest in sorted(library_fingerprint().items()):
+        digest.update("{}={};".format(label, obj_digest).encode())
+    digest.update(repr(sorted(translator_fingerprint().items())).encode())
+    digest.update(repr(sorted((k, _canonical(v, {})) for k, v in compile_args.items())).encode())
+    cl = CompileContexts.channel_library()
+    digest.update(repr((CompileContexts.awg_dir(), cl.db_provider, cl.db_resource_name,
+                        cl.channelDatabase.id)).encode())
+    return digest.hexdigest()
+
+
+def sequence_fingerprint(seqs):
+    '''
+    Digest of the structure of seqs and of the qfunction bodies they call.
+    Block labels are numbered by first appearance, so that the same program
+    built twice (with different label names) has the same fingerprint.
+    '''
+    state = {'labels': {}, 'memo': {}}
+    digest = hashlib.sha256()
+    targets = []
+    for seq in seqs:
+        digest.update(b'[')
+        for entry in seq:
+            digest.update(_canonical(entry, state).encode())
+            if isinstance(entry, ControlFlow.Call) and entry.target not in targets:
+                targets.append(entry.target)
+        digest.update(b']')
+    for target in targets:
+        digest.update(b'{')
+        for entry in flatten(ControlFlow.qfunction_specialization(target)):
+            digest.update(_canonical(entry, state).encode())
+        digest.update(b'}')
+    return digest.hexdigest()
+
+
+def library_fingerprint():
+    '''
+    Digest of the parameters of each object in the channel library, keyed by label.
+    '''
+    return {label: _digest(library_object_params(obj))
+            for label, obj in CompileContexts.channel_library().channelDict.items()}
+
+
+def library_object_params(obj):
+    mapper = sqlalchemy.inspect(type(obj))
+    params = [type(obj).__name__]
+    for attr in mapper.column_attrs:
+        if attr.key in IGNORED_ATTRIBUTES or attr.key.endswith('_id'):
+            continue
+        params.append((attr.key, _canonical(getattr(obj, attr.key), {})))
+    # relationships are recorded by the label of what they point to
+    for rel in mapper.relationships:
+        if rel.direction is MANYTOONE and rel.key != 'channel_db':
+            other = getattr(obj, rel.key)
+            params.append((rel.key, getattr(other, 'label', None)))
+    return repr(params)
+
+
+def translator_fingerprint():
+    '''
+    Digests of the compiler and translator sources and the driver flags, with
+    the config options that change the output (under 'QGL.config').
+    '''
+    translators = set(getattr(obj, 'translator', None)
+                      for obj in CompileContexts.channel_library().channelDict.values())
+    modules = COMPILER_MODULES + ['QGL.drivers.' + t for t in translators if t]
+    versions = {}
+    for name in modules:
+        module = import_module(name)
+        with open(module.__file__, 'rb') as FID:
+            source = hashlib.sha256(FID.read()).hexdigest()
+        flags = sorted((k, repr(v)) for k, v in vars(module).items()
+                       if k.isupper() and isinstance(v, (bool, int, float, str)))
+        versions[name] = (source, flags)
+    versions['QGL.config'] = [(option, repr(getattr(config, option)))
+                              for option in CONFIG_OPTIONS]
+    return versions
+
+
+def restore(key):
+    '''
+    Copies the files of cache entry key back to where they were written and
+    returns the path to the metafile, or None on a cache miss.
+    '''
+    entry = os.path.join(cache_dir(), key)
+    manifest = _read_manifest(entry)
+    if manifest is None or not all(os.path.exists(os.path.join(entry, stored))
+                                   for stored, _ in manifest['files']):
+        stats['misses'] += 1
+        return None
+    for stored, path in manifest['files']:
+        target_folder = os.path.dirname(path)
+        if not os.path.exists(target_folder):
+            os.makedirs(target_folder)
+        shutil.copyfile(os.path.join(entry, stored), path)
+    with CompileContexts.library_lock:
+        for awgName, new_meta in manifest['awg_metas'].items():
+            CompileContexts.channel_library()[awgName].extra_meta = new_meta
+    # mark as recently used
+    os.utime(os.path.join(entry, MANIFEST))
+    stats['hits'] += 1
+    logger.info("Compile cache hit: {}".format(key))
+    return manifest['metafile']
+
+
+def store(key, metafile, files, awg_metas={}):
+    '''
+    Stores copies of metafile and files (a list of paths) as cache entry key,
+    then evicts the least recently used entries beyond config.compile_cache_size.
+    '''
+    files = [f for f in [metafile] + list(files) if os.path.exists(f)]
+    size = sum(os.path.getsize(f) for f in files)
+    if size > config.compile_cache_size:
+        logger.info("Not caching compilation of {} bytes".format(size))
+        return
+    if not os.path.exists(cache_dir()):
+        os.makedirs(cache_dir())
+    # build the entry in a temporary folder so that it appears atomically
+    tmp = tempfile.mkdtemp(dir=cache_dir(), prefix='.tmp')
+    manifest = {'metafile': metafile, 'files': [], 'size': size,
+                'awg_metas': awg_metas}
+    for ct, path in enumerate(files):
+        stored = '{}-{}'.format(ct, os.path.basename(path))
+        shutil.copyfile(path, os.path.join(tmp, stored))
+        manifest['files'].append((stored, path))
+    with open(os.path.join(tmp, MANIFEST), 'w') as FID:
+        json.dump(manifest, FID)
+    entry = os.path.join(cache_dir(), key)
+    # compilations in other threads may store the same entry
+    with _store_lock:
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+        evict(config.compile_cache_size)
+
+
+def evict(max_size):
+    '''
+    Removes the least recently used entries until the cache fits in max_size bytes.
+    '''
+    entries = sorted(list_entries(), key=lambda e: e['used'])
+    total = sum(e['size'] for e in entries)
+    for entry in entries:
+        if total <= max_size:
+            break
+        shutil.rmtree(entry['path'], ignore_errors=True)
+        total -= entry['size']
+        stats['evictions'] += 1
+
+
+def list_entries():
+    entries = []
+    if not os.path.exists(cache_dir()):
+        return entries
+    for key in os.listdir(cache_dir()):
+        path = os.path.join(cache_dir(), key)
+        manifest = _read_manifest(path)
+        if manifest is None:
+            continue
+        entries.append({'key': key, 'path': path, 'size': manifest['size'],
+                        'used': os.path.getmtime(os.path.join(path, MANIFEST))})
+    return entries
+
+
+def _read_manifest(entry):
+    return _read_manifest_file(os.path.join(entry, MANIFEST))
+
+
+def _read_manifest_file(path):
+    try:
+        with open(path, 'r') as FID:
+            return json.load(FID)
+    except (OSError, ValueError):
+        return None
+
+
+def _digest(s):
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+def _canonical(obj, state):
+    '''
+    A string that identifies obj by value, with channels replaced by their
+    label and block labels numbered by order of appearance.
+    '''
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        return repr(obj)
+    if isinstance(obj, np.generic):
+        return '{}({!r})'.format(type(obj).__name__, obj.item())
+    if isinstance(obj, np.ndarray):
+        return 'ndarray({},{},{})'.format(obj.dtype, obj.shape,
+                                          hashlib.sha256(obj.tobytes()).hexdigest())
+    if isinstance(obj, BlockLabel):
+        labels = state.setdefault('labels', {})
+        return 'L{}'.format(labels.setdefault(obj.label, len(labels)))
+    if isinstance(obj, Channels.Channel):
+        return 'C({})'.format(obj.label)
+    if isinstance(obj, (list, tuple)) and not isinstance(obj, (Pulse, CompositePulse)):
+        return '[{}]'.format(','.join(_canonical(o, state) for o in obj))
+    if isinstance(obj, dict):
+        return '{{{}}}'.format(','.join('{}:{}'.format(_canonical(k, state), _canonical(v, state))
+                                       for k, v in obj.items()))
+    if callable(obj) and hasattr(obj, '__code__'):
+        return _function_fingerprint(obj)
+
+    # pulses are shared between sequences so we memoize their canonical form
+    memo = state.setdefault('memo', {})
+    if isinstance(obj, (Pulse, CompositePulse, PulseBlock)) and id(obj) in memo:
+        return memo[id(obj)][1]
+    if isinstance(obj, Pulse):
+        out = 'P({})'.format(','.join(_canonical(getattr(obj, f), state)
+                                      for f in obj._fields if f != 'channel'))
+        out += _canonical(obj.channel, state)
+    elif isinstance(obj, CompositePulse):
+        out = 'CP({},{})'.format(repr(obj.label), _canonical(obj.pulses, state))
+    elif hasattr(obj, '__dict__'):
+        out = '{}({})'.format(type(obj).__qualname__,
+                              _canonical(sorted(vars(obj).items()), state))
+    else:
+        raise Uncacheable("cannot fingerprint {}".format(type(obj).__name__))
+    if isinstance(obj, (Pulse, CompositePulse, PulseBlock)):
+        # keep obj alive so that its id is not reused
+        memo[id(obj)] = (obj, out)
+    return out
+
+
+def _function_fingerprint(func):
+    if func.__closure__ or '<' in func.__qualname__:
+        raise Uncacheable("{} is not a module level function".format(func.__qualname__))
+    code = hashlib.sha256(marshal.dumps(func.__code__)).hexdigest()
+    return 'F({}.{},{},{})'.format(func.__module__, func.__qualname__, code,
+                                   _canonical(func.__defaults__, {}))
+
+
+def channel_fingerprints(seqs, channels):
+    '''
+    Digest per logical channel of the part of seqs its wire depends on: its own
+    pulses plus the timing and control flow shared by all channels. Also returns
+    the set of channels carrying measurements (which are needed to count them).
+    '''
+    state = {'labels': {}, 'memo': {}}
+    common = hashlib.sha256()
+    tokens = {chan: [] for chan in channels}
+    measuring = set()
+
+    def add_pulse(ct, chan, pulse):
+        tokens.setdefault(chan, []).append('{}:{};'.format(ct, _canonical(pulse, state)))
+        for p in getattr(pulse, 'pulses', [pulse]):
+            if p.label == "MEAS":
+                measuring.add(chan)
+
+    targets = []
+    for seq in seqs:
+        for entry in flatten(seq):
+            if isinstance(entry, ControlFlow.Call) and entry.target not in targets:
+                targets.append(entry.target)
+    entries = flatten(list(seqs) + [ControlFlow.qfunction_specialization(t) for t in targets])
+    for ct, entry in enumerate(entries):
+        if isinstance(entry, PulseBlock):
+            common.update('{}:B{!r};'.format(ct, entry.length).encode())
+            for chan, pulse in entry.pulses.items():
+                add_pulse(ct, chan, pulse)
+        elif isinstance(entry, (Pulse, CompositePulse)):
+            common.update('{}:B{!r};'.format(ct, entry.length).encode())
+            add_pulse(ct, entry.channel, entry)
+        else:
+            common.update('{}:{};'.format(ct, _canonical(entry, state)).encode())
+    common = common.hexdigest()
+    return {chan: _digest(common + ''.join(tokens[chan])) for chan in channels}, measuring
+
+
+def awg_name(phys_chan):
+    '''
+    The name of the sequence file unit a physical channel is written to.
+    '''
+    module = import_module('QGL.drivers.' + phys_chan.translator)
+    return phys_chan.label if module.SEQFILE_PER_CHANNEL else phys_chan.instrument
+
+
+def awg_fingerprints(seqs, channels, **compile_args):
+    '''
+    Digest per AWG (or per channel for SEQFILE_PER_CHANNEL translators) of
+    everything its sequence file depends on: the sequences of the logical
+    channels mapped onto it (and, for edges, of the target qubit whose frame
+    changes are propagated to the edge), the parameters of those channels,
+    of its physical channels and of the instrument, plus program wide inputs
+    such as the compiler sources, driver flags and channel delays.
+    Also returns the channels that carry measurements.
+    '''
+    views, measuring = channel_fingerprints(seqs, channels)
+    phys_chans = set(chan.phys_chan for chan in channels)
+    cl = CompileContexts.channel_library()
+    program = _digest(repr((
+        sorted(translator_fingerprint().items()),
+        sorted((k, _canonical(v, {})) for k, v in compile_args.items()),
+        sorted(chan.label for chan in channels),
+        sorted((chan.label, repr(chan.delay)) for chan in phys_chans),
+        CompileContexts.awg_dir(), cl.db_provider, cl.db_resource_name, cl.channelDatabase.id)))
+
+    params = {}
+    def params_digest(obj):
+        if obj is None:
+            return None
+        if obj.label not in params:
+            params[obj.label] = _digest(library_object_params(obj))
+        return params[obj.label]
+
+    digests = {}
+    for chan in sorted(channels, key=lambda c: c.label):
+        deps = [chan]
+        if isinstance(chan, Channels.Edge) and chan.target in channels:
+            deps.append(chan.target)
+        phys = chan.phys_chan
+        instrument = cl.channelDict.get(phys.instrument)
+        digests.setdefault(awg_name(phys), [program]).append(
+            (chan.label, [(d.label, views[d], params_digest(d)) for d in deps],
+             params_digest(phys), params_digest(instrument)))
+    return {awg: _digest(repr(d)) for awg, d in digests.items()}, measuring
+
+
+def incremental_record_path(fileName, suffix=''):
+    key = _digest(repr((CompileContexts.awg_dir(), fileName, suffix)))
+    return os.path.join(cache_dir(), 'incremental', key + '.json')
+
+
+def load_incremental_record(fileName, suffix=''):
+    '''
+    Returns the per-AWG records of the previous incremental compilation to
+    fileName whose output files are still on disk and unchanged since.
+    '''
+    record = _read_manifest_file(incremental_record_path(fileName, suffix))
+    if record is None:
+        return {}
+    return {awg: rec for awg, rec in record.items()
+            if [_file_stamp(f) for f in rec['files']] == rec['stamps']}
+
+
+def save_incremental_record(fileName, suffix, record):
+    '''
+    Saves the per-AWG records of an incremental compilation. record maps AWG
+    names to {'digest', 'files', 'files_key', 'meta'} where 'files' are the
+    paths written for the AWG and 'files_key' its key in the metafile
+    instruments (or None if it is not listed there).
+    '''
+    path = incremental_record_path(fileName, suffix)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    for rec in record.values():
+        rec['stamps'] = [_file_stamp(f) for f in rec['files']]
+    with open(path, 'w') as FID:
+        json.dump(record, FID)
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
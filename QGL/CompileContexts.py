@@ -0,0 +1,187 @@
+'''
+State of the construction and compilation of a program.
+
+Building and compiling sequences uses a channel library, an output directory
+and a few caches and counters: the memoized pulses of PulsePrimitives, the
+qfunction bodies of ControlFlow, the block label counter of BlockLabel and the
+shape graph of CompositeShapes. By default these are module globals (and
+ChannelLibraries.channelLib, config.AWGDir), shared by the whole process.
+
+A CompileContext owns its own copy of them. While it is entered, in a with
+statement or through the context argument of compile_to_hardware, the code
+running in the same thread (or asyncio task) uses the context instead of the
+globals, so that independent programs can be built concurrently in threads and
+compiled from them:
+
+    with CompileContext(channelLib=cl, AWGDir=awg_dir) as ctx:
+        seqs = [[X(q1), MEAS(q1)]]
+        compile_to_hardware(seqs, 'Test/test')
+
+Each thread should use its own context, and the sequences compiled in a
+context should be built in it (or in the context it was derived from, see
+CompileContext.from_current). The WaveformCache and the CompileCache are
+shared by all contexts. Profiling (see Profiler) is process wide.
+
+The channel objects are not copied: all the channel libraries of a process
+share the one database session of bbndb, which is not thread safe. The
+compilations only go through it, holding library_lock, to update the library
+when they start (see update_library) and to record the extra_meta of the AWGs
+when they finish; in between they read the channels without changing them, so
+compilations in different contexts run at the same time. The library should
+not be edited while a compilation runs.
+
+Copyright 2020 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import threading
+import contextvars
+from concurrent.futures import CancelledError
+from functools import wraps
+
+from . import config
+
+# the context entered in the current thread or task, if any
+_current = contextvars.ContextVar('QGL.CompileContext', default=None)
+
+# held while the compilations use the shared database session
+library_lock = threading.RLock()
+
+
+class CompileCancelled(CancelledError):
+    pass
+
+
+class CompileContext(object):
+    '''
+    The channel library and output directory (by default those current when
+    the context is created) and the caches and counters used to build and
+    compile sequences. A context can be entered again, also while it is active.
+    '''
+    def __init__(self, channelLib=None, AWGDir=None):
+        if channelLib is None:
+            channelLib = channel_library()
+        self.channelLib = channelLib
+        self.AWGDir = awg_dir() if AWGDir is None else AWGDir
+        # PulsePrimitives._memoize
+        self.pulse_cache = {}
+        # PulseSequencer._hash_cache
+        self.pulse_hashes = {}
+        # ControlFlow.qfunction
+        self.qfunction_seq = {}
+        self.qfunction_targets = {}
+        # BlockLabel.newlabel
+        self.numlabels = 0
+        # CompositeShapes
+        self.composite_ids = {}
+        self.composite_shapes = {}
+        self.composite_generation = None
+        # set by cancel(), checked by checkpoint()
+        self.cancelled = False
+        self._tokens = []
+
+    @classmethod
+    def from_current(cls, channelLib=None, AWGDir=None):
+        '''
+        A new context that carries on from the current one (or the global
+        state): it has the qfunction bodies registered so far and continues the
+        label numbering, so that the sequences built so far can be compiled in
+        it.
+        '''
+        from . import BlockLabel, ControlFlow
+        ctx = cls(channelLib, AWGDir)
+        ctx.qfunction_seq = dict(ControlFlow.qfunction_table())
+        current = _current.get()
+        ctx.numlabels = BlockLabel.newlabel.numlabels if current is None else current.numlabels
+        return ctx
+
+    def cancel(self):
+        '''
+        Asks the compilation running in this context to stop at its next
+        checkpoint, with a CompileCancelled exception.
+        '''
+        self.cancelled = True
+
+    def __enter__(self):
+        self._tokens.append(_current.set(self))
+        return self
+
+    def __exit__(self, *exc):
+        _current.reset(self._tokens.pop())
+
+
+def current():
+    '''
+    The CompileContext entered in this thread or task, or None.
+    '''
+    return _current.get()
+
+
+def channel_library():
+    '''
+    The channel library of the current context, or ChannelLibraries.channelLib.
+    '''
+    ctx = _current.get()
+    if ctx is None:
+        from . import ChannelLibraries
+        return ChannelLibraries.channelLib
+    return ctx.channelLib
+
+
+def awg_dir():
+    '''
+    The output directory of the current context, or config.AWGDir.
+    '''
+    ctx = _current.get()
+    return config.AWGDir if ctx is None else ctx.AWGDir
+
+
+def checkpoint():
+    '''
+    Raises CompileCancelled if the current context was cancelled.
+    '''
+    ctx = _current.get()
+    if ctx is not None and ctx.cancelled:
+        raise CompileCancelled("Compilation cancelled")
+
+
+def with_context(func):
+    '''
+    Adds a context keyword argument to func, the CompileContext to run it in.
+    '''
+    @wraps(func)
+    def wrapper(*args, context=None, **kwargs):
+        if context is None:
+            return func(*args, **kwargs)
+        with context:
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def update_library():
+    '''
+    Updates the channel library of the current context for a compilation,
+    holding library_lock, and loads what its objects point to (e.g. the
+    physical channel of a qubit) so that the compilation reads them without
+    going through the database session.
+    '''
+    import sqlalchemy
+    from sqlalchemy.orm.interfaces import MANYTOONE
+    library = channel_library()
+    with library_lock:
+        library.update_channelDict()
+        for obj in library.channelDict.values():
+            for rel in sqlalchemy.inspect(type(obj)).relationships:
+                if rel.direction is MANYTOONE and rel.key != 'channel_db':
+                    getattr(obj, rel.key)
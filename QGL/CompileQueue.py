@@ -0,0 +1,196 @@
+'''
+Background compilation, to compile the next experiment while the current one
+runs.
+
+compile_to_hardware_async(seqs, fileName, ...) queues a compile_to_hardware
+and returns at once a CompileFuture (a concurrent.futures.Future) of the path of
+the metafile. The compilations run in order on background threads (see
+config.compile_queue_workers), each in its own CompileContext carrying on from
+the caller's (see CompileContext.from_current), so that they share no caches
+or counters with the caller or with each other. At most
+config.compile_queue_size compilations wait for a thread; submitting another
+blocks until one starts, or raises queue.Full after the given timeout.
+
+    future = compile_to_hardware_async(seqs, 'Rabi/Rabi')
+    ... acquire the previous experiment ...
+    metafile = future.result()
+
+The sequences belong to the compilation once submitted (compile_to_hardware
+adds the triggers and gates to them). future.cancel() drops a compilation that
+has not started yet, and asks a running one to stop at its next checkpoint,
+after which result() raises CompileCancelled (a CancelledError). The files it
+has written by then are left as they are.
+
+The compiler is mostly Python code, so a background compilation overlaps
+with waiting on instruments or with other processes rather than with Python
+work in the calling process (or other compilations, with several workers).
+
+Copyright 2020 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import queue
+import atexit
+import logging
+import threading
+from concurrent.futures import Future
+
+from . import config
+from . import Compiler
+from .CompileContexts import CompileContext, CompileCancelled
+
+logger = logging.getLogger(__name__)
+
+
+class CompileFuture(Future):
+    '''
+    The future of a queued compilation, in its CompileContext context.
+    '''
+    def __init__(self, context):
+        super().__init__()
+        self.context = context
+
+    def cancel(self):
+        '''
+        Cancels the compilation if it has not started, or asks it to stop if it
+        is running. Returns False if it has already finished.
+        '''
+        if super().cancel():
+            return True
+        if self.running():
+            self.context.cancel()
+            return True
+        return False
+
+
+class CompileQueue(object):
+    '''
+    Runs the compilations submitted to it in order on workers background
+    threads, with at most max_pending compilations waiting (defaults:
+    config.compile_queue_workers and config.compile_queue_size). The threads
+    are started on the first submission.
+    '''
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or config.compile_queue_workers
+        if max_pending is None:
+            max_pending = config.compile_queue_size
+        self.pending = queue.Queue()
+        # a slot per waiting compilation, released when a thread picks it up
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.threads = []
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def submit(self, seqs, fileName, context=None, block=True, timeout=None,
+               **compile_args):
+        '''
+        Queues compile_to_hardware(seqs, fileName, **compile_args) in context
+        (default: a new CompileContext.from_current()). If the queue is full,
+        waits for a free slot (up to timeout seconds) or, without block, raises
+        queue.Full. Returns a CompileFuture of the path of the metafile.
+        '''
+        if self.closed:
+            raise RuntimeError("Cannot submit a compilation after shutdown")
+        if not self.slots.acquire(block, timeout):
+            raise queue.Full("{} compilations are already waiting".format(
+                self.pending.qsize()))
+        future = CompileFuture(context or CompileContext.from_current())
+        self.start()
+        self.pending.put((future, seqs, fileName, compile_args))
+        return future
+
+    def start(self):
+        with self._lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.run, daemon=True,
+                                          name='QGL-compile-{}'.format(len(self.threads)))
+                thread.start()
+                self.threads.append(thread)
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            self.slots.release()
+            future, seqs, fileName, compile_args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                metafile = Compiler.compile_to_hardware(seqs, fileName,
+                                                        context=future.context,
+                                                        **compile_args)
+            except CompileCancelled as e:
+                logger.info("Cancelled the compilation of %s", fileName)
+                future.set_exception(e)
+            except BaseException as e:
+                logger.exception("Compilation of %s failed", fileName)
+                future.set_exception(e)
+            else:
+                future.set_result(metafile)
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        '''
+        Stops the threads once the compilations submitted so far are done (or,
+        with cancel_pending, once the running ones are, the others being
+        cancelled). With wait, waits for them.
+        '''
+        self.closed = True
+        if cancel_pending:
+            while True:
+                try:
+                    item = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self.slots.release()
+                    item[0].cancel()
+        with self._lock:
+            for _ in self.threads:
+                self.pending.put(None)
+            threads, self.threads = self.threads, []
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+_default_queue = None
+_default_lock = threading.Lock()
+
+
+def default_queue():
+    '''
+    The CompileQueue of compile_to_hardware_async, created when first needed.
+    '''
+    global _default_queue
+    with _default_lock:
+        if _default_queue is None or _default_queue.closed:
+            _default_queue = CompileQueue()
+            atexit.register(_default_queue.shutdown)
+        return _default_queue
+
+
+def compile_to_hardware_async(seqs, fileName, **kwargs):
+    '''
+    Queues compile_to_hardware(seqs, fileName, **kwargs) on the default
+    CompileQueue and returns a CompileFuture of the path of the metafile. The
+    context, block and timeout arguments are as for CompileQueue.submit.
+    '''
+    return default_queue().submit(seqs, fileName, **kwargs)
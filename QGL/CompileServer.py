@@ -0,0 +1,362 @@
+'''
+Long running compile server.
+
+An experiment script pays for importing QGL, loading the channel library and
+evaluating every waveform shape before its first compilation. A CompileServer
+process pays for these once: it keeps the channel library loaded (reloading
+it when its database file changes), and the WaveformCache of the shapes it
+has already evaluated (python -m QGL.CompileServer turns on
+config.waveform_cache_enabled). Start it with
+
+    python -m QGL.CompileServer --db path/to/library.sqlite
+
+and compile through it with a CompileClient:
+
+    with CompileClient() as client:
+        metafile, timings = client.compile(seqs, 'Rabi/Rabi')
+
+The client saves the sequences as a program archive (see ProgramArchive) in a
+temporary file and sends the server, over a Unix socket, a request naming it:
+one line of JSON per request and per response. The channels of the program
+are looked up by label in the library of the server, so both should use the
+same database. The server compiles one request at a time, each in its own
+CompileContext, and answers with the path of the metafile and the wall time of
+each step (and, on request, the Profiler report).
+
+The server trusts its clients: a request names a program archive, which is
+loaded with pickle, and output paths. It is meant for the processes of one
+user on one machine only. The socket is created readable and writable by its
+owner only (in a directory of its own by default, see default_socket), and
+where the system tells the user of the other end of a connection (Linux), the
+connections of other users are refused.
+
+LocalClient is a stand-in for CompileClient that calls a CompileServer in the
+same process, e.g. for testing.
+
+Copyright 2020 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import os
+import json
+import stat
+import time
+import struct
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import socketserver
+
+from . import config
+from . import BlockLabel
+from . import ChannelLibraries
+from . import CompileContexts
+from . import ProgramArchive
+from .Compiler import compile_to_hardware
+from .CompileContexts import CompileContext
+
+logger = logging.getLogger(__name__)
+
+
+class CompileServerError(RuntimeError):
+    pass
+
+
+def _uid():
+    return os.getuid() if hasattr(os, 'getuid') else 0
+
+
+def default_socket():
+    '''
+    config.compile_server_socket, or compile.sock in the qgl-compile-<user id>
+    directory of the temporary directory.
+    '''
+    if config.compile_server_socket:
+        return config.compile_server_socket
+    return os.path.join(tempfile.gettempdir(), 'qgl-compile-{}'.format(_uid()),
+                        'compile.sock')
+
+
+def private_directory(path):
+    '''
+    Creates the directory path, readable by its owner only, if it does not
+    exist. Raises CompileServerError if it belongs to another user or others
+    can access it.
+    '''
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != _uid():
+        raise CompileServerError("{} is not a directory of this user".format(path))
+    if info.st_mode & 0o077:
+        raise CompileServerError("{} is accessible to other users".format(path))
+
+
+def peer_uid(sock):
+    '''
+    The user id of the process at the other end of the Unix socket sock, or
+    None if the system does not tell.
+    '''
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        uid = peer_uid(self.connection)
+        if uid is not None and uid != _uid():
+            logger.warning("Refused a connection from user %d", uid)
+            return
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+            except ValueError as e:
+                response = {'error': 'Invalid request: {}'.format(e)}
+            else:
+                response = self.server.compile_server.compile(request)
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class CompileServer(object):
+    '''
+    Compiles requests against channelLib (default: the current channel
+    library). A request is a dictionary with
+        program: the path of a program archive
+        fileName: as for compile_to_hardware
+        AWGDir (optional): the output directory. Defaults to config.AWGDir.
+        numlabels (optional): the number of block labels made by the client,
+            after which the labels made while compiling are numbered
+        compile_args (optional): the other arguments of compile_to_hardware
+        profile (optional): also return the Profiler report
+    and the response a dictionary with the metafile path, the timings (in
+    seconds) of the steps of the request and the profile report if asked
+    for, or an error message.
+    '''
+    def __init__(self, channelLib=None):
+        self.channelLib = channelLib or ChannelLibraries.channelLib
+        if self.channelLib is None:
+            raise Exception("No channel library initialized")
+        self.lock = threading.Lock()
+        self.library_stamp = self.db_stamp()
+        self.server = None
+
+    def db_stamp(self):
+        '''
+        The modification time and size of the database file of the library,
+        or None if it is not a file.
+        '''
+        cl = self.channelLib
+        if cl.db_provider != 'sqlite' or cl.db_resource_name in (None, '', ':memory:'):
+            return None
+        try:
+            stat = os.stat(cl.db_resource_name)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def check_library(self):
+        '''
+        Reloads the library if its database file changed. Returns whether it did.
+        '''
+        stamp = self.db_stamp()
+        if stamp == self.library_stamp:
+            return False
+        logger.info("Reloading the channel library")
+        self.channelLib.reload()
+        self.library_stamp = stamp
+        return True
+
+    def compile(self, request):
+        start = time.perf_counter()
+        timings = {}
+        with self.lock:
+            try:
+                if self.check_library():
+                    timings['reload'] = time.perf_counter() - start
+                ctx = CompileContext(channelLib=self.channelLib, AWGDir=request.get('AWGDir'))
+                ctx.numlabels = request.get('numlabels', 0)
+                with ctx:
+                    step = time.perf_counter()
+                    seqs = ProgramArchive.load_program(request['program'], self.channelLib)
+                    timings['load'] = time.perf_counter() - step
+                    step = time.perf_counter()
+                    result = compile_to_hardware(seqs, request['fileName'],
+                                                 profile=bool(request.get('profile')),
+                                                 **request.get('compile_args', {}))
+                    timings['compile'] = time.perf_counter() - step
+            except Exception as e:
+                logger.exception("Failed to compile %s", request.get('fileName'))
+                return {'error': '{}: {}'.format(type(e).__name__, e)}
+        timings['total'] = time.perf_counter() - start
+        if request.get('profile'):
+            metafile, report = result
+            return {'metafile': metafile, 'timings': timings, 'profile': report}
+        return {'metafile': result, 'timings': timings}
+
+    def serve_forever(self, path=None):
+        '''
+        Serves the requests sent to the Unix socket path (default:
+        default_socket(), in a directory created for it) until shutdown() is
+        called. A socket left at path by a previous server of this user is
+        replaced; anything else there is an error.
+        '''
+        if path is None:
+            path = default_socket()
+            if not config.compile_server_socket:
+                private_directory(os.path.dirname(path))
+        try:
+            info = os.lstat(path)
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(info.st_mode) or info.st_uid != _uid():
+                raise CompileServerError(
+                    "{} exists and is not a socket of this user".format(path))
+            os.remove(path)
+        # only the owner may connect
+        umask = os.umask(0o177)
+        try:
+            self.server = _UnixServer(path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.compile_server = self
+        logger.info("Compile server listening on %s", path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(path)
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+
+class CompileClient(object):
+    '''
+    Sends compile requests to the CompileServer listening on the Unix socket
+    path (default: default_socket()).
+    '''
+    def __init__(self, path=None):
+        self.path = path or default_socket()
+        self.sock = None
+        self.FID = None
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.FID = self.sock.makefile('rwb')
+
+    def close(self):
+        if self.sock is not None:
+            self.FID.close()
+            self.sock.close()
+            self.sock = self.FID = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, request):
+        if self.sock is None:
+            self.connect()
+        self.FID.write(json.dumps(request).encode() + b'\n')
+        self.FID.flush()
+        line = self.FID.readline()
+        if not line:
+            self.close()
+            raise CompileServerError("The compile server closed the connection")
+        return json.loads(line.decode())
+
+    def compile(self, seqs, fileName, profile=False, **compile_args):
+        '''
+        Compiles seqs on the server as compile_to_hardware(seqs, fileName,
+        **compile_args), in the output directory of the current context.
+        compile_args must be JSON serializable. Returns the path of the metafile
+        and the timings of the request (with profile, the Profiler report is
+        added to them as 'profile').
+        '''
+        fd, program = tempfile.mkstemp(suffix='.qgl')
+        os.close(fd)
+        try:
+            ProgramArchive.save_program(seqs, program)
+            ctx = CompileContexts.current()
+            response = self.send({
+                'program': program,
+                'fileName': fileName,
+                'AWGDir': CompileContexts.awg_dir(),
+                'numlabels': BlockLabel.newlabel.numlabels if ctx is None else ctx.numlabels,
+                'compile_args': compile_args,
+                'profile': profile})
+        finally:
+            os.remove(program)
+        if 'error' in response:
+            raise CompileServerError(response['error'])
+        timings = response['timings']
+        if profile:
+            timings['profile'] = response['profile']
+        return response['metafile'], timings
+
+
+class LocalClient(CompileClient):
+    '''
+    A CompileClient that hands its requests to server, a CompileServer in this
+    process (default: one for the current channel library), through JSON as
+    over the socket.
+    '''
+    def __init__(self, server=None):
+        super().__init__()
+        self.server = server or CompileServer()
+
+    def send(self, request):
+        response = self.server.compile(json.loads(json.dumps(request)))
+        return json.loads(json.dumps(response))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QGL compile server")
+    parser.add_argument('--socket', default=None,
+                        help="Unix socket to listen on (default: {})".format(default_socket()))
+    parser.add_argument('--db', default=None,
+                        help="channel library database (default: the BBN_DB environment variable)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    db_resource_name = args.db or config.load_db()
+    if db_resource_name is None:
+        parser.error("no channel library database given")
+    ChannelLibraries.ChannelLibrary(db_resource_name=db_resource_name)
+    # the shapes evaluated by this process are what it keeps warm
+    config.waveform_cache_enabled = True
+    server = CompileServer()
+    try:
+        server.serve_forever(args.socket)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -18,31 +18,44 @@ limitations under the License.
 import logging
 import numpy as np
 import os
-import operator
 from warnings import warn
 from copy import copy
-from functools import reduce
+from functools import reduce, wraps
+from itertools import chain, count, islice
+from collections.abc import Iterator
 from importlib import import_module
 import json
 from . import config
 from . import PatternUtils
 from .PatternUtils import flatten, has_gate
 from . import Channels
-from . import ChannelLibraries
+from . import CompileContexts
 from . import PulseShapes
+from . import PulseSequencer
 from .PulsePrimitives import Id, clear_pulse_cache
-from .PulseSequencer import Pulse, PulseBlock, CompositePulse
+from .PulseSequencer import Pulse, PulseBlock, CompositePulse, same_length
 from . import ControlFlow
 from . import BlockLabel
 from . import TdmInstructions # only for APS2-TDM
+from . import CompileCache
+from . import Profiler
+from . import ProgramArchive
+from . import WaveformCache
+from . import WireArrays
+from . import CompositeShapes
 import gc
+import io
+import pickle
+import multiprocessing
 
 logger = logging.getLogger(__name__)
 
-def map_logical_to_physical(wires):
+def map_logical_to_physical(wires, shape_funLibs=None):
     """construct a mapping of physical channels to lists of logical channels
     (there will be more than one logical channel if multiple logical
-    channels share a physical channel)"""
+    channels share a physical channel)
+    shape_funLibs (optional) keeps the shape functions of merged pulses per
+    physical channel, so that chunks compiled separately share them"""
     physicalChannels = {}
     for logicalChan in wires.keys():
         phys_chan = logicalChan.phys_chan
@@ -57,17 +70,20 @@ def map_logical_to_physical(wires):
     physicalWires = {}
     for phys_chan, logicalChan in physicalChannels.items():
         if len(logicalChan) > 1:
-            physicalWires[phys_chan] = merge_channels(wires, logicalChan)
+            physicalWires[phys_chan] = merge_channels(wires, logicalChan,
+                None if shape_funLibs is None else shape_funLibs.setdefault(phys_chan, {}))
         else:
             physicalWires[phys_chan] = wires[logicalChan[0]]
 
     return physicalWires
 
 
-def merge_channels(wires, channels):
+def merge_channels(wires, channels, shape_funLib=None):
     chan = channels[0]
     mergedWire = [[] for _ in range(len(wires[chan]))]
-    shape_funLib = {}
+    sampling_rate = chan.phys_chan.sampling_rate if config.sample_lengths else None
+    if shape_funLib is None:
+        shape_funLib = {}
     for ct, segment in enumerate(mergedWire):
         entry_iterators = [iter(wires[ch][ct]) for ch in channels]
         while True:
@@ -87,7 +103,8 @@ def merge_channels(wires, channels):
                 segment.append(entries[0])
                 continue
             # at this point we have at least one waveform instruction
-            entries, block_length = pull_uniform_entries(entries, entry_iterators)
+            entries, block_length = pull_uniform_entries(entries, entry_iterators,
+                                                         sampling_rate)
 
             # look for the simplest case of at most one non-identity
             if len(entries) == 1:
@@ -116,12 +133,9 @@ def merge_channels(wires, channels):
                 phase = 0.0
                 pulsesHash = tuple([(e.hashshape(), e.amp, e.phase) for e in entries])
                 if pulsesHash not in shape_funLib:
-                    # create closure to sum waveforms
-                    def sum_shapes(entries=entries, **kwargs):
-                        return reduce(operator.add,
-                            [e.amp * np.exp(1j * e.phase) * e.shape for e in entries])
-
-                    shape_funLib[pulsesHash] = sum_shapes
+                    # sum the waveforms
+                    shape_funLib[pulsesHash] = CompositeShapes.SumShape(
+                        [(e.amp * np.exp(1j * e.phase), e) for e in entries])
                 shape_fun = shape_funLib[pulsesHash]
 
             shapeParams = {"shape_fun": shape_fun, "length": block_length}
@@ -132,7 +146,7 @@ def merge_channels(wires, channels):
     return mergedWire
 
 
-def pull_uniform_entries(entries, entry_iterators):
+def pull_uniform_entries(entries, entry_iterators, sampling_rate=None):
     '''
     Given entries from a set of logical channels (that share a physical
     channel), pull enough entries from each channel so that the total pulse
@@ -144,12 +158,15 @@ def pull_uniform_entries(entries, entry_iterators):
         A1* = A1 + B1 + C1
     and update entries such that entries = [A1*, A2].
     The function returns the resulting block length.
+    With a sampling_rate, the lengths are compared in (integer) samples.
     '''
     numChan = len(entries)
     #keep track of how many entry iterators are used up
     iterDone = [ False ] * numChan
     ct = 0
     lengths = np.array([e.length for e in entries])
+    if sampling_rate is not None:
+        samples = [round(e.length * sampling_rate) for e in entries]
     entries_stack = [[e] for e in entries]
 
     while True:
@@ -157,12 +174,16 @@ def pull_uniform_entries(entries, entry_iterators):
         if all(iterDone):
             raise StopIteration("Unable to find a uniform set of entries")
 
+        if sampling_rate is not None:
+            if all(s == samples[0] for s in samples):
+                break
         #if all(np.isclose(x, lengths[0], atol=1e-10) for x in lengths):
-        if np.all(np.less(np.abs(lengths - lengths[0]), 1e-10)):
+        elif np.all(np.less(np.abs(lengths - lengths[0]), 1e-10)):
             break
 
         #Otherwise try to concatenate on entries to match lengths
-        while not np.isclose(lengths[ct], max(lengths), atol=1e-10):
+        while (samples[ct] != max(samples) if sampling_rate is not None
+               else not same_length(lengths[ct], max(lengths))):
             # concatenate with following entry to make up the length difference
             try:
                 next_entry = next(entry_iterators[ct])
@@ -171,6 +192,8 @@ def pull_uniform_entries(entries, entry_iterators):
 
             entries_stack[ct].append(next_entry)
             lengths[ct] += next_entry.length
+            if sampling_rate is not None:
+                samples[ct] += round(next_entry.length * sampling_rate)
 
         ct = (ct + 1) % numChan
 
@@ -200,14 +223,10 @@ def concatenate_entries(entry1, entry2):
     frameChange = entry1.frameChange + entry2.frameChange
     if not (entry1.isTimeAmp and entry2.isTimeAmp and entry1.amp == entry2.amp
             and entry1.phase == (entry1.frameChange + entry2.phase)):
-        # otherwise, need to build a closure to stack them
-        def stack_shapes(entry1=entry1, entry2=entry2, **kwargs):
-            return np.hstack((
-                entry1.amp * np.exp(1j * entry1.phase) * entry1.shape,
-                entry2.amp * np.exp(1j * (entry1.frameChange + entry2.phase)) *
-                entry2.shape))
-
-        shapeParams['shape_fun'] = stack_shapes
+        # otherwise, need to stack them
+        shapeParams['shape_fun'] = CompositeShapes.StackShape([
+            (entry1.amp * np.exp(1j * entry1.phase), entry1),
+            (entry2.amp * np.exp(1j * (entry1.frameChange + entry2.phase)), entry2)])
         label = entry1.label + '+' + entry2.label
         amp = 1.0
         phase = 0.0
@@ -216,8 +235,14 @@ def concatenate_entries(entry1, entry2):
 
 
 def generate_waveforms(physicalWires):
+    '''
+    Builds the library of the unique shapes of each wire. The shapes of the
+    same shape function are evaluated together (see PulseShapes.batch_shapes),
+    or taken from the waveform cache (see WaveformCache).
+    '''
     wfs = {ch: {} for ch in physicalWires.keys()}
     for ch, wire in physicalWires.items():
+        batches = {}
         for pulse in flatten(wire):
             if not isinstance(pulse, Pulse):
                 continue
@@ -225,14 +250,29 @@ def generate_waveforms(physicalWires):
                 if pulse.isTimeAmp:
                     wfs[ch][pulse.hashshape()] = np.ones(1, dtype=np.complex)
                 else:
-                    wfs[ch][pulse.hashshape()] = pulse.shape
+                    # keep the place of the shape in the library
+                    wfs[ch][pulse.hashshape()] = None
+                    shape_fun, params = pulse.shape_call()
+                    batches.setdefault(shape_fun, []).append((pulse.hashshape(), params))
+        for shape_fun, batch in batches.items():
+            shapes = WaveformCache.get_shapes(shape_fun, [params for _, params in batch])
+            for (key, _), shape in zip(batch, shapes):
+                wfs[ch][key] = shape
     return wfs
 
 
 def pulses_to_waveforms(physicalWires):
+    '''
+    Replaces the Pulses of each wire with Waveforms or, for the translators that
+    accept them, turns the wire into a WireArrays (see config.wire_arrays).
+    '''
     logger.debug("Converting pulses_to_waveforms:")
     wireOuts = {ch: [] for ch in physicalWires.keys()}
     for ch, seqs in physicalWires.items():
+        if config.wire_arrays and getattr(
+                import_module('QGL.drivers.' + ch.translator), 'WIRE_ARRAYS', False):
+            wireOuts[ch] = WireArrays.WireArrays.from_pulses(seqs)
+            continue
         logger.debug('')
         logger.debug("Channel '%s':", ch)
         for seq in seqs:
@@ -256,7 +296,7 @@ def channel_delay_map(physicalWires):
 def setup_awg_channels(physicalChannels):
     translators = {}
     for chan in physicalChannels:
-        translators[chan.instrument] = import_module('QGL.drivers.' + chan.translator)
+        translators[CompileCache.awg_name(chan)] = import_module('QGL.drivers.' + chan.translator)
 
     data = {awg: translator.get_empty_channel_set()
             for awg, translator in translators.items()}
@@ -278,10 +318,11 @@ def bundle_wires(physWires, wfs):
         _, awgChan = chan.label.rsplit('-', 1)
         if awgChan[0] != 'm':
             awgChan = 'ch' + awgChan
-        awgData[chan.instrument][awgChan]['linkList'] = physWires[chan]
-        awgData[chan.instrument][awgChan]['wfLib'] = wfs[chan]
+        awgName = CompileCache.awg_name(chan)
+        awgData[awgName][awgChan]['linkList'] = physWires[chan]
+        awgData[awgName][awgChan]['wfLib'] = wfs[chan]
         if hasattr(chan, 'correctionT'):
-            awgData[chan.instrument][awgChan]['correctionT'] = chan.correctionT
+            awgData[awgName][awgChan]['correctionT'] = chan.correctionT
     return awgData
 
 
@@ -300,6 +341,47 @@ def collect_specializations(seqs):
             done.append(target)
     return funcs
 
+def decorate_sequences(seqs, add_slave_trigger=True):
+    '''
+    Adds the WAITs, digitizer triggers, gating/blanking pulses and slave
+    trigger that compile_to_hardware needs to the sequences, in place.
+    '''
+    # all sequences should start with a WAIT for synchronization
+    for seq in seqs:
+        if not isinstance(seq[0], ControlFlow.Wait):
+            logger.debug("Adding a WAIT - first sequence element was %s", seq[0])
+            seq.insert(0, ControlFlow.Wait())
+
+    # Add the digitizer trigger to measurements, the gating/blanking pulses
+    # and the slave trigger in one pass
+    logger.info("Adding digitizer trigger and blanking pulses")
+    if add_slave_trigger and 'slave_trig' in CompileContexts.channel_library():
+        # Add the slave trigger
+        logger.debug("Adding slave trigger")
+        slaveChan = CompileContexts.channel_library()['slave_trig']
+    else:
+        logger.info("Not adding slave trigger")
+        slaveChan = None
+    PatternUtils.decorate(seqs, slaveChan)
+
+def _pulse_hash_scope(func):
+    '''
+    Empties the table of pulse hashes (see PulseSequencer) before and after
+    func, so that it holds the pulses of one compilation at most, and drops the
+    composite shapes evaluated by func.
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        PulseSequencer.clear_hash_cache()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            PulseSequencer.clear_hash_cache()
+            CompositeShapes.forget_shapes()
+    return wrapper
+
+@CompileContexts.with_context
+@_pulse_hash_scope
 def compile_to_hardware(seqs,
                         fileName,
                         library_version=None,
@@ -307,7 +389,13 @@ def compile_to_hardware(seqs,
                         axis_descriptor=None,
                         add_slave_trigger=True,
                         extra_meta=None,
-                        tdm_seq = False):
+                        tdm_seq = False,
+                        workers=None,
+                        awg_workers=None,
+                        max_inflight_awgs=None,
+                        incremental=False,
+                        chunk_size=None,
+                        profile=False):
     '''
     Compiles 'seqs' to a hardware description and saves it to 'fileName'.
     Other inputs:
@@ -322,48 +410,110 @@ def compile_to_hardware(seqs,
             the time delays between pulses.
         add_slave_trigger (optional): add the slave trigger(s)
         tdm_seq (optional): compile for TDM
+        workers (optional): number of processes used to compile the individual
+            sequences. Default None (or 1) compiles serially.
+        awg_workers (optional): number of processes used to write the sequence
+            files of the individual AWGs. Default None (or 1) writes them in turn.
+        max_inflight_awgs (optional): with awg_workers, the maximum number of
+            AWGs being translated at once. Defaults to awg_workers.
+        incremental (optional): only rebuild the sequence files of the AWGs whose
+            inputs changed since the previous incremental compilation to
+            'fileName', reusing the files (and metafile entries) of the others.
+        chunk_size (optional): compile the sequences in chunks of chunk_size
+            sequences with compile_to_hardware_streaming. This is the default
+            (with config.stream_chunk_size) when seqs is an iterator, e.g. a
+            generator, rather than a list. TDM sequences (tdm_seq) are
+            compiled at once regardless.
+        profile (optional): profile the compilation (see Profiler) and return
+            (metafile path, report) rather than just the path. With
+            config.profile_compile, every compilation is profiled and the last
+            report is kept in Profiler.last_report. With config.profile_in_meta,
+            the report is also saved in the metafile.
+        context (optional): the CompileContext to compile in (see CompileContexts),
+            e.g. to compile in several threads at once. Default None uses the
+            context entered by the caller, if any, or the global state.
+    If config.compile_cache_enabled, the outputs are cached and compiling the
+    same inputs again restores them instead of recompiling (see CompileCache).
     '''
-    ChannelLibraries.channelLib.update_channelDict()
+    if profile or (config.profile_compile and Profiler.active is None):
+        with Profiler.profiling():
+            metafilepath = compile_to_hardware(seqs, fileName, library_version,
+                                               suffix, axis_descriptor,
+                                               add_slave_trigger, extra_meta,
+                                               tdm_seq, workers, awg_workers,
+                                               max_inflight_awgs, incremental,
+                                               chunk_size)
+        report = Profiler.last_report
+        if metafilepath and config.profile_in_meta:
+            add_profile_to_meta(metafilepath, report)
+        return (metafilepath, report) if profile else metafilepath
+
+    if (chunk_size or isinstance(seqs, Iterator)) and tdm_seq:
+        # the TDM instructions are written for the whole program at once
+        warn("TDM sequences cannot be compiled in chunks; compiling them at once")
+        seqs = list(seqs)
+    elif chunk_size or isinstance(seqs, Iterator):
+        if incremental:
+            warn("Incremental compilation does not support compiling in chunks")
+        return compile_to_hardware_streaming(seqs, fileName, chunk_size=chunk_size,
+                                             library_version=library_version,
+                                             suffix=suffix,
+                                             axis_descriptor=axis_descriptor,
+                                             add_slave_trigger=add_slave_trigger,
+                                             extra_meta=extra_meta,
+                                             workers=workers)
+
+    CompileContexts.update_library()
     clear_pulse_cache()
+    CompositeShapes.clear_cache()
+
+    compile_args = dict(fileName=fileName, suffix=suffix,
+                        axis_descriptor=axis_descriptor,
+                        add_slave_trigger=add_slave_trigger,
+                        extra_meta=extra_meta, tdm_seq=tdm_seq)
+    cache_key = None
+    if config.compile_cache_enabled:
+        Profiler.step('cache_lookup')
+        cache_key = CompileCache.fingerprint(seqs, **compile_args)
+        if cache_key:
+            metafilepath = CompileCache.restore(cache_key)
+            if metafilepath:
+                save_code(seqs, fileName + suffix)
+                return metafilepath
 
     logger.debug("Compiling %d sequence(s)", len(seqs))
 
     # save input code to file
+    Profiler.step('save_code')
     save_code(seqs, fileName + suffix)
 
-    # all sequences should start with a WAIT for synchronization
-    for seq in seqs:
-        if not isinstance(seq[0], ControlFlow.Wait):
-            logger.debug("Adding a WAIT - first sequence element was %s", seq[0])
-            seq.insert(0, ControlFlow.Wait())
-
-    # Add the digitizer trigger to measurements
-    logger.info("Adding digitizer trigger")
-    PatternUtils.add_digitizer_trigger(seqs)
-
-    # Add gating/blanking pulses
-    logger.info("Adding blanking pulses")
-    for seq in seqs:
-        PatternUtils.add_parametric_pulses(seq)
-        PatternUtils.add_gate_pulses(seq)
-
-    if add_slave_trigger and 'slave_trig' in ChannelLibraries.channelLib:
-        # Add the slave trigger
-        logger.debug("Adding slave trigger")
-        PatternUtils.add_slave_trigger(seqs,
-                                       ChannelLibraries.channelLib['slave_trig'])
-    else:
-        logger.info("Not adding slave trigger")
+    CompileContexts.checkpoint()
+    Profiler.step('decorate')
+    decorate_sequences(seqs, add_slave_trigger)
 
     # find channel set at top level to account for individual sequence channel variability
     logger.info("Finding unique channels.")
+    Profiler.step('find_channels')
     channels = set()
     for seq in seqs:
         channels |= find_unique_channels(seq)
 
+    plan = None
+    if incremental and tdm_seq:
+        warn("Incremental compilation does not support TDM sequences")
+    elif incremental:
+        logger.info("Finding AWGs to rebuild.")
+        Profiler.step('plan_incremental')
+        plan = plan_incremental_compile(seqs, channels, **compile_args)
+
     # Compile all the pulses/pulseblocks to sequences of pulses and control flow
     logger.info("Compiling sequences.")
-    wireSeqs = compile_sequences(seqs, channels)
+    Profiler.step('compile_sequences')
+    if plan:
+        wireSeqs = compile_sequences(seqs, plan['channels'], workers=workers)
+    else:
+        wireSeqs = compile_sequences(seqs, channels, workers=workers)
+    Profiler.count(sequences=len(seqs), wires=len(wireSeqs))
 
     if not validate_linklist_channels(wireSeqs.keys()):
         print("Compile to hardware failed")
@@ -373,6 +523,7 @@ def compile_to_hardware(seqs,
     logger.debug("Now after gating constraints:")
     # apply gating constraints
     logger.info("Applying gating constraints")
+    Profiler.step('gating')
     for chan, seq in wireSeqs.items():
         if isinstance(chan, Channels.LogicalMarkerChannel):
             wireSeqs[chan] = PatternUtils.apply_gating_constraints(
@@ -381,22 +532,31 @@ def compile_to_hardware(seqs,
 
     # save number of measurements for meta info
     logger.info("Counting measurements.")
+    Profiler.step('count_measurements')
     num_measurements = count_measurements(wireSeqs)
     wire_measurements = count_measurements_per_wire(wireSeqs)
 
+    if plan:
+        # drop the wires of the AWGs whose files are reused
+        wireSeqs = {chan: seq for chan, seq in wireSeqs.items()
+                    if CompileCache.awg_name(chan.phys_chan) not in plan['reuse']}
+
     # map logical to physical channels, physWires is a list of
     # PhysicalQuadratureChannels and PhysicalMarkerChannels
     # for the APS, the naming convention is:
     # ASPName-12, or APSName-12m1
     logger.info("Mapping logical to physical channels.")
+    Profiler.step('map_to_physical')
     physWires = map_logical_to_physical(wireSeqs)
+    if Profiler.active:
+        Profiler.count(pulses=count_pulses(physWires))
 
     # Pave the way for composite instruments, not useful yet...
+    # (the channels of SEQFILE_PER_CHANNEL translators get a sequence file
+    # each, named after the channel, see CompileCache.awg_name)
     files = {}
     label_to_inst   = {}
     label_to_chan   = {}
-    old_wire_names  = {}
-    old_wire_instrs = {}
     for wire, pulses in physWires.items():
         pattern_module = import_module('QGL.drivers.' + wire.translator)
         if pattern_module.SEQFILE_PER_CHANNEL:
@@ -406,16 +566,16 @@ def compile_to_hardware(seqs,
             label_to_inst[wire.label] = inst_name
             if has_non_id_pulses:
                 label_to_chan[wire.label] = chan_name
-            # Change the name/inst for uniqueness, but we must restore this later!
-            old_wire_names[wire] = wire.label
-            old_wire_instrs[wire] = wire.instrument
-            wire.instrument = wire.label
-            wire.label = chan_name
             #files[inst_name] = {}
 
     # construct channel delay map
     logger.info("Constructing delay map.")
-    delays = channel_delay_map(physWires)
+    Profiler.step('delays')
+    if plan:
+        # delays are relative to all the channels, including the reused ones
+        delays = channel_delay_map({chan.phys_chan: None for chan in channels})
+    else:
+        delays = channel_delay_map(physWires)
 
     # apply delays
     logger.info("Applying delays.")
@@ -425,67 +585,403 @@ def compile_to_hardware(seqs,
 
     # generate wf library (base shapes)
     logger.info("Generating waveform library.")
+    CompileContexts.checkpoint()
+    Profiler.step('generate_waveforms')
     wfs = generate_waveforms(physWires)
+    Profiler.count(unique_shapes=sum(len(shapes) for shapes in wfs.values()))
 
     # replace Pulse objects with Waveforms
     logger.info("Replacing pulses with waveforms")
+    Profiler.step('pulses_to_waveforms')
     physWires = pulses_to_waveforms(physWires)
+    if Profiler.active:
+        Profiler.count(waveforms=count_pulses(physWires, Waveform))
 
     # bundle wires on instruments, or channels depending
     # on whether we have one sequence per channel
     logger.info("Bundling wires.")
+    Profiler.step('bundle')
     awgData = bundle_wires(physWires, wfs)
     del wireSeqs
     gc.collect()
 
     # convert to hardware formats
-    # files = {}
-    awg_metas = {}
-    for awgName in list(awgData.keys()):
-        data = awgData[awgName]
-        # create the target folder if it does not exist
-        targetFolder = os.path.split(os.path.normpath(os.path.join(
-            config.AWGDir, fileName)))[0]
-        if not os.path.exists(targetFolder):
-            os.mkdir(targetFolder)
-        fullFileName = os.path.normpath(os.path.join(
-            config.AWGDir, fileName + '-' + awgName + suffix + data[
+    # create the target folder if it does not exist
+    targetFolder = os.path.split(os.path.normpath(os.path.join(
+        CompileContexts.awg_dir(), fileName)))[0]
+    if not os.path.exists(targetFolder):
+        os.mkdir(targetFolder)
+    fullFileNames = {}
+    awgFiles = {}
+    for awgName, data in awgData.items():
+        fullFileNames[awgName] = os.path.normpath(os.path.join(
+            CompileContexts.awg_dir(), fileName + '-' + awgName + suffix + data[
                 'seqFileExt']))
-        logger.info("Writing sequence file for: {}".format(awgName))
-        new_meta = data['translator'].write_sequence_file(data, fullFileName)
-        if new_meta:
-            awg_metas[awgName] = new_meta
-            ChannelLibraries.channelLib[awgName].extra_meta = new_meta
+        awgFiles[awgName] = [fullFileNames[awgName]]
+        if getattr(data['translator'], 'SAVE_WF_OFFSETS', False):
+            awgFiles[awgName].append(os.path.splitext(fullFileNames[awgName])[0] + '.offsets')
 
+    Profiler.step('write_sequence_files')
+    new_metas = dict(write_sequence_files(awgData, fullFileNames,
+                                          awg_workers, max_inflight_awgs))
+
+    # collect the results in a fixed order, independent of completion order
+    awg_metas = {}
+    awg_records = plan['reuse'] if plan else {}
+    for awgName, fullFileName in fullFileNames.items():
+        new_meta = new_metas[awgName]
         # Allow for per channel and per AWG seq files
         if awgName in label_to_inst:
-            if awgName in label_to_chan:
-                files[label_to_chan[awgName]] = fullFileName
+            files_key = label_to_chan.get(awgName)
         else:
-            files[awgName] = fullFileName
-
-        del data
-        del awgData[awgName]
-        gc.collect()
+            files_key = awgName
+        awg_records[awgName] = {'digest': plan['digests'][awgName] if plan else None,
+                                'files': awgFiles[awgName],
+                                'files_key': files_key,
+                                'meta': new_meta}
+
+    for awgName, record in awg_records.items():
+        if record['meta']:
+            awg_metas[awgName] = record['meta']
+            with CompileContexts.library_lock:
+                CompileContexts.channel_library()[awgName].extra_meta = record['meta']
+        if record['files_key']:
+            files[record['files_key']] = record['files'][0]
+    writtenFiles = [f for record in awg_records.values() for f in record['files']]
 
     # generate TDM sequences FIXME: what's the best way to identify the need for a TDM seq.? Support for single TDM
     if tdm_seq and 'APS2Pattern' in [wire.translator for wire in physWires]:
+            Profiler.step('tdm')
             aps2tdm_module = import_module('QGL.drivers.APS2Pattern') # this is redundant with above
             tdm_instr = aps2tdm_module.tdm_instructions(seqs)
             files['TDM'] = os.path.normpath(os.path.join(
-                config.AWGDir, fileName + '-' + 'TDM' + suffix + '.aps2'))
+                CompileContexts.awg_dir(), fileName + '-' + 'TDM' + suffix + '.aps2'))
             aps2tdm_module.write_tdm_seq(tdm_instr, files['TDM'])
+            writtenFiles.append(files['TDM'])
+
+    Profiler.step('write_meta')
+    metafilepath = write_meta_file(fileName, files, channels, len(seqs),
+                                   num_measurements, wire_measurements,
+                                   axis_descriptor, extra_meta, awg_metas)
+
+    if plan:
+        CompileCache.save_incremental_record(fileName, suffix, awg_records)
+    if cache_key:
+        Profiler.step('cache_store')
+        CompileCache.store(cache_key, metafilepath, writtenFiles, awg_metas)
+
+    # Return the filenames we wrote
+    return metafilepath
 
+@CompileContexts.with_context
+@_pulse_hash_scope
+def compile_to_hardware_streaming(seqs,
+                                  fileName,
+                                  chunk_size=None,
+                                  memory_budget=None,
+                                  channels=None,
+                                  library_version=None,
+                                  suffix='',
+                                  axis_descriptor=None,
+                                  add_slave_trigger=True,
+                                  extra_meta=None,
+                                  workers=None):
+    '''
+    Compiles an iterable of sequences (e.g. a generator) to the same hardware
+    description as compile_to_hardware, for experiments too long to hold in
+    memory at once. The sequences are taken chunk_size at a time, compiled and
+    appended to the sequence files by the SequenceFileWriter of each AWG's
+    translator, so that only one chunk of sequences, wires and waveforms is
+    in memory at a time.
+    Other inputs:
+        chunk_size (optional): number of sequences per chunk. Defaults to
+            config.stream_chunk_size.
+        memory_budget (optional): bytes of instructions and waveform data kept
+            in memory by the sequence file writers, beyond which they are
+            spilled to temporary files. Defaults to config.stream_memory_budget.
+        channels (optional): logical channels used by an iterator of sequences
+            in addition to those of the first chunk (with its triggers, gates
+            and subroutines). Using any other channel in a later chunk is an
+            error. The channels of a list of sequences are found up front.
+        workers (optional): number of processes used to compile the sequences
+            of each chunk.
+    The other inputs are as for compile_to_hardware. If the translator of any
+    AWG used (by the first chunk of an iterator) cannot write its sequence
+    file in chunks, all the sequences are compiled at once instead.
+    '''
+    CompileContexts.update_library()
+    clear_pulse_cache()
+    CompositeShapes.clear_cache()
+    chunk_size = chunk_size or config.stream_chunk_size
+    if memory_budget is None:
+        memory_budget = config.stream_memory_budget
+
+    seqs_iter = iter(seqs)
+    chunk = list(islice(seqs_iter, chunk_size))
+    if not chunk:
+        raise ValueError("No sequences to compile")
+
+    # check that every AWG can be written in chunks before compiling any
+    unstreamable = sorted(t.__name__.split('.')[-1] for t in _translators(
+        chunk if isinstance(seqs, Iterator) else seqs, channels, add_slave_trigger)
+        if not hasattr(t, 'SequenceFileWriter'))
+    if unstreamable:
+        warn("{} cannot compile in chunks; compiling all the sequences at once".format(
+             ', '.join(unstreamable)))
+        return compile_to_hardware(chunk + list(seqs_iter), fileName,
+                                   library_version=library_version, suffix=suffix,
+                                   axis_descriptor=axis_descriptor,
+                                   add_slave_trigger=add_slave_trigger,
+                                   extra_meta=extra_meta, workers=workers)
+    raw_chunks = chain([chunk], iter(lambda: list(islice(seqs_iter, chunk_size)), []))
+
+    # create the target folder if it does not exist
+    targetFolder = os.path.split(os.path.normpath(os.path.join(
+        CompileContexts.awg_dir(), fileName)))[0]
+    if not os.path.exists(targetFolder):
+        os.mkdir(targetFolder)
+    programWriters = open_program_writers(fileName + suffix)
+
+    writers = {}
+    fullFileNames = {}
+    label_to_inst = {}
+    label_to_chan = {}
+    shape_funLibs = {}
+    # the (closure or composite) shape functions seen so far: their ids key the
+    # waveforms across chunks, so they must not be freed and reused
+    shape_funs = {}
+    targets = []
+    subroutines = []
+    num_sequences = 0
+    num_measurements = 0
+    wire_measurements = {}
+    first_chunk = True
+    try:
+        Profiler.step('decorate')
+        chunks = _save_and_decorate(raw_chunks, programWriters, add_slave_trigger)
+        channels = set(channels or [])
+        if not isinstance(seqs, Iterator):
+            # the sequences are all in memory anyway: decorate them up front to
+            # find all the channels they use
+            chunks = list(chunks)
+            for seq in chain.from_iterable(chunks):
+                channels |= find_unique_channels(seq)
+            chunks = iter(chunks)
+        chunk = next(chunks)
+        while chunk:
+            CompileContexts.checkpoint()
+            Profiler.step('decorate')
+            next_chunk = next(chunks, None)
+
+            if first_chunk:
+                first_label = BlockLabel.label(chunk[0])
+            # collect the function definitions for the targets of Call instructions
+            for entry in flatten(chunk):
+                if isinstance(entry, ControlFlow.Call) and entry.target not in targets:
+                    targets.append(entry.target)
+                    subroutines.append(ControlFlow.qfunction_specialization(entry.target))
+            if first_chunk:
+                for seq in chunk:
+                    channels |= find_unique_channels(seq)
+                channels |= find_unique_channels(subroutines)
+            new_channels = find_unique_channels(chunk) | find_unique_channels(subroutines)
+            if not new_channels <= channels:
+                raise ValueError("Channels {} are not used in the first chunk; "
+                                 "pass all the channels with 'channels'".format(
+                                 sorted(c.label for c in new_channels - channels)))
+            if not next_chunk:
+                # turn into a loop, and append the subroutines
+                if not isinstance(chunk[-1][-1], ControlFlow.Goto):
+                    chunk[-1].append(ControlFlow.Goto(first_label))
+                chunk += subroutines
+            num_sequences += len(chunk)
+
+            logger.info("Compiling sequences.")
+            Profiler.step('compile_sequences')
+            Profiler.count(sequences=len(chunk))
+            wireSeqs = {chan: [] for chan in channels}
+            for wires in compile_unique_sequences(chunk, channels, workers):
+                for chan in wireSeqs.keys():
+                    wireSeqs[chan].append(wires[chan])
+            del chunk
+
+            if first_chunk and not validate_linklist_channels(wireSeqs.keys()):
+                print("Compile to hardware failed")
+                return
+
+            logger.info("Applying gating constraints")
+            Profiler.step('gating')
+            for chan, seq in wireSeqs.items():
+                if isinstance(chan, Channels.LogicalMarkerChannel):
+                    wireSeqs[chan] = PatternUtils.apply_gating_constraints(
+                        chan.phys_chan, seq)
+
+            Profiler.step('count_measurements')
+            num_measurements += count_measurements(wireSeqs)
+            for wire, n in count_measurements_per_wire(wireSeqs).items():
+                wire_measurements[wire] = wire_measurements.get(wire, 0) + n
+
+            Profiler.step('map_to_physical')
+            physWires = map_logical_to_physical(wireSeqs, shape_funLibs)
+            del wireSeqs
+            if Profiler.active:
+                Profiler.count(pulses=count_pulses(physWires))
+
+            for wire, pulses in physWires.items():
+                pattern_module = import_module('QGL.drivers.' + wire.translator)
+                if pattern_module.SEQFILE_PER_CHANNEL:
+                    if first_chunk:
+                        label_to_inst[wire.label] = wire.transmitter.label
+                    if any(isinstance(p, Pulse) and p.label != "Id" for ps in pulses for p in ps):
+                        label_to_chan[wire.label] = wire.label
+
+            Profiler.step('delays')
+            if first_chunk:
+                logger.info("Constructing delay map.")
+                delays = channel_delay_map(physWires)
+
+            for chan, wire in physWires.items():
+                PatternUtils.delay(wire, delays[chan])
+
+            Profiler.step('generate_waveforms')
+            wfs = generate_waveforms(physWires)
+            Profiler.count(unique_shapes=sum(len(shapes) for shapes in wfs.values()))
+            for wire in physWires.values():
+                for pulse in flatten(wire):
+                    if isinstance(pulse, Pulse):
+                        shape_fun = pulse.shapeParams.get('shape_fun')
+                        if (isinstance(shape_fun, CompositeShapes.CompositeShape) or
+                                '<' in getattr(shape_fun, '__qualname__', '')):
+                            shape_funs[id(shape_fun)] = shape_fun
+            Profiler.step('pulses_to_waveforms')
+            physWires = pulses_to_waveforms(physWires)
+            if Profiler.active:
+                Profiler.count(waveforms=count_pulses(physWires, Waveform))
+            Profiler.step('bundle')
+            awgData = bundle_wires(physWires, wfs)
+            del physWires, wfs
+            # keep to the memory budget: each chunk evaluates its shapes afresh
+            CompositeShapes.forget_shapes()
+
+            Profiler.step('write_sequence_files')
+            for awgName, data in awgData.items():
+                if awgName not in writers:
+                    fullFileNames[awgName] = os.path.normpath(os.path.join(
+                        CompileContexts.awg_dir(), fileName + '-' + awgName + suffix + data[
+                            'seqFileExt']))
+                    writers[awgName] = data['translator'].SequenceFileWriter(
+                        fullFileNames[awgName], memory_budget // len(awgData))
+                logger.info("Appending to sequence file for: {}".format(awgName))
+                with Profiler.stage(awgName):
+                    writers[awgName].write(data)
+            del awgData
+
+            first_chunk = False
+            chunk = next_chunk
+
+        print('Compiled {} sequences.'.format(num_sequences - len(subroutines)))
+
+        files = {}
+        awg_metas = {}
+        Profiler.step('close_sequence_files')
+        for awgName, writer in writers.items():
+            logger.info("Writing sequence file for: {}".format(awgName))
+            with Profiler.stage(awgName):
+                new_meta = writer.close()
+            if new_meta:
+                awg_metas[awgName] = new_meta
+                with CompileContexts.library_lock:
+                    CompileContexts.channel_library()[awgName].extra_meta = new_meta
+            # Allow for per channel and per AWG seq files
+            if awgName in label_to_inst:
+                if awgName in label_to_chan:
+                    files[label_to_chan[awgName]] = fullFileNames[awgName]
+            else:
+                files[awgName] = fullFileNames[awgName]
+
+        Profiler.step('write_meta')
+        return write_meta_file(fileName, files, channels, num_sequences,
+                               num_measurements, wire_measurements,
+                               axis_descriptor, extra_meta, awg_metas)
+    finally:
+        for writer in programWriters:
+            writer.close()
+
+def add_profile_to_meta(metafilepath, report):
+    '''
+    Saves a profile report (see Profiler) in the metafile of a compilation.
+    '''
+    with open(metafilepath, 'r') as FID:
+        meta = json.load(FID)
+    meta['profile'] = report
+    with open(metafilepath, 'w') as FID:
+        json.dump(meta, FID, indent=2, sort_keys=True)
+
+def _translators(seqs, channels=None, add_slave_trigger=True):
+    '''
+    The translator modules of the AWGs that the undecorated sequences seqs (and
+    the logical channels in channels) will use once decorated, with their
+    triggers, gates and slave trigger.
+    '''
+    channels = set(channels or [])
+    for seq in seqs:
+        channels |= find_unique_channels(seq)
+    for chan in list(channels):
+        for attr in ['trig_chan', 'gate_chan', 'parametric_chan']:
+            if getattr(chan, attr, None) is not None:
+                channels.add(getattr(chan, attr))
+    library = CompileContexts.channel_library()
+    if add_slave_trigger and 'slave_trig' in library:
+        channels.add(library['slave_trig'])
+    translators = set(getattr(getattr(chan, 'phys_chan', None), 'translator', None)
+                      for chan in channels)
+    return set(import_module('QGL.drivers.' + t) for t in translators if t)
+
+def _save_and_decorate(chunks, programWriters, add_slave_trigger=True):
+    '''
+    Saves each chunk of sequences with the open program writers, then
+    decorates it. An archive that fails is replaced by the text dump of the
+    sequences from that chunk on.
+    '''
+    num_sequences = 0
+    for chunk in chunks:
+        for ct, writer in enumerate(programWriters):
+            try:
+                writer.add(chunk)
+            except ProgramArchive.ProgramArchiveError as e:
+                writer.discard()
+                if any(isinstance(w, CodeWriter) for w in programWriters):
+                    warn("{}; the program is saved as text in -code.py only".format(e))
+                    programWriters[ct] = None
+                else:
+                    warn("{}; saving the sequences from number {} on as text in "
+                         "-code.py instead".format(e, num_sequences))
+                    fileName = writer.fileName[:-len('-program.qgl')] + '-code.py'
+                    programWriters[ct] = CodeWriter(fileName)
+                    programWriters[ct].add(chunk)
+        programWriters[:] = [w for w in programWriters if w is not None]
+        num_sequences += len(chunk)
+        decorate_sequences(chunk, add_slave_trigger)
+        yield chunk
+
+def write_meta_file(fileName, files, channels, num_sequences, num_measurements,
+                    wire_measurements, axis_descriptor=None, extra_meta=None,
+                    awg_metas=None):
+    '''
+    Writes the -meta.json describing a compiled experiment and returns its path.
+    '''
+    awg_metas = awg_metas or {}
     if extra_meta:
         extra_meta.update(awg_metas)
     else:
         extra_meta = awg_metas
     # create meta output
+    channelLib = CompileContexts.channel_library()
     db_info = {
-        'db_provider': ChannelLibraries.channelLib.db_provider,
-        'db_resource_name': ChannelLibraries.channelLib.db_resource_name,
+        'db_provider': channelLib.db_provider,
+        'db_resource_name': channelLib.db_resource_name,
         'library_name': 'working',
-        'library_id': ChannelLibraries.channelLib.channelDatabase.id
+        'library_id': channelLib.channelDatabase.id
     }
     if not axis_descriptor:
         axis_descriptor = [{
@@ -501,7 +997,7 @@ def compile_to_hardware(seqs,
     meta = {
         'database_info': db_info,
         'instruments': files,
-        'num_sequences': len(seqs),
+        'num_sequences': num_sequences,
         'num_measurements': num_measurements,
         'axis_descriptor': axis_descriptor,
         'qubits': [c.label for c in channels if isinstance(c, Channels.Qubit)],
@@ -511,23 +1007,118 @@ def compile_to_hardware(seqs,
     }
     if extra_meta:
         meta.update({'extra_meta': extra_meta})
-    metafilepath = os.path.join(config.AWGDir, fileName + '-meta.json')
+    metafilepath = os.path.join(CompileContexts.awg_dir(), fileName + '-meta.json')
     with open(metafilepath, 'w') as FID:
         json.dump(meta, FID, indent=2, sort_keys=True)
+    return metafilepath
 
-    # Restore the wire info
-    for wire in old_wire_names.keys():
-        wire.label = old_wire_names[wire]
-    for wire in old_wire_instrs.keys():
-        wire.instrument = old_wire_instrs[wire]
 
-    # Return the filenames we wrote
-    return metafilepath
+# state shared with the forked workers of compile_sequences_parallel and
+# write_sequence_files_parallel, by call (calls may overlap in threads)
+_parallel_state = {}
+_parallel_keys = count()
+
+def write_sequence_files(awgData, fullFileNames, workers=None, max_inflight=None):
+    '''
+    Runs the translator of each AWG in awgData on its data and writes it to
+    fullFileNames[awgName]. Yields (awgName, new_meta) as each AWG is finished,
+    dropping its data from awgData to bound the peak memory.
+    '''
+    if workers and workers > 1 and len(awgData) > 1:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            yield from write_sequence_files_parallel(awgData, fullFileNames,
+                                                     workers, max_inflight)
+            return
+        warn("Parallel sequence file writing requires the 'fork' start method; writing serially")
+
+    for awgName in list(awgData.keys()):
+        CompileContexts.checkpoint()
+        data = awgData[awgName]
+        logger.info("Writing sequence file for: {}".format(awgName))
+        with Profiler.stage(awgName):
+            new_meta = data['translator'].write_sequence_file(data, fullFileNames[awgName])
+        yield awgName, new_meta
 
+        del data
+        del awgData[awgName]
+        gc.collect()
 
-def compile_sequences(seqs, channels=set()):
+def _write_awg_sequence_file(key, awgName, fullFileName):
+    state = _parallel_state[key]
+    data = state['awgData'][awgName]
+    if state['profile']:
+        # profile the translator in the worker, and send the report back
+        with Profiler.profiling(awgName):
+            new_meta = data['translator'].write_sequence_file(data, fullFileName)
+        return new_meta, Profiler.last_report
+    return data['translator'].write_sequence_file(data, fullFileName), None
+
+def write_sequence_files_parallel(awgData, fullFileNames, workers, max_inflight=None):
+    '''
+    Parallel version of write_sequence_files using a pool of forked processes.
+    At most max_inflight AWGs (default: workers) are submitted at once.
+    '''
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+    max_inflight = max(1, max_inflight or workers)
+    pending = list(awgData.keys())
+    key = next(_parallel_keys)
+    _parallel_state[key] = {'awgData': awgData, 'profile': Profiler.active is not None}
+    try:
+        with ProcessPoolExecutor(min(workers, max_inflight),
+                mp_context=multiprocessing.get_context('fork')) as executor:
+            inflight = {}
+            while pending or inflight:
+                while pending and len(inflight) < max_inflight:
+                    awgName = pending.pop(0)
+                    logger.info("Writing sequence file for: {}".format(awgName))
+                    inflight[executor.submit(_write_awg_sequence_file, key, awgName,
+                                             fullFileNames[awgName])] = awgName
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    awgName = inflight.pop(future)
+                    new_meta, report = future.result()
+                    if report:
+                        Profiler.active.add_report(report)
+                    yield awgName, new_meta
+                    del awgData[awgName]
+                gc.collect()
+    finally:
+        del _parallel_state[key]
+
+def plan_incremental_compile(seqs, channels, **compile_args):
+    '''
+    Compares the inputs of each AWG with the previous incremental compilation
+    to the same file (see CompileCache.awg_fingerprints). Returns a dictionary with
+        digests: the fingerprint of each AWG
+        reuse: the records of the AWGs whose previous files can be reused
+        channels: the logical channels that need to be compiled
+    '''
+    # include the channels used in qfunctions, as compile_sequences would
+    channels |= find_unique_channels(collect_specializations(seqs))
+    digests, measuring = CompileCache.awg_fingerprints(seqs, channels, **compile_args)
+    previous = CompileCache.load_incremental_record(compile_args['fileName'],
+                                                    compile_args['suffix'])
+    reuse = {awgName: previous[awgName] for awgName, digest in digests.items()
+             if awgName in previous and previous[awgName]['digest'] == digest}
+    compile_channels = set(chan for chan in channels
+                           if CompileCache.awg_name(chan.phys_chan) not in reuse)
+    # edges pick up the frame changes of their target qubit
+    compile_channels |= set(chan.target for chan in compile_channels
+                            if isinstance(chan, Channels.Edge) and chan.target in channels)
+    # measurements are counted across all channels
+    compile_channels |= measuring
+    if not compile_channels:
+        # compile something to keep the program structure (GOTO, subroutines)
+        compile_channels = {min(channels, key=lambda chan: chan.label)}
+    logger.info("Rebuilding {}, reusing {}".format(
+        sorted(set(digests) - set(reuse)), sorted(reuse)))
+    return {'digests': digests, 'reuse': reuse, 'channels': compile_channels}
+
+def compile_sequences(seqs, channels=set(), workers=None):
     '''
     Main function to convert sequences to miniLL's and waveform libraries.
+    If workers > 1, the individual sequences are compiled in a pool of
+    forked processes and the resulting wires are merged back in order.
     '''
 
     # turn into a loop, by appending GOTO(0) at end of last sequence
@@ -544,12 +1135,10 @@ def compile_sequences(seqs, channels=set()):
         channels |= find_unique_channels(subroutines)
 
     # use seqs[0] as prototype in case we were not given a set of channels
-    wires = compile_sequence(seqs[0], channels)
     if not channels:
-        channels = set(wires.keys())
-    wireSeqs = {chan: [seq] for chan, seq in wires.items()}
-    for seq in seqs[1:]:
-        wires = compile_sequence(seq, channels)
+        channels = find_unique_channels(seqs[0])
+    wireSeqs = {chan: [] for chan in channels}
+    for wires in compile_unique_sequences(seqs, channels, workers):
         for chan in wireSeqs.keys():
             wireSeqs[chan].append(wires[chan])
     #Print a message so for the experiment we know how many sequences there are
@@ -560,11 +1149,174 @@ def compile_sequences(seqs, channels=set()):
 
     return wireSeqs
 
+def compile_unique_sequences(seqs, channels, workers=None):
+    '''
+    Compiles each distinct sequence in seqs once (see sequence_keys; with
+    config.dedup_sequences, otherwise every sequence) and yields the wires of
+    every sequence in order. Repeated sequences get a copy of the
+    wires, which the later passes modify in place, and are translated like
+    the others.
+    '''
+    if config.dedup_sequences:
+        keys = sequence_keys(seqs)
+    else:
+        keys = [None] * len(seqs)
+    first = {}
+    which = []
+    unique = []
+    for seq, key in zip(seqs, keys):
+        if key is None or key not in first:
+            if key is not None:
+                first[key] = len(unique)
+            which.append(len(unique))
+            unique.append(seq)
+        else:
+            which.append(first[key])
+    Profiler.count(unique_sequences=len(unique))
+
+    if workers and workers > 1 and len(unique) > 2:
+        compiled = list(compile_sequences_parallel(unique, channels, workers))
+    else:
+        compiled = [compile_sequence(seq, channels) for seq in unique]
+    done = [False] * len(unique)
+    for idx in which:
+        if done[idx]:
+            yield {chan: [entry if isinstance(entry, Pulse) else copy(entry)
+                          for entry in wire]
+                   for chan, wire in compiled[idx].items()}
+        else:
+            done[idx] = True
+            yield compiled[idx]
+
+def sequence_keys(seqs):
+    '''
+    Structural keys of the sequences: sequences with equal keys compile to
+    equal wires. The key of a sequence is None if some entry cannot be keyed.
+    '''
+    # each distinct entry gets a number, looked up by id first, so that the
+    # keys are cheap to hash
+    numbers = {}
+    by_id = {}
+
+    def freeze(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(freeze(v) for v in value)
+        if isinstance(value, (set, frozenset)):
+            return frozenset(freeze(v) for v in value)
+        hash(value)
+        return value
+
+    def entry_key(entry):
+        if isinstance(entry, Pulse):
+            return entry
+        if isinstance(entry, CompositePulse):
+            return ('composite', entry.label,
+                    tuple(number(p) for p in entry.pulses))
+        if isinstance(entry, PulseBlock):
+            return ('block', freeze({k: v for k, v in entry.__dict__.items() if k != 'pulses'}),
+                    tuple((chan, number(p)) for chan, p in entry.pulses.items()))
+        if isinstance(entry, (BlockLabel.BlockLabel, ControlFlow.ControlInstruction,
+                              TdmInstructions.WriteAddrInstruction,
+                              TdmInstructions.CustomInstruction,
+                              TdmInstructions.LoadCmpVramInstruction)):
+            return (type(entry), freeze(entry.__dict__))
+        raise TypeError("Cannot key {}".format(type(entry)))
+
+    def number(entry):
+        n = by_id.get(id(entry))
+        if n is None:
+            n = numbers.setdefault(entry_key(entry), len(numbers))
+            by_id[id(entry)] = n
+        return n
+
+    keys = []
+    for seq in seqs:
+        try:
+            keys.append(tuple(number(entry) for entry in flatten(seq)))
+        except TypeError:
+            # e.g. arrays in the shape parameters
+            keys.append(None)
+    return keys
+
+class _ChannelPickler(pickle.Pickler):
+    """Pickles channels by reference into the table of channels shared by the
+    parent and the forked workers, so that the parent gets back its own
+    channel objects."""
+    def __init__(self, FID, state):
+        super().__init__(FID, pickle.HIGHEST_PROTOCOL)
+        self.state = state
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Channels.Channel):
+            return self.state['channel_ids'].get(id(obj), obj.label)
+        return None
+
+class _ChannelUnpickler(pickle.Unpickler):
+    def __init__(self, FID, state):
+        super().__init__(FID)
+        self.state = state
+
+    def persistent_load(self, pid):
+        if isinstance(pid, int):
+            return self.state['channel_table'][pid]
+        return CompileContexts.channel_library()[pid]
+
+def _compile_sequence_chunk(args):
+    key, bounds = args
+    state = _parallel_state[key]
+    channels = state['channels']
+    wires = [compile_sequence(seq, channels) for seq in state['seqs'][slice(*bounds)]]
+    buf = io.BytesIO()
+    try:
+        _ChannelPickler(buf, state).dump(wires)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        # e.g. a lambda shape_fun; let the parent compile this chunk
+        return None
+    return buf.getvalue()
+
+def compile_sequences_parallel(seqs, channels, workers):
+    '''
+    Compiles each sequence in seqs with compile_sequence using a pool of
+    forked processes. Yields the wires for each sequence in order.
+    '''
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        warn("Parallel compilation requires the 'fork' start method; compiling serially")
+        for seq in seqs:
+            yield compile_sequence(seq, channels)
+        return
+
+    # a few chunks per worker to balance the load
+    chunksize = max(1, -(-len(seqs) // (4 * workers)))
+    bounds = [(start, min(start + chunksize, len(seqs)))
+              for start in range(0, len(seqs), chunksize)]
+    channel_table = list(channels)
+    key = next(_parallel_keys)
+    state = _parallel_state[key] = {
+        'seqs': seqs,
+        'channels': channels,
+        'channel_table': channel_table,
+        'channel_ids': {id(chan): ct for ct, chan in enumerate(channel_table)}
+    }
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            for (start, stop), data in zip(bounds,
+                    pool.imap(_compile_sequence_chunk, [(key, b) for b in bounds])):
+                if data is None:
+                    chunk = [compile_sequence(seq, channels) for seq in seqs[start:stop]]
+                else:
+                    chunk = _ChannelUnpickler(io.BytesIO(data), state).load()
+                yield from chunk
+    finally:
+        del _parallel_state[key]
+
 def compile_sequence(seq, channels=None):
     '''
     Takes a list of control flow and pulses, and returns aligned blocks
     separated into individual abstract channels (wires).
     '''
+    CompileContexts.checkpoint()
     logger.debug('')
     logger.debug("In compile_sequence:")
     #Find the set of logical channels used here and initialize them
@@ -573,6 +1325,55 @@ def compile_sequence(seq, channels=None):
         channels = find_unique_channels(seq)
 
     wires = {chan: [] for chan in channels}
+    # index in each wire of the last non-TA pulse (-1 if none) and of the first
+    # entry with a frame change, to push frame changes onto in constant time
+    last_pulse = {chan: -1 for chan in channels}
+    first_frame = {chan: None for chan in channels}
+    # edges into each node channel, looked up when first needed
+    in_edges = {}
+    # the blocks only hold the channels they use: the idle time of each channel
+    # is filled with Id's when the channel is next used, from the lengths of the
+    # blocks since idle_from[chan]
+    block_lengths = []
+    idle_from = {chan: 0 for chan in channels}
+    idle_pulses = {}
+    grids = {}
+
+    def idle(chan, length):
+        if (chan, length) not in idle_pulses:
+            idle_pulses[chan, length] = Id(chan, length)
+        return idle_pulses[chan, length]
+
+    def flush(chan):
+        start = idle_from[chan]
+        if start == len(block_lengths):
+            return
+        idle_from[chan] = len(block_lengths)
+        if config.merge_idle and chan not in grids:
+            grids[chan] = sample_grid(chan)
+        if config.merge_idle and isinstance(chan, Channels.LogicalMarkerChannel):
+            # the gating constraints add up the idle time of markers anyway
+            extend(chan, [idle(chan, sum(block_lengths[start:]))])
+        elif config.merge_idle and grids[chan] is not None:
+            # the translator rounds each block on its own: add up the samples
+            # of the blocks so that the merged Id lasts as long as the Id's
+            sampling_rate, quantum = grids[chan]
+            samples = 0
+            for length in block_lengths[start:]:
+                block_samples = int(round(length * sampling_rate))
+                samples += block_samples - block_samples % quantum
+            extend(chan, [idle(chan, samples / sampling_rate)])
+        else:
+            extend(chan, [idle(chan, length) for length in block_lengths[start:]])
+
+    def extend(chan, entries):
+        wire = wires[chan]
+        for entry in entries:
+            if hasattr(entry, 'isTimeAmp') and not entry.isTimeAmp:
+                last_pulse[chan] = len(wire)
+            if first_frame[chan] is None and hasattr(entry, 'frameChange'):
+                first_frame[chan] = len(wire)
+            wire.append(entry)
 
     # Debugging: what does the sequence look like?
     if logger.isEnabledFor(logging.DEBUG):
@@ -592,12 +1393,13 @@ def compile_sequence(seq, channels=None):
         else:
             for pulse in obj.pulses:
                 yield from flatten_to_pulses(pulse)
-    for block in normalize(flatten(seq), channels):
+    for block in normalize(flatten(seq), channels, sparse=True):
         logger.debug(" %s", block)
         # labels broadcast to all channels
         if isinstance(block, BlockLabel.BlockLabel):
             for chan in channels:
-                wires[chan] += [copy(block)]
+                flush(chan)
+                extend(chan, [copy(block)])
             continue
         # control flow broadcasts to all channels if channel attribute is None
         if (isinstance(block, ControlFlow.ControlInstruction) or
@@ -610,63 +1412,113 @@ def compile_sequence(seq, channels=None):
             # block_channels = block.channels if block.channels else channels
             block_channels = channels
             for chan in block_channels:
-                wires[chan] += [copy(block)]
+                flush(chan)
+                extend(chan, [copy(block)])
             continue
+        block_channels = [chan for chan in block.pulses if chan in wires]
         # propagate frame change from nodes to edges
-        for chan in channels:
+        for chan in block_channels:
             if block.pulses[chan].frameChange == 0:
                 continue
-            if chan in ChannelLibraries.channelLib.connectivityG.nodes():
+            if chan not in in_edges:
+                in_edges[chan] = incoming_edges(chan, wires)
+            if in_edges[chan]:
                 logger.debug("Doing propagate_node_frame_to_edges()")
                 wires = propagate_node_frame_to_edges(
-                    wires, chan, block.pulses[chan].frameChange)
+                    wires, chan, block.pulses[chan].frameChange,
+                    in_edges[chan], last_pulse)
         # drop length 0 blocks but push nonzero frame changes onto previous entries
         if block.length == 0:
-            for chan in channels:
+            for chan in block_channels:
                 if block.pulses[chan].frameChange == 0:
                     continue
+                flush(chan)
                 if len(wires[chan]) == 0:
                     warn("Dropping initial frame change")
                     continue
                 logger.debug("Modifying pulse on %s: %s", chan, wires[chan][-1])
-                # search for last non-TA entry
-                for ct in range(1,len(wires[chan])+1):
-                    if hasattr(wires[chan][-ct], 'isTimeAmp') and not wires[chan][-ct].isTimeAmp:
-                        updated_frameChange = wires[chan][-ct].frameChange + block.pulses[chan].frameChange
-                        wires[chan][-ct] = wires[chan][-ct]._replace(frameChange=updated_frameChange)
-                        break
+                # push onto the last non-TA entry
+                ct = last_pulse[chan]
+                if ct < 0:
                     # if no non-TA entry, add frame change at first available opportunity, from the start moving forward
-                    if ct == len(wires[chan]):
-                        for ct2 in range(len(wires[chan])):
-                            if hasattr(wires[chan][ct2], 'frameChange'):
-                                if hasattr(wires[chan][ct2], 'isTimeAmp') and  wires[chan][ct2].isTimeAmp:
-                                    updated_frameChange = wires[chan][ct2].frameChange + block.pulses[chan].frameChange
-                                    wires[chan][ct2] = wires[chan][ct2]._replace(frameChange=updated_frameChange)
-                                break # if the first pulse is not an Id left, it should have already been updated
+                    ct = first_frame[chan]
+                    # if the first pulse is not an Id left, it should have already been updated
+                    if ct is None or not (hasattr(wires[chan][ct], 'isTimeAmp') and wires[chan][ct].isTimeAmp):
+                        continue
+                updated_frameChange = wires[chan][ct].frameChange + block.pulses[chan].frameChange
+                wires[chan][ct] = wires[chan][ct]._replace(frameChange=updated_frameChange)
             continue
         # add the pulses per channel
-        for chan in channels:
-            wires[chan] += list(flatten_to_pulses(block.pulses[chan]))
+        for chan in block_channels:
+            flush(chan)
+            idle_from[chan] = len(block_lengths) + 1
+            extend(chan, flatten_to_pulses(block.pulses[chan]))
+        block_lengths.append(block.length)
+    for chan in channels:
+        flush(chan)
 
     debug_print(wires, 'compile_sequence() return')
 
     return wires
 
 
-def propagate_node_frame_to_edges(wires, chan, frameChange):
+def sample_grid(chan):
+    '''
+    The sampling rate and the quantum (in samples) of the lengths of the entries
+    of the logical channel chan, as rounded by its translator, or None if the
+    translator does not give them (see config.merge_idle).
     '''
-    Propagate frame change in node to relevant edges (for CR gates)
+    translator = getattr(getattr(chan, 'phys_chan', None), 'translator', None)
+    if not translator:
+        return None
+    try:
+        module = import_module('QGL.drivers.' + translator)
+    except ImportError:
+        return None
+    if not hasattr(module, 'sample_grid'):
+        return None
+    return module.sample_grid()
+
+
+def incoming_edges(chan, wires):
+    '''
+    The edges (CR gates) into the node chan that have a wire in wires.
+    '''
+    connectivityG = CompileContexts.channel_library().connectivityG
+    if chan not in connectivityG.nodes():
+        return []
+    edges = [connectivityG.edges[predecessor, chan]['channel']
+             for predecessor in connectivityG.predecessors(chan)]
+    return [edge for edge in edges if edge in wires]
+
+
+def last_pulse_index(wire):
     '''
-    for predecessor in ChannelLibraries.channelLib.connectivityG.predecessors(
-            chan):
-        edge = ChannelLibraries.channelLib.connectivityG.edges[predecessor, chan]['channel']
-        if edge in wires:
-            # search for last non-TA entry
-            for ct in range(1,len(wires[edge])):
-                if hasattr(wires[edge][-ct], 'isTimeAmp') and not wires[edge][-ct].isTimeAmp:
-                    updated_frameChange = wires[edge][-ct].frameChange + frameChange
-                    wires[edge][-ct] = wires[edge][-ct]._replace(frameChange=updated_frameChange)
-                    break
+    Index of the last non-TA entry of wire, or -1.
+    '''
+    for ct in range(len(wire) - 1, -1, -1):
+        if hasattr(wire[ct], 'isTimeAmp') and not wire[ct].isTimeAmp:
+            return ct
+    return -1
+
+
+def propagate_node_frame_to_edges(wires, chan, frameChange, edges=None, last_pulse=None):
+    '''
+    Propagate frame change in node to relevant edges (for CR gates). edges
+    (from incoming_edges) and the index of the last non-TA entry of each wire
+    (last_pulse) are looked up when not given.
+    '''
+    if edges is None:
+        edges = incoming_edges(chan, wires)
+    for edge in edges:
+        if last_pulse is not None:
+            ct = last_pulse[edge]
+        else:
+            ct = last_pulse_index(wires[edge])
+        # the first entry of an edge is never updated
+        if ct > 0:
+            updated_frameChange = wires[edge][ct].frameChange + frameChange
+            wires[edge][ct] = wires[edge][ct]._replace(frameChange=updated_frameChange)
     return wires
 
 
@@ -682,13 +1534,16 @@ def find_unique_channels(seq):
     return channels
 
 
-def normalize(seq, channels=None):
+def normalize(seq, channels=None, sparse=False):
     '''
     For mixed lists of Pulses and PulseBlocks, converts to list of PulseBlocks
-    with uniform channels on each PulseBlock. We inject Id's where necessary.
+    with uniform channels on each PulseBlock. We inject Id's where necessary,
+    unless sparse, in which case each PulseBlock keeps only its own channels.
     '''
     # promote to PulseBlocks
     seq = [p.promote(PulseBlock) for p in seq]
+    if sparse:
+        return seq
 
     if not channels:
         channels = find_unique_channels(seq)
@@ -777,7 +1632,7 @@ class Waveform(object):
 
 def validate_linklist_channels(linklistChannels):
     errors = []
-    channels = ChannelLibraries.channelLib.channelDict
+    channels = CompileContexts.channel_library().channelDict
     for channel in linklistChannels:
         if channel.label not in channels.keys(
         ) and channel.label not in errors:
@@ -843,18 +1698,73 @@ def debug_print(seqs, label):
                     logger.debug(" %s", elem)
 
 def save_code(seqs, filename):
-    from IPython.lib.pretty import pretty
-    import io  #needed for writing unicode to file in Python 2.7
+    '''
+    Saves the input program as selected by config.save_program, as text if it
+    cannot be archived.
+    '''
+    text = config.save_program in ['text', 'both']
+    if config.save_program in ['archive', 'both']:
+        try:
+            ProgramArchive.save_program(seqs, program_path(filename, '-program.qgl'))
+        except ProgramArchive.ProgramArchiveError as e:
+            warn("{}; saving the program as text in -code.py instead".format(e))
+            text = True
+    if text:
+        from IPython.lib.pretty import pretty
+        import io  #needed for writing unicode to file in Python 2.7
+        with io.open(program_path(filename, '-code.py'), "w", encoding="utf-8") as FID:
+            FID.write(u'seqs =\n')
+            FID.write(pretty(seqs))
+
+def program_path(filename, ending):
     # create the target folder if it does not exist
-    targetFolder = os.path.split(os.path.normpath(os.path.join(config.AWGDir,
+    targetFolder = os.path.split(os.path.normpath(os.path.join(CompileContexts.awg_dir(),
                                                                filename)))[0]
     if not os.path.exists(targetFolder):
         os.mkdir(targetFolder)
-    fullname = os.path.normpath(os.path.join(config.AWGDir, filename +
-                                             '-code.py'))
-    with io.open(fullname, "w", encoding="utf-8") as FID:
-        FID.write(u'seqs =\n')
-        FID.write(pretty(seqs))
+    return os.path.normpath(os.path.join(CompileContexts.awg_dir(), filename + ending))
+
+class CodeWriter(object):
+    '''
+    Writes the pretty-printed -code.py of a program a chunk at a time.
+    '''
+    def __init__(self, fullname):
+        import io
+        self.FID = io.open(fullname, "w", encoding="utf-8")
+        self.FID.write(u'seqs =\n[')
+        self.empty = True
+
+    def add(self, seqs):
+        from IPython.lib.pretty import pretty
+        for seq in seqs:
+            self.FID.write((u'' if self.empty else u',\n ') + pretty(seq))
+            self.empty = False
+
+    def close(self):
+        if not self.FID.closed:
+            self.FID.write(u']')
+            self.FID.close()
+
+def open_program_writers(filename):
+    '''
+    Opens the writers of the input program selected by config.save_program, to
+    save it a chunk at a time.
+    '''
+    writers = []
+    if config.save_program in ['archive', 'both']:
+        writers.append(ProgramArchive.ArchiveWriter(program_path(filename, '-program.qgl')))
+    if config.save_program in ['text', 'both']:
+        writers.append(CodeWriter(program_path(filename, '-code.py')))
+    return writers
+
+def count_pulses(wires, kind=Pulse):
+    '''
+    Counts the entries of the given kind (Pulses by default) on a set of wires.
+    '''
+    arrays = [wire for wire in wires.values() if isinstance(wire, WireArrays.WireArrays)]
+    wires = [wire for wire in wires.values() if not isinstance(wire, WireArrays.WireArrays)]
+    num = sum(wire.num_waveforms for wire in arrays) if kind is Waveform else 0
+    return num + sum(isinstance(entry, kind) for entry in flatten(wires))
 
 def count_measurements(wireSeqs):
     # count number of measurements per sequence as the max over the the number
@@ -0,0 +1,185 @@
+'''
+Shapes of the pulses the compiler builds out of other pulses.
+
+merge_channels sums the pulses played at the same time on the logical channels
+of a physical channel, and pull_uniform_entries concatenates the pulses of a
+channel to match the others. Their shape functions are SumShape and StackShape
+nodes of an expression graph whose leaves are the shapes of ordinary pulses.
+
+The nodes are numbered by value, and the shapes evaluated are kept by node for
+the rest of the compilation, so that the same sum or concatenation of the same
+shapes is assembled once, whatever sequence or channel it comes from, and each
+leaf shape is evaluated once. The nodes themselves compare by identity, like
+the closures they replace, so the waveform libraries are unchanged. Within a
+CompileContext, the numbering and the shapes are those of the context.
+
+Copyright 2020 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+from itertools import count
+
+import numpy as np
+
+from . import CompileContexts
+from . import WaveformCache
+
+# node numbers by value, and the shapes evaluated by (generation, node
+# number), for the current compilation
+_ids = {}
+_shapes = {}
+_generation = 0
+# each compilation gets its own number, so that the nodes numbered in one are
+# never mistaken for those of another
+_generations = count(1)
+
+
+def _state():
+    ctx = CompileContexts.current()
+    if ctx is None:
+        return _ids, _generation, _shapes
+    if ctx.composite_generation is None:
+        ctx.composite_generation = next(_generations)
+    return ctx.composite_ids, ctx.composite_generation, ctx.composite_shapes
+
+
+def clear_cache():
+    '''
+    Forgets the nodes and shapes of the previous compilation.
+    '''
+    global _generation
+    ctx = CompileContexts.current()
+    if ctx is None:
+        _ids.clear()
+        _shapes.clear()
+        _generation = next(_generations)
+    else:
+        ctx.composite_ids = {}
+        ctx.composite_shapes = {}
+        ctx.composite_generation = next(_generations)
+
+
+def forget_shapes():
+    '''
+    Drops the shapes evaluated so far but keeps the numbering of the nodes,
+    e.g. between the chunks of a streaming compilation.
+    '''
+    _state()[2].clear()
+
+
+def _intern(ids, key):
+    try:
+        return ids.setdefault(key, len(ids))
+    except TypeError:  # unhashable shape parameters: never shared
+        node_id = len(ids)
+        ids[('unique', node_id)] = node_id
+        return node_id
+
+
+def _term_id(ids, pulse):
+    shape_fun, params = pulse.shape_call()
+    if isinstance(shape_fun, CompositeShape):
+        return shape_fun.id
+    return _intern(ids, ('leaf', shape_fun, frozenset(params.items())))
+
+
+def _term_shape(pulse):
+    shape_fun, params = pulse.shape_call()
+    if isinstance(shape_fun, CompositeShape):
+        return shape_fun()
+    ids, generation, shapes = _state()
+    key = (generation, _term_id(ids, pulse))
+    shape = shapes.get(key)
+    if shape is None:
+        shape = WaveformCache.get_shapes(shape_fun, [params])[0]
+        shapes[key] = shape
+    return shape
+
+
+class CompositeShape(object):
+    '''
+    A shape function combining the shapes of pulses, each multiplied by a
+    complex coefficient: terms is a list of (coefficient, pulse). Like any
+    shape function it is called with the shape parameters of its pulse, which
+    it ignores.
+    '''
+    __slots__ = ['terms', '_id']
+    kind = None
+
+    def __init__(self, terms):
+        self.terms = terms
+        self._id = (None, None)
+
+    @property
+    def id(self):
+        ids, generation, _ = _state()
+        node_generation, node_id = self._id
+        if node_generation != generation:
+            node_id = _intern(ids, (self.kind,) + tuple((coef, _term_id(ids, pulse))
+                                                        for coef, pulse in self.terms))
+            self._id = (generation, node_id)
+        return node_id
+
+    def __call__(self, **kwargs):
+        _, generation, shapes = _state()
+        key = (generation, self.id)
+        shape = shapes.get(key)
+        if shape is None:
+            shape = self.combine([_term_shape(pulse) for _, pulse in self.terms])
+            shapes[key] = shape
+        return shape
+
+    def combine(self, shapes):
+        raise NotImplementedError
+
+
+class SumShape(CompositeShape):
+    '''
+    The sum of the terms (pulses played at the same time).
+    '''
+    __slots__ = []
+    kind = 'sum'
+
+    def combine(self, shapes):
+        # reduce(operator.add, [coef * shape ...]) with a single scratch buffer
+        out = self.terms[0][0] * shapes[0]
+        scratch = None
+        for (coef, _), shape in zip(self.terms[1:], shapes[1:]):
+            if shape.shape == out.shape and np.result_type(coef, shape) == out.dtype:
+                if scratch is None:
+                    scratch = np.empty_like(out)
+                np.multiply(coef, shape, out=scratch)
+                out += scratch
+            else:
+                out = out + coef * shape
+        return out
+
+
+class StackShape(CompositeShape):
+    '''
+    The concatenation of the terms (pulses played one after the other).
+    '''
+    __slots__ = []
+    kind = 'stack'
+
+    def combine(self, shapes):
+        # np.hstack([coef * shape ...]) written in place
+        dtype = np.result_type(*[np.result_type(coef, shape) for (coef, _), shape
+                                 in zip(self.terms, shapes)])
+        out = np.empty(sum(len(shape) for shape in shapes), dtype=dtype)
+        start = 0
+        for (coef, _), shape in zip(self.terms, shapes):
+            np.multiply(coef, shape, out=out[start:start + len(shape)])
+            start += len(shape)
+        return out
@@ -1,4 +1,5 @@
 from .BlockLabel import newlabel, label, endlabel
+from . import CompileContexts
 from .PulseSequencer import Pulse
 from functools import wraps
 from .mm import multimethod
@@ -34,16 +35,26 @@ def qdowhile(value, seq):
 qfunction_seq = {}
 
 
+def qfunction_table():
+    '''
+    The qfunction bodies of the current CompileContext (or qfunction_seq), by label.
+    '''
+    ctx = CompileContexts.current()
+    return qfunction_seq if ctx is None else ctx.qfunction_seq
+
+
 def qfunction(func):
     target = {}
 
     @wraps(func)
     def crfunc(*args, **kwargs):
-        if args not in target:
+        ctx = CompileContexts.current()
+        targets = target if ctx is None else ctx.qfunction_targets.setdefault(crfunc, {})
+        if args not in targets:
             seq = func(*args, **kwargs) + [Return()]
-            target[args] = label(seq)
-            qfunction_seq[label(seq)] = seq
-        return Call(target[args])
+            targets[args] = label(seq)
+            qfunction_table()[label(seq)] = seq
+        return Call(targets[args])
 
     return crfunc
 
@@ -54,8 +65,9 @@ def qfunction_specialization(target):
     # In those cases, there was no qfunction registering
     # a sequence that needs to be inserted; the pulses
     # are already in a sequence, so are not in this hash.
-    if target in qfunction_seq:
-        return qfunction_seq[target]
+    table = qfunction_table()
+    if target in table:
+        return table[target]
     else:
         # QGL2 case
         return list()
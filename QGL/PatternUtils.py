@@ -17,11 +17,13 @@ import numpy as np
 from warnings import warn
 from math import pi
 import hashlib, collections
+import tempfile
 import pickle
 from copy import copy
 from collections.abc import Iterable
 
-from .PulseSequencer import Pulse, TAPulse, PulseBlock, CompositePulse, CompoundGate, align
+from .PulseSequencer import (Pulse, TAPulse, PulseBlock, CompositePulse, CompoundGate, align,
+                             same_length)
 from .PulsePrimitives import BLANK, X
 from . import ControlFlow
 from . import BlockLabel
@@ -41,15 +43,22 @@ def delay(sequences, delay):
     '''
     if delay <= 0:  # no need to inject zero delays
         return
+    wait, sync = ControlFlow.Wait(), ControlFlow.Sync()
+    # one (immutable) delay pulse per channel
+    delays = {}
     for seq in sequences:
-        # loop through and look for WAIT instructions
-        # use while loop because len(seq) will change as we inject delays
-        ct = 0
-        while ct < len(seq) - 1:
-            if seq[ct] == ControlFlow.Wait() or seq[ct] == ControlFlow.Sync():
-                seq.insert(ct + 1, TAPulse("Id", seq[ct + 1].channel, delay,
-                                           0))
-            ct += 1
+        # rebuild the sequence with a delay after each WAIT or SYNC instruction
+        # (except at the end)
+        out = []
+        for ct, entry in enumerate(seq):
+            out.append(entry)
+            if (ct < len(seq) - 1 and isinstance(entry, ControlFlow.ControlInstruction)
+                    and (entry == wait or entry == sync)):
+                channel = seq[ct + 1].channel
+                if channel not in delays:
+                    delays[channel] = TAPulse("Id", channel, delay, 0)
+                out.append(delays[channel])
+        seq[:] = out
 
 
 def normalize_delays(delays):
@@ -84,23 +93,35 @@ def add_gate_pulses(seq):
     '''
 
     for ct in range(len(seq)):
-        if isinstance(seq[ct], CompoundGate):
-            add_gate_pulses(seq[ct].seq)
-        elif isinstance(seq[ct], PulseBlock):
-            pb = None
-            for chan, pulse in seq[ct].pulses.items():
-                if has_gate(chan) and not pulse.isZero and not (
-                        chan.gate_chan in seq[ct].pulses.keys()):
-                    if pb:
-                        pb *= BLANK(chan, pulse.length)
-                    else:
-                        pb = BLANK(chan, pulse.length)
+        seq[ct] = gate_entry(seq[ct])
+
+def gate_entry(entry):
+    '''
+    add gating pulses to the Qubit pulses of a single entry
+    '''
+    if isinstance(entry, CompoundGate):
+        add_gate_pulses(entry.seq)
+    elif isinstance(entry, PulseBlock):
+        pb = None
+        for pulse in gate_pulses(entry.pulses):
             if pb:
-                seq[ct] *= pb
-        elif hasattr(seq[ct], 'channel'):
-            chan = seq[ct].channel
-            if has_gate(chan) and not seq[ct].isZero:
-                seq[ct] *= BLANK(chan, seq[ct].length)
+                pb *= pulse
+            else:
+                pb = pulse
+        if pb:
+            entry *= pb
+    elif hasattr(entry, 'channel'):
+        chan = entry.channel
+        if has_gate(chan) and not entry.isZero:
+            entry *= BLANK(chan, entry.length)
+    return entry
+
+def gate_pulses(pulses):
+    '''
+    The gating pulses for a dictionary of channel: pulse
+    '''
+    return [BLANK(chan, pulse.length) for chan, pulse in pulses.items()
+            if has_gate(chan) and not pulse.isZero and not (chan.gate_chan in pulses.keys())]
 
 def add_parametric_pulses(seq):
     '''
@@ -108,23 +129,90 @@ def add_parametric_pulses(seq):
     '''
 
     for ct in range(len(seq)):
-        if isinstance(seq[ct], CompoundGate):
-            add_parametric_pulses(seq[ct].seq)
-        elif isinstance(seq[ct], PulseBlock):
-            pb = None
-            for chan, pulse in seq[ct].pulses.items():
-                if has_parametric(chan) and not pulse.isZero and not (
-                        chan.parametric_chan in seq[ct].pulses.keys()):
-                    if pb:
-                        pb *= X(chan.parametric_chan, length = pulse.length)
-                    else:
-                        pb = X(chan.parametric_chan, length = pulse.length)
+        seq[ct] = parametric_entry(seq[ct])
+
+def parametric_entry(entry):
+    '''
+    add parametric pulses to a single entry
+    '''
+    if isinstance(entry, CompoundGate):
+        add_parametric_pulses(entry.seq)
+    elif isinstance(entry, PulseBlock):
+        pb = None
+        for pulse in parametric_pulses(entry.pulses):
             if pb:
-                seq[ct] *= pb
-        elif hasattr(seq[ct], 'channel'):
-            chan = seq[ct].channel
-            if has_parametric(chan) and not seq[ct].isZero:
-                seq[ct] *= X(chan.parametric_chan, length = seq[ct].length)
+                pb *= pulse
+            else:
+                pb = pulse
+        if pb:
+            entry *= pb
+    elif hasattr(entry, 'channel'):
+        chan = entry.channel
+        if has_parametric(chan) and not entry.isZero:
+            entry *= X(chan.parametric_chan, length = entry.length)
+    return entry
+
+def parametric_pulses(pulses):
+    '''
+    The parametric pulses for a dictionary of channel: pulse
+    '''
+    return [X(chan.parametric_chan, length = pulse.length) for chan, pulse in pulses.items()
+            if has_parametric(chan) and not pulse.isZero and
+            not (chan.parametric_chan in pulses.keys())]
+
+def _uniform_length(length, pulses):
+    # the length of block * pulses[0] * pulses[1] ... for a block of the given
+    # length, or None unless the product is a plain union of the pulses (no
+    # alignment nor repeated channels)
+    pb_length = None
+    for pulse in pulses:
+        if pb_length is None:
+            pb_length = pulse.length
+        elif not same_length(pb_length, pulse.length):
+            return None
+        else:
+            pb_length = max(pb_length, pulse.length)
+    if len(set(pulse.channel for pulse in pulses)) < len(pulses) or not same_length(length, pb_length):
+        return None
+    return max(length, pb_length)
+
+def decorate_entry(entry):
+    '''
+    parametric_entry followed by gate_entry, building the resulting PulseBlock
+    once when the extra pulses line up with the entry
+    '''
+    if isinstance(entry, CompoundGate):
+        for ct in range(len(entry.seq)):
+            entry.seq[ct] = decorate_entry(entry.seq[ct])
+        return entry
+    if isinstance(entry, PulseBlock):
+        pulses = entry.pulses
+    elif isinstance(entry, (Pulse, CompositePulse)):
+        pulses = {entry.channel: entry}
+    else:
+        return gate_entry(parametric_entry(entry))
+    extra = parametric_pulses(pulses)
+    length = _uniform_length(entry.length, extra) if extra else entry.length
+    if length is not None:
+        pulses = collections.OrderedDict(pulses)
+        pulses.update((pulse.channel, pulse) for pulse in extra)
+        gates = gate_pulses(pulses)
+        if gates:
+            length = _uniform_length(length, gates)
+            extra += gates
+    if length is None:
+        return gate_entry(parametric_entry(entry))
+    if not extra:
+        return entry
+    if isinstance(entry, PulseBlock):
+        result = copy(entry)
+        result.pulses = copy(entry.pulses)
+    else:
+        result = entry.promote(PulseBlock)
+    for pulse in extra:
+        result.pulses[pulse.channel] = pulse
+    result.length = length
+    return result
 
 def has_gate(channel):
     return hasattr(channel, 'gate_chan') and channel.gate_chan
@@ -141,6 +229,16 @@ def update_pulse_length(pulse, new_length):
     return pulse._replace(shapeParams=new_params, length=new_length)
 
 def apply_gating_constraints(chan, linkList):
+    '''
+    Gating for the marker wire linkList: globs together the adjacent entries
+    that are both zero or both non-zero, expands the non-zero entries by
+    gate_buffer (and contracts the following ones), then fills the gaps
+    shorter than gate_min_width between two non-zero entries.
+
+    The entries of all the sequences are handled at once as run-length arrays
+    of (isZero, length); Pulses are only rebuilt at the end, for the entries
+    whose length changed.
+    '''
     # get channel parameters in samples
     if not hasattr(chan, 'gate_buffer'):
         raise AttributeError("{0} does not have gate_buffer".format(chan.label))
@@ -153,64 +251,78 @@ def apply_gating_constraints(chan, linkList):
     gate_buffer = chan.gate_buffer
     gate_min_width = chan.gate_min_width
 
-    #Initialize list of sequences to return
-    gateSeqs = []
-
-    for miniLL in linkList:
-        gateSeq = []
-        # first pass consolidates entries
-        previousEntry = None
-        for ct,entry in enumerate(miniLL):
-            if isinstance(entry,
-                    (ControlFlow.ControlInstruction, BlockLabel.BlockLabel,
-                        TdmInstructions.CustomInstruction,
-                        TdmInstructions.WriteAddrInstruction,
-                        TdmInstructions.LoadCmpVramInstruction)):
-
-                if previousEntry:
-                    gateSeq.append(previousEntry)
-                    previousEntry = None
-                gateSeq.append(entry)
-                continue
-
-            if previousEntry is None:
-                previousEntry = entry
-                continue
-
-            # matching entry types can be globbed together
-            if previousEntry.isZero == entry.isZero:
-                previousEntry = update_pulse_length(previousEntry, previousEntry.length + entry.length)
-            else:
-                gateSeq.append(previousEntry)
-                previousEntry = entry
-
-        # push on the last entry if necessary
-        if previousEntry:
-            gateSeq.append(previousEntry)
-
-        # second pass expands non-zeros by gate_buffer
-        for ct in range(len(gateSeq)):
-            if isNonZeroWaveform(gateSeq[ct]):
-                gateSeq[ct] = update_pulse_length(gateSeq[ct], gateSeq[ct].length + gate_buffer)
-
-                # contract the next pulse by the same amount
-                if ct + 1 < len(gateSeq) - 1 and isinstance(gateSeq[ct + 1], Pulse):
-                    gateSeq[ct+1] = update_pulse_length(gateSeq[ct+1], gateSeq[ct+1].length - gate_buffer)
-
-        # third pass ensures gate_min_width
-        ct = 0
-        while ct + 2 < len(gateSeq):
-            # look for pulse, delay, pulse pattern and ensure delay is long enough
-            if [isNonZeroWaveform(x) for x in gateSeq[ct:ct+3]] == [True, False, True] and \
-                gateSeq[ct+1].length < gate_min_width and \
-                [isinstance(x, Pulse) for x in gateSeq[ct:ct+3]] == [True, True, True]:
-                gateSeq[ct] = update_pulse_length(gateSeq[ct], gateSeq[ct + 1].length + gateSeq[ct + 2].length)
-                del gateSeq[ct + 1:ct + 3]
-            else:
-                ct += 1
-        gateSeqs.append(gateSeq)
-
-    return gateSeqs
+    entries = [entry for miniLL in linkList for entry in miniLL]
+    seq_starts = np.cumsum([0] + [len(miniLL) for miniLL in linkList])
+    if not entries:
+        return [[] for _ in linkList]
+    control = np.fromiter((isinstance(entry, (ControlFlow.ControlInstruction, BlockLabel.BlockLabel,
+                                              TdmInstructions.CustomInstruction,
+                                              TdmInstructions.WriteAddrInstruction,
+                                              TdmInstructions.LoadCmpVramInstruction))
+                           for entry in entries), np.bool_, len(entries))
+    isZero = np.array([not c and bool(entry.isZero) for entry, c in zip(entries, control)])
+
+    # first pass consolidates entries: a run of matching entry types starts
+    # at the first entry of a sequence, after control flow or on a change of type
+    start = ~control
+    start[1:] &= control[:-1] | (isZero[1:] != isZero[:-1])
+    firsts = seq_starts[:-1][seq_starts[:-1] < len(entries)]
+    start[firsts] = ~control[firsts]
+    pulses = np.flatnonzero(~control)
+    runs = np.flatnonzero(start[pulses])
+    # the lengths as Python numbers, so that the sums are those of the entries
+    lengths = np.empty(len(pulses), dtype=object)
+    lengths[:] = [entries[ct].length for ct in pulses.tolist()]
+
+    rows = np.flatnonzero(control | start)
+    length = np.zeros(len(rows), dtype=object)
+    isRun = start[rows]
+    length[isRun] = np.add.reduceat(lengths, runs) if len(runs) else []
+    changed = np.zeros(len(rows), dtype=np.bool_)
+    changed[isRun] = np.diff(np.append(runs, len(pulses))) > 1
+    isPulse = np.fromiter((isinstance(entries[ct], Pulse) for ct in rows.tolist()),
+                          np.bool_, len(rows))
+    nonZero = isPulse & ~isZero[rows]
+    # start and end (exclusive) of the sequence of each row
+    gate_starts = np.searchsorted(rows, seq_starts)
+    seq_of = np.searchsorted(gate_starts, np.arange(len(rows)), side='right') - 1
+    seq_end = gate_starts[seq_of + 1]
+
+    # second pass expands non-zeros by gate_buffer
+    expand = np.flatnonzero(nonZero)
+    length[expand] += gate_buffer
+    # contract the next pulse by the same amount (unless it is the last entry)
+    contract = expand + 1
+    contract = contract[contract < seq_end[expand] - 1]
+    contract = contract[isPulse[contract]]
+    length[contract] -= gate_buffer
+    changed[expand] = True
+    changed[contract] = True
+    assert all(length[changed] >= 0)
+
+    # third pass ensures gate_min_width: a pulse, delay, pulse pattern with a
+    # short delay becomes a single pulse, possibly over several such patterns
+    link = np.zeros(len(rows), dtype=np.bool_)
+    if len(rows) > 2:
+        link[:-2] = (nonZero[:-2] & isPulse[1:-1] & ~nonZero[1:-1] & nonZero[2:] &
+                     (length[1:-1] < gate_min_width).astype(np.bool_) &
+                     (np.arange(len(rows) - 2) + 2 < seq_end[:-2]))
+    links = np.flatnonzero(link)
+    keep = np.ones(len(rows), dtype=np.bool_)
+    if len(links):
+        first = np.ones(len(links), dtype=np.bool_)
+        first[1:] = links[1:] != links[:-1] + 2
+        last = np.append(first[1:], True)
+        # the pulse takes the length of the last delay and pulse it absorbs
+        length[links[first]] = length[links[last] + 1] + length[links[last] + 2]
+        changed[links[first]] = True
+        keep[links + 1] = False
+        keep[links + 2] = False
+
+    gated = [update_pulse_length(entries[row], length[ct]) if changed[ct] else entries[row]
+             for ct, row in enumerate(rows.tolist()) if keep[ct]]
+    bounds = np.append(0, np.cumsum(keep))[gate_starts].tolist()
+    return [gated[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
 
 
 def isNonZeroWaveform(entry):
@@ -224,16 +336,24 @@ def add_digitizer_trigger(seqs):
     # Attach a trigger to any pulse block containing a measurement. Each trigger is specific to each measurement
     for seq in seqs:
         for ct in range(len(seq)):
-            if not contains_measurement(seq[ct]):
-                continue
-            #find corresponding digitizer trigger
-            chanlist = list(flatten([seq[ct].channel]))
-            for chan in chanlist:
-                if hasattr(chan, 'trig_chan') and chan.trig_chan is not None:
-                    trig_chan = chan.trig_chan
-                    if not (hasattr(seq[ct], 'pulses') and
-                            trig_chan in seq[ct].pulses.keys()):
-                        seq[ct] = align('left', seq[ct], TAPulse("TRIG", trig_chan, trig_chan.pulse_params['length'], 1.0, 0.0, 0.0))
+            seq[ct] = trigger_entry(seq[ct])
+
+
+def trigger_entry(entry):
+    '''
+    Add the digitizer triggers to a single entry.
+    '''
+    if not contains_measurement(entry):
+        return entry
+    #find corresponding digitizer trigger
+    chanlist = list(flatten([entry.channel]))
+    for chan in chanlist:
+        if hasattr(chan, 'trig_chan') and chan.trig_chan is not None:
+            trig_chan = chan.trig_chan
+            if not (hasattr(entry, 'pulses') and
+                    trig_chan in entry.pulses.keys()):
+                entry = align('left', entry, TAPulse("TRIG", trig_chan, trig_chan.pulse_params['length'], 1.0, 0.0, 0.0))
+    return entry
 
 
 def contains_measurement(entry):
@@ -269,6 +389,32 @@ def add_slave_trigger(seqs, slaveChan):
                 ct += 1
 
 
+def decorate(seqs, slaveChan=None):
+    '''
+    add_digitizer_trigger, add_parametric_pulses, add_gate_pulses and (with a
+    slaveChan) add_slave_trigger in a single pass over each sequence.
+    '''
+    for seq in seqs:
+        out = []
+        trigger = False
+        for ct, entry in enumerate(seq):
+            entry = decorate_entry(trigger_entry(entry))
+            if trigger:
+                # the entry following a WAIT, as in add_slave_trigger
+                trigger = False
+                try:
+                    out.append(align('left', entry, TAPulse("TRIG", slaveChan, slaveChan.pulse_params['length'], 1.0, 0.0, 0.0)))
+                    continue
+                except:
+                    out.append(TAPulse("TRIG", slaveChan,
+                                       slaveChan.pulse_params['length'],
+                                       1.0, 0.0, 0.0))
+            if slaveChan is not None and isinstance(entry, ControlFlow.Wait) and ct < len(seq) - 1:
+                trigger = True
+            out.append(entry)
+        seq[:] = out
+
+
 def propagate_frame_changes(seq, wf_type):
     '''
     Propagates all frame changes through sequence
@@ -320,6 +466,66 @@ def flatten(l):
             yield el
 
 
+class SpillBuffer(object):
+    '''
+    Append-only array of the given dtype for the output of long streaming
+    compilations. Once more than budget bytes are held in memory, the contents
+    are moved to an anonymous temporary file in directory dir.
+    '''
+    def __init__(self, dtype, budget=None, dir=None):
+        self.dtype = np.dtype(dtype)
+        self.budget = budget
+        self.dir = dir
+        self.chunks = []
+        self.tail = []
+        self.nbytes = 0
+        self.size = 0
+        self.file = None
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        data = np.asarray(data, dtype=self.dtype)
+        self.tail.append(data)
+        self.nbytes += data.nbytes
+        self.size += data.size
+        # coalesce small appends to keep the per-array overhead down
+        if len(self.tail) >= 1024:
+            self.chunks.append(np.concatenate(self.tail))
+            self.tail = []
+        if self.budget is not None and self.nbytes > self.budget:
+            self.spill()
+
+    def spill(self):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.dir)
+        for chunk in self.chunks + self.tail:
+            self.file.write(chunk.tobytes())
+        self.chunks = []
+        self.tail = []
+        self.nbytes = 0
+
+    def array(self):
+        '''
+        Returns the contents, memory-mapped from the file if they were spilled.
+        '''
+        if self.file is None:
+            if not self.chunks and not self.tail:
+                return np.zeros(0, dtype=self.dtype)
+            return np.concatenate(self.chunks + self.tail)
+        self.spill()
+        self.file.flush()
+        return np.memmap(self.file, dtype=self.dtype, mode='r', shape=(self.size,))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.chunks = []
+        self.tail = []
+
+
 def update_wf_library(pulses, path):
     """
     Update the waveform library in-place.
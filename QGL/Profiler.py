@@ -0,0 +1,252 @@
+'''
+Per-stage timing and memory profile of compile_to_hardware.
+
+While a profile is active (see profiling()), the compiler and the translators
+mark their stages with stage() and step(), and report item counts with count().
+Each stage records its wall and CPU time, the growth of the peak RSS of the
+process and, with tracemalloc, the net and peak Python allocations. Stages
+with the same name at the same level (e.g. the chunks of a streaming compile)
+are merged, with their number of calls.
+
+The report is a nested dictionary ready to be dumped to JSON:
+
+    {'name': 'compile_to_hardware', 'calls': 1, 'wall': 1.2, 'cpu': 1.1,
+     'peak_rss': ..., 'rss_delta': ..., 'traced_delta': ..., 'traced_peak': ...,
+     'counts': {...}, 'stages': {'compile_sequences': {...}, ...}}
+
+Copyright 2020 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from . import config
+
+# the profile being recorded, if any
+active = None
+# the report of the last profiled compilation
+last_report = None
+
+
+def peak_rss():
+    '''
+    Peak resident set size of the process in bytes, or None if unknown.
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return rss if sys.platform == 'darwin' else 1024 * rss
+
+
+def new_record(name):
+    return {'name': name, 'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+            'peak_rss': None, 'rss_delta': None, 'traced_delta': None,
+            'traced_peak': None, 'counts': {}, 'stages': {}}
+
+
+def merge_record(record, other):
+    '''
+    Accumulates the stage record other (e.g. another chunk of the same stage)
+    into record.
+    '''
+    record['calls'] += other['calls']
+    for key in ['wall', 'cpu', 'rss_delta', 'traced_delta']:
+        if other[key] is not None:
+            record[key] = (record[key] or 0) + other[key]
+    for key in ['peak_rss', 'traced_peak']:
+        if other[key] is not None:
+            record[key] = max(record[key] or 0, other[key])
+    for key, value in other['counts'].items():
+        record['counts'][key] = record['counts'].get(key, 0) + value
+    for name, stage in other['stages'].items():
+        merge_record(record['stages'].setdefault(name, new_record(name)), stage)
+
+
+class Frame(object):
+    '''
+    An open stage: its record and the measurements at its start.
+    '''
+    def __init__(self, record, is_step=False):
+        self.record = record
+        self.is_step = is_step
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.rss = peak_rss()
+        self.traced = None
+        self.peak = None
+
+
+class CompileProfile(object):
+    '''
+    Records the stages of one compilation as a tree of stage records.
+    '''
+    def __init__(self, name='compile_to_hardware', trace_memory=False):
+        self.trace_memory = trace_memory and tracemalloc.is_tracing()
+        self.root = new_record(name)
+        self.frames = []
+        self.open(self.root)
+
+    def open(self, record, is_step=False):
+        frame = Frame(record, is_step)
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.frames:
+                self.frames[-1].peak = max(self.frames[-1].peak, peak)
+            # measure the peak of this stage alone (Python >= 3.9)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            frame.traced = frame.peak = current
+        self.frames.append(frame)
+
+    def close(self):
+        frame = self.frames.pop()
+        record = frame.record
+        record['calls'] += 1
+        record['wall'] += time.perf_counter() - frame.wall
+        record['cpu'] += time.process_time() - frame.cpu
+        rss = peak_rss()
+        if rss is not None:
+            record['peak_rss'] = max(record['peak_rss'] or 0, rss)
+            record['rss_delta'] = (record['rss_delta'] or 0) + rss - frame.rss
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            frame.peak = max(frame.peak, peak)
+            record['traced_delta'] = (record['traced_delta'] or 0) + current - frame.traced
+            record['traced_peak'] = max(record['traced_peak'] or 0, frame.peak - frame.traced)
+            if self.frames:
+                self.frames[-1].peak = max(self.frames[-1].peak, frame.peak)
+
+    def child(self, name):
+        stages = self.frames[-1].record['stages']
+        if name not in stages:
+            stages[name] = new_record(name)
+        return stages[name]
+
+    def close_step(self):
+        if self.frames[-1].is_step:
+            self.close()
+
+    @contextmanager
+    def stage(self, name):
+        self.open(self.child(name))
+        depth = len(self.frames)
+        try:
+            yield
+        finally:
+            # close the steps of this stage, then the stage itself
+            while len(self.frames) >= depth:
+                self.close()
+
+    def step(self, name):
+        self.close_step()
+        self.open(self.child(name), is_step=True)
+
+    def count(self, **counts):
+        record = self.frames[-1].record
+        for key, value in counts.items():
+            record['counts'][key] = record['counts'].get(key, 0) + int(value)
+
+    def add_report(self, report):
+        '''
+        Adds the report of a stage profiled elsewhere (e.g. in a worker process)
+        as a stage of the current one.
+        '''
+        merge_record(self.child(report['name']), report)
+
+    def finish(self):
+        while self.frames:
+            self.close()
+        return self.root
+
+
+@contextmanager
+def profiling(name='compile_to_hardware', trace_memory=None):
+    '''
+    Profiles the enclosed code, yielding the CompileProfile. The report is also
+    kept in last_report. trace_memory (default config.profile_trace_memory)
+    traces the Python allocations with tracemalloc, at some cost in speed.
+    '''
+    global active, last_report
+    if trace_memory is None:
+        trace_memory = config.profile_trace_memory
+    started = trace_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    profile = CompileProfile(name, trace_memory)
+    previous, active = active, profile
+    try:
+        yield profile
+    finally:
+        active = previous
+        last_report = profile.finish()
+        if started:
+            tracemalloc.stop()
+
+
+@contextmanager
+def stage(name):
+    '''
+    Records the enclosed code as a stage of the active profile, if any.
+    '''
+    if active is None:
+        yield
+    else:
+        with active.stage(name):
+            yield
+
+
+def step(name):
+    '''
+    Ends the previous step at the current level of the active profile, if any,
+    and starts the next one. The last step ends with the enclosing stage.
+    '''
+    if active is not None:
+        active.step(name)
+
+
+def count(**counts):
+    '''
+    Adds item counts (e.g. pulses=10) to the current stage of the active profile.
+    '''
+    if active is not None:
+        active.count(**counts)
+
+
+def format_report(report, indent=0):
+    '''
+    Formats a report as a table of stages, one per line.
+    '''
+    def size(value):
+        return '' if value is None else '{:.1f}'.format(value / 2**20)
+    lines = []
+    if indent == 0:
+        lines.append('{:<40} {:>6} {:>10} {:>10} {:>10} {:>10}  {}'.format(
+            'stage', 'calls', 'wall (s)', 'cpu (s)', 'rss+ (MB)', 'alloc (MB)', 'counts'))
+    counts = ', '.join('{}={}'.format(k, v) for k, v in report['counts'].items())
+    lines.append('{:<40} {:>6} {:>10.4f} {:>10.4f} {:>10} {:>10}  {}'.format(
+        ' ' * indent + report['name'], report['calls'], report['wall'],
+        report['cpu'], size(report['rss_delta']), size(report['traced_peak']),
+        counts))
+    for stage in report['stages'].values():
+        lines.append(format_report(stage, indent + 2))
+    return '\n'.join(lines)
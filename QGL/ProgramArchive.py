@@ -0,0 +1,474 @@
+'''
+Compact binary archive of the input program of compile_to_hardware.
+
+The archive interns the channels and pulses of the program: each distinct
+Pulse is stored once, as a row of a structured array of its parameters, and
+each sequence as an array of tokens referring to the pulses, the groups of
+pulses (composite pulses, pulse blocks and compound gates) and the pickled
+control-flow instructions. The bodies of the qfunctions called are stored as
+extra sequences. Reading an archive is lazy: the file is memory-mapped, the
+sequences are built one at a time on access and the pulse table can be
+inspected without building any Pulse at all.
+
+Shape functions are saved by reference, like any pickled function: lambdas and
+closures cannot be, and ArchiveWriter raises ProgramArchiveError for them.
+
+File layout (version 1): MAGIC, uint32 version, the tokens of the sequences,
+the tables, a JSON header describing them, and the uint64 offset of the header
+followed by MAGIC again.
+
+Copyright 2020 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import io
+import os
+import mmap
+import json
+import struct
+import pickle
+
+import numpy as np
+
+from . import Channels
+from . import CompileContexts
+from . import ControlFlow
+from .PulseSequencer import Pulse, CompositePulse, PulseBlock, CompoundGate
+
+MAGIC = b'QGLPROG\x00'
+VERSION = 1
+
+PULSE_DTYPE = np.dtype([('label', np.int32), ('channel', np.int32),
+                        ('length', np.float64), ('amp', np.float64),
+                        ('phase', np.float64), ('frequency', np.float64),
+                        ('frameChange', np.float64), ('isTimeAmp', np.bool_),
+                        ('isZero', np.bool_), ('maddr', np.int64, 2),
+                        ('maddr_pair', np.bool_), ('moffset', np.int64),
+                        ('shapeParams', np.int32),
+                        ('ignoredStrParams', np.int32)])
+
+
+# the kinds of entries of a sequence, in the low bits of its tokens
+PULSE, COMPOSITE, BLOCK, GATE, OBJECT = range(5)
+KIND_BITS = 3
+
+GROUP_DTYPE = np.dtype([('label', np.int32), ('alignment', np.int32),
+                        ('length', np.float64), ('start', np.int64),
+                        ('stop', np.int64)])
+
+
+class ProgramArchiveError(Exception):
+    pass
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file, writer):
+        super(_Pickler, self).__init__(file, protocol=4)
+        self.writer = writer
+
+    def persistent_id(self, obj):
+        return self.writer.persistent_id(obj)
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, archive):
+        super(_Unpickler, self).__init__(file)
+        self.archive = archive
+
+    def persistent_load(self, pid):
+        return self.archive.persistent_load(pid)
+
+
+class ArchiveWriter(object):
+    '''
+    Writes an archive of the sequences passed to add(), in order.
+
+    Each sequence is stored as an array of tokens, one per entry: the index of
+    the entry in its table shifted by KIND_BITS, with its kind in the low bits.
+    Pulses, composite pulses, pulse blocks and compound gates (the groups,
+    whose items are tokens too) are interned by value; other entries (e.g.
+    control-flow instructions) are pickled and interned by their pickles.
+    '''
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.FID = open(fileName, 'wb')
+        self.FID.write(MAGIC)
+        self.FID.write(struct.pack('<I', VERSION))
+        self.seq_offsets = [0]
+        self.pulses = []
+        # entries are looked up by id first, and kept alive so their ids stay
+        # unique, then by value
+        self.ids = {}
+        self.interned = []
+        self.pulse_values = {}
+        self.channels = {}
+        self.strings = {}
+        self.params = {}
+        self.param_values = {}
+        self.ignored = {}
+        self.groups = {}
+        self.items = []
+        self.objects = {}
+        self.targets = []
+
+    def persistent_id(self, obj):
+        if type(obj) is Pulse:
+            return ('p', self.pulse_index(obj))
+        if isinstance(obj, Channels.Channel):
+            return ('c', self.intern(self.channels, obj.label))
+        if callable(obj) and '<' in getattr(obj, '__qualname__', ''):
+            raise ProgramArchiveError("{} cannot be archived: lambdas and closures "
+                                      "are not saved".format(obj.__qualname__))
+        return None
+
+    def intern(self, table, key):
+        if key not in table:
+            table[key] = len(table)
+        return table[key]
+
+    def string(self, value):
+        return -1 if value is None else self.intern(self.strings, value)
+
+    def pulse_index(self, pulse):
+        try:
+            idx = self.pulse_values.get(pulse)
+            hashable = True
+        except TypeError:
+            # e.g. arrays in the shape parameters
+            idx = None
+            hashable = False
+        if idx is None:
+            idx = len(self.pulses)
+            pair = isinstance(pulse.maddr, tuple)
+            self.pulses.append((self.intern(self.strings, pulse.label),
+                                self.intern(self.channels, pulse.channel.label),
+                                pulse.length, pulse.amp, pulse.phase,
+                                pulse.frequency, pulse.frameChange,
+                                pulse.isTimeAmp, pulse.isZero,
+                                # a measurement address is -1 or (address, bit)
+                                pulse.maddr if pair else (pulse.maddr, 0), pair,
+                                pulse.moffset,
+                                self.params_index(pulse.shapeParams),
+                                self.intern(self.ignored, tuple(pulse.ignoredStrParams))))
+            if hashable:
+                self.pulse_values[pulse] = idx
+        return idx
+
+    def params_index(self, params):
+        try:
+            key = frozenset(params.items())
+            if key in self.param_values:
+                return self.param_values[key]
+        except TypeError:
+            key = None
+        idx = self.intern(self.params, self.dumps(params))
+        if key is not None:
+            self.param_values[key] = idx
+        return idx
+
+    def group_index(self, label, alignment, length, entries):
+        key = (label, alignment, length, tuple(self.token(e) for e in entries))
+        if key not in self.groups:
+            self.groups[key] = len(self.groups)
+            self.items.extend(key[3])
+        return self.groups[key]
+
+    def token(self, entry):
+        token = self.ids.get(id(entry))
+        if token is not None:
+            return token
+        kind = type(entry)
+        if kind is Pulse:
+            token = self.pulse_index(entry) << KIND_BITS | PULSE
+        elif kind is CompositePulse:
+            token = self.group_index(self.string(entry.label), -1, 0.0,
+                                     entry.pulses) << KIND_BITS | COMPOSITE
+        elif (kind is PulseBlock and entry.__dict__.keys() == {'alignment', 'pulses', 'length', 'label'}
+              and all(k is v.channel for k, v in entry.pulses.items())):
+            token = self.group_index(self.string(entry.label), self.string(entry.alignment),
+                                     entry.length, entry.pulses.values()) << KIND_BITS | BLOCK
+        elif kind is CompoundGate and entry.__dict__.keys() == {'seq', 'label'}:
+            token = self.group_index(self.string(entry.label), -1, 0.0,
+                                     entry.seq) << KIND_BITS | GATE
+        else:
+            token = self.intern(self.objects, self.dumps(entry)) << KIND_BITS | OBJECT
+        self.ids[id(entry)] = token
+        self.interned.append(entry)
+        return token
+
+    def dumps(self, obj):
+        buf = io.BytesIO()
+        try:
+            _Pickler(buf, self).dump(obj)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise ProgramArchiveError("{!r} cannot be archived: {}".format(obj, e)) from e
+        return buf.getvalue()
+
+    def write_tokens(self, seq):
+        tokens = np.array([self.token(entry) for entry in seq], dtype=np.int64)
+        self.FID.write(tokens.tobytes())
+        self.seq_offsets.append(self.seq_offsets[-1] + len(tokens))
+        for entry in seq:
+            if isinstance(entry, ControlFlow.Call) and entry.target not in self.targets:
+                self.targets.append(entry.target)
+
+    def add(self, seqs):
+        for seq in seqs:
+            self.write_tokens(seq)
+
+    def write_section(self, sections, name, data):
+        # align the sections for memory-mapping
+        self.FID.write(b'\0' * (-self.FID.tell() % 8))
+        sections[name] = [self.FID.tell(), len(data)]
+        self.FID.write(data.tobytes() if isinstance(data, np.ndarray) else data)
+
+    def close(self):
+        try:
+            num_sequences = len(self.seq_offsets) - 1
+            # append the bodies of the qfunctions called, which may call others
+            functions = []
+            for target in self.targets:
+                if target in ControlFlow.qfunction_table():
+                    functions.append(self.token(target))
+                    self.write_tokens(ControlFlow.qfunction_table()[target])
+            sections = {'sequences': [len(MAGIC) + 4, self.seq_offsets[-1]]}
+            self.write_section(sections, 'seq_offsets',
+                               np.array(self.seq_offsets, dtype=np.int64))
+            # the shape parameters may add objects
+            params = list(self.params.keys())
+            self.write_section(sections, 'param_offsets',
+                               np.cumsum([0] + [len(p) for p in params], dtype=np.int64))
+            self.write_section(sections, 'params', b''.join(params))
+            objects = list(self.objects.keys())
+            self.write_section(sections, 'object_offsets',
+                               np.cumsum([0] + [len(o) for o in objects], dtype=np.int64))
+            self.write_section(sections, 'objects', b''.join(objects))
+            self.write_section(sections, 'pulses', np.array(self.pulses, dtype=PULSE_DTYPE))
+            stops = np.cumsum([len(key[3]) for key in self.groups], dtype=np.int64)
+            self.write_section(sections, 'groups', np.array(
+                [key[:3] + (stop - len(key[3]), stop) for key, stop in zip(self.groups, stops)],
+                dtype=GROUP_DTYPE))
+            self.write_section(sections, 'items', np.array(self.items, dtype=np.int64))
+
+            header = {'version': VERSION,
+                      'num_sequences': num_sequences,
+                      'functions': functions,
+                      'channels': list(self.channels.keys()),
+                      'strings': list(self.strings.keys()),
+                      'ignored': [list(i) for i in self.ignored.keys()],
+                      'sections': sections}
+            offset = self.FID.tell()
+            self.FID.write(json.dumps(header).encode('utf-8'))
+            self.FID.write(struct.pack('<Q', offset))
+            self.FID.write(MAGIC)
+        finally:
+            self.FID.close()
+
+    def discard(self):
+        '''
+        Closes and deletes the unfinished archive, e.g. after a
+        ProgramArchiveError.
+        '''
+        self.FID.close()
+        if os.path.exists(self.fileName):
+            os.remove(self.fileName)
+
+
+class ProgramArchive(object):
+    '''
+    Lazily loaded program archive. archive[i] (or a slice) builds only the
+    sequences asked for; archive.pulses is the memory-mapped pulse table, with
+    the labels in archive.strings and the channel labels in archive.channels.
+
+    The channels are looked up by label in channelLib (default: the current
+    channel library) when the pulses are built. The file stays mapped until
+    close(), or the end of a with block.
+    '''
+    def __init__(self, fileName, channelLib=None):
+        self.fileName = fileName
+        self.channelLib = channelLib
+        with open(fileName, 'rb') as FID:
+            if FID.read(len(MAGIC)) != MAGIC:
+                raise IOError("{} is not a QGL program archive".format(fileName))
+            version, = struct.unpack('<I', FID.read(4))
+            if version > VERSION:
+                raise IOError("Unsupported program archive version {}".format(version))
+            FID.seek(-len(MAGIC) - 8, os.SEEK_END)
+            offset, = struct.unpack('<Q', FID.read(8))
+            end = FID.tell() - 8
+            FID.seek(offset)
+            header = json.loads(FID.read(end - offset).decode('utf-8'))
+            self._map = mmap.mmap(FID.fileno(), 0, access=mmap.ACCESS_READ)
+        self.version = header['version']
+        self.channels = header['channels']
+        self.strings = header['strings']
+        self.ignored = header['ignored']
+        self.sections = header['sections']
+        self.num_sequences = header['num_sequences']
+        self._functions = header['functions']
+        self._sections = {}
+        self._groups = {}
+        self._pulses = {}
+        self._channels = {}
+        self._params = {}
+
+    def close(self):
+        '''
+        Unmaps the file. The arrays of the sections (e.g. archive.pulses) must
+        no longer be in use.
+        '''
+        self._sections.clear()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def section(self, name, dtype=np.uint8):
+        if name not in self._sections:
+            offset, length = self.sections[name]
+            self._sections[name] = np.frombuffer(self._map, dtype=dtype,
+                                                 count=length, offset=offset)
+        return self._sections[name]
+
+    @property
+    def pulses(self):
+        return self.section('pulses', PULSE_DTYPE)
+
+    def loads(self, name, idx):
+        offsets = self.section(name[:-1] + '_offsets', np.int64)
+        data = self.section(name)[offsets[idx]:offsets[idx + 1]].tobytes()
+        return _Unpickler(io.BytesIO(data), self).load()
+
+    def persistent_load(self, pid):
+        kind, idx = pid
+        if kind == 'p':
+            return self.pulse(idx)
+        if kind == 'c':
+            return self.channel(idx)
+        return idx
+
+    def channel(self, idx):
+        if idx not in self._channels:
+            channelLib = self.channelLib or CompileContexts.channel_library()
+            if channelLib is None:
+                raise KeyError("No channel library to look up {}".format(self.channels[idx]))
+            self._channels[idx] = channelLib[self.channels[idx]]
+        return self._channels[idx]
+
+    def string(self, idx):
+        return None if idx < 0 else self.strings[idx]
+
+    def pulse(self, idx):
+        '''
+        Builds Pulse idx of the pulse table.
+        '''
+        if idx not in self._pulses:
+            row = self.pulses[idx]
+            if row['shapeParams'] not in self._params:
+                self._params[row['shapeParams']] = self.loads('params', row['shapeParams'])
+            self._pulses[idx] = Pulse._make((
+                self.strings[row['label']], self.channel(int(row['channel'])),
+                float(row['length']), float(row['amp']), float(row['phase']),
+                float(row['frequency']), float(row['frameChange']),
+                dict(self._params[row['shapeParams']]), bool(row['isTimeAmp']),
+                bool(row['isZero']), list(self.ignored[row['ignoredStrParams']]),
+                tuple(int(a) for a in row['maddr']) if row['maddr_pair'] else int(row['maddr'][0]),
+                int(row['moffset'])))
+        return self._pulses[idx]
+
+    def entry(self, token):
+        idx, kind = token >> KIND_BITS, token & ((1 << KIND_BITS) - 1)
+        if kind == PULSE:
+            return self._pulses[idx] if idx in self._pulses else self.pulse(idx)
+        if kind == OBJECT:
+            return self.loads('objects', idx)
+        if idx not in self._groups:
+            row = self.section('groups', GROUP_DTYPE)[idx]
+            self._groups[idx] = (self.string(row['label']), self.string(row['alignment']),
+                                 float(row['length']),
+                                 self.section('items', np.int64)[row['start']:row['stop']].tolist())
+        label, alignment, length, tokens = self._groups[idx]
+        entries = [self.entry(token) for token in tokens]
+        if kind == COMPOSITE:
+            return CompositePulse(label, entries)
+        if kind == GATE:
+            return CompoundGate(entries, label)
+        block = PulseBlock(*entries)
+        block.alignment = alignment
+        block.length = length
+        block.label = label
+        return block
+
+    def sequence(self, idx):
+        offsets = self.section('seq_offsets', np.int64)
+        tokens = self.section('sequences', np.int64)[offsets[idx]:offsets[idx + 1]]
+        return [self.entry(token) for token in tokens.tolist()]
+
+    def __len__(self):
+        return self.num_sequences
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[ct] for ct in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("sequence index out of range")
+        return self.sequence(idx)
+
+    def __iter__(self):
+        for ct in range(len(self)):
+            yield self.sequence(ct)
+
+    @property
+    def functions(self):
+        '''
+        The bodies of the qfunctions called by the program, by target label.
+        '''
+        return {self.entry(token): self.sequence(self.num_sequences + ct)
+                for ct, token in enumerate(self._functions)}
+
+    def load(self, register_functions=True):
+        '''
+        Returns all the sequences. With register_functions, the qfunction bodies
+        are registered again so that the program can be recompiled.
+        '''
+        if register_functions:
+            ControlFlow.qfunction_table().update(self.functions)
+        return list(self)
+
+
+def save_program(seqs, fileName):
+    '''
+    Writes an archive of the sequences seqs to fileName.
+    '''
+    writer = ArchiveWriter(fileName)
+    try:
+        writer.add(seqs)
+    except ProgramArchiveError:
+        writer.discard()
+        raise
+    writer.close()
+
+
+def load_program(fileName, channelLib=None):
+    '''
+    Reads back the sequences archived in fileName, and registers the bodies of
+    the qfunctions they call.
+    '''
+    with ProgramArchive(fileName, channelLib) as archive:
+        return archive.load()
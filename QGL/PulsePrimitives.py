@@ -16,11 +16,13 @@ limitations under the License.
 from . import PulseShapes
 from . import Channels
 from . import ChannelLibraries
+from . import CompileContexts
 from . import config
 import operator
 
 from math import pi, sin, cos, acos, sqrt
 import numpy as np
+from . import PulseSequencer
 from .PulseSequencer import Pulse, TAPulse, CompoundGate, align
 from functools import wraps, reduce
 
@@ -43,15 +45,22 @@ def _memoize(pulseFunc):
     def cacheWrap(*args, **kwargs):
         if kwargs:
             return pulseFunc(*args, **kwargs)
+        ctx = CompileContexts.current()
+        cache = _memoize.cache if ctx is None else ctx.pulse_cache
         key = (pulseFunc, args)
-        if key not in _memoize.cache:
-            _memoize.cache[key] = pulseFunc(*args)
-        return _memoize.cache[key]
+        if key not in cache:
+            cache[key] = pulseFunc(*args)
+        return cache[key]
 
     return cacheWrap
 
 def clear_pulse_cache():
-    _memoize.cache = {}
+    PulseSequencer.clear_hash_cache()
+    ctx = CompileContexts.current()
+    if ctx is None:
+        _memoize.cache = {}
+    else:
+        ctx.pulse_cache = {}
 
 @_memoize
 def Id(channel, *args, **kwargs):
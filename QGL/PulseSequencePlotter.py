@@ -41,6 +41,9 @@ def build_awg_translator_map():
     translators = [_[1] for _ in pkgutil.walk_packages(drivers.__path__)]
     for translator in translators:
         module = import_module('QGL.drivers.' + translator)
+        if not hasattr(module, 'get_seq_file_extension'):
+            # shared by several translators
+            continue
         ext = module.get_seq_file_extension()
         if ext in translators_map:
             translators_map[ext].append(module)
@@ -27,13 +27,52 @@ from functools import reduce
 from builtins import str
 
 from . import PulseShapes
+from . import CompileContexts
 
 from collections import namedtuple
 
+def same_length(a, b):
+    '''
+    np.isclose(a, b, atol=1e-10) for two lengths (in seconds), without the
+    overhead of NumPy on scalars.
+    '''
+    return abs(a - b) <= 1e-10 + 1e-5 * abs(b)
+
+
+# the shape fingerprint and the hash of the pulses hashed lately, as
+# [pulse, hashshape, hash] by id of the pulse: a Pulse is a tuple, which cannot
+# have slots of its own. The entries keep their pulse alive so that its id is
+# not reused while it is cached. The table is that of the current
+# CompileContext, if any, and is emptied when it gets to HASH_CACHE_SIZE
+# entries and at the start and end of each compilation.
+_hash_cache = {}
+HASH_CACHE_SIZE = 2**16
+
+def _hash_table():
+    ctx = CompileContexts.current()
+    return _hash_cache if ctx is None else ctx.pulse_hashes
+
+def _hash_entry(pulse):
+    table = _hash_table()
+    entry = table.get(id(pulse))
+    if entry is None or entry[0] is not pulse:
+        if len(table) >= HASH_CACHE_SIZE:
+            table.clear()
+        entry = [pulse, hash(frozenset(pulse.shapeParams.items())), None]
+        table[id(pulse)] = entry
+    return entry
+
+def clear_hash_cache():
+    _hash_table().clear()
+
+
 class Pulse(namedtuple("Pulse", ["label", "channel", "length", "amp", "phase", "frequency",
                                  "frameChange", "shapeParams", "isTimeAmp",
                                  "isZero", "ignoredStrParams",
                                  "maddr", "moffset"])):
+    # the shape fingerprint and the hash are computed on first use and kept in
+    # _hash_cache. A pulse is immutable (its shapeParams are copied, never
+    # modified in place) so they never go stale.
     __slots__ = ()
 
     def __new__(cls, label, channel, shapeParams, amp=1.0, phase=0, frameChange=0, ignoredStrParams=[], maddr=-1, moffset=0, frequency=None):
@@ -85,13 +124,21 @@ class Pulse(namedtuple("Pulse", ["label", "channel", "length", "amp", "phase", "
         p.text(str(self))
 
     def hashshape(self):
-        return hash(frozenset(self.shapeParams.items()))
+        return _hash_entry(self)[1]
 
     def __hash__(self):
-        d = self._asdict()
-        d['shapeParams'] = self.hashshape()
-        del d['ignoredStrParams']
-        return hash(frozenset(d.items()))
+        entry = _hash_entry(self)
+        if entry[2] is None:
+            d = self._asdict()
+            d['shapeParams'] = entry[1]
+            del d['ignoredStrParams']
+            entry[2] = hash(frozenset(d.items()))
+        return entry[2]
+
+    def __reduce__(self):
+        # rebuild from the stored fields rather than going back through __new__,
+        # whose signature does not match the namedtuple field order
+        return (self._make, (tuple(self),))
 
     def __add__(self, other):
         if self.channel != other.channel:
@@ -106,7 +153,7 @@ class Pulse(namedtuple("Pulse", ["label", "channel", "length", "amp", "phase", "
 
     def __mul__(self, other):
         """ Overload multiplication of Pulses as a "tensor" operator"""
-        if not np.isclose(self.length, other.length, atol=1e-10):
+        if not same_length(self.length, other.length):
             if self.length == 0 or other.length == 0:
                 return align('left', self, other)
             else:
@@ -120,13 +167,20 @@ class Pulse(namedtuple("Pulse", ["label", "channel", "length", "amp", "phase", "
 
     @property
     def shape(self):
+        shape_fun, params = self.shape_call()
+        return shape_fun(**params)
+
+    def shape_call(self):
+        '''
+        Returns the shape function of the pulse and its keyword arguments.
+        '''
         params = copy(self.shapeParams)
         params['sampling_rate'] = self.channel.phys_chan.sampling_rate
         params.pop('shape_fun')
         if isinstance(self.shapeParams['shape_fun'],str):
-            return getattr(PulseShapes, self.shapeParams['shape_fun'])(**params)
+            return getattr(PulseShapes, self.shapeParams['shape_fun']), params
         else:
-            return self.shapeParams['shape_fun'](**params)
+            return self.shapeParams['shape_fun'], params
 
 
 def TAPulse(label,
@@ -174,7 +228,7 @@ class CompositePulse(namedtuple("CompositePulse", ["label", "pulses"])):
             return CompositePulse("", self.pulses + [other])
 
     def __mul__(self, other):
-        if not np.isclose(self.length, other.length, atol=1e-10):
+        if not same_length(self.length, other.length):
             if self.length == 0 or other.length == 0:
                 return align('left', self, other)
             else:
@@ -240,7 +294,7 @@ class PulseBlock(object):
             return rhs * self
         # otherwise, we are promoting to a PulseBlock
         rhs = rhs.promote(ptype)
-        if not np.isclose(self.length, rhs.length, atol=1e-10):
+        if not same_length(self.length, rhs.length):
             return align('center', self, rhs)
         # copy PulseBlock so we don't modify other references
         result = copy(self)
@@ -309,14 +363,31 @@ def align(mode="center", *pulses):
         # no padding element required
         return reduce(operator.mul, pulses)
     elif mode == 'left':
-        return reduce(operator.mul,[p + TAPulse('Id', p.channel, max(pulse_lengths) - p.length,0) if p.length < max(pulse_lengths) else p for p in pulse_list])
+        return product([p + TAPulse('Id', p.channel, max(pulse_lengths) - p.length,0) if p.length < max(pulse_lengths) else p for p in pulse_list])
     elif mode == 'right':
-        return reduce(operator.mul,[TAPulse('Id', p.channel, max(pulse_lengths) - p.length,0) + p if p.length < max(pulse_lengths) else p for p in pulse_list])
+        return product([TAPulse('Id', p.channel, max(pulse_lengths) - p.length,0) + p if p.length < max(pulse_lengths) else p for p in pulse_list])
     elif mode == 'center':
-        return reduce(operator.mul,[TAPulse('Id', p.channel, (max(pulse_lengths) - p.length)/2,0) + p + TAPulse('Id', p.channel, (max(pulse_lengths) - p.length)/2,0) if p.length < max(pulse_lengths) else p for p in pulse_list])
+        return product([TAPulse('Id', p.channel, (max(pulse_lengths) - p.length)/2,0) + p + TAPulse('Id', p.channel, (max(pulse_lengths) - p.length)/2,0) if p.length < max(pulse_lengths) else p for p in pulse_list])
     else:
         logger.error('Pulse alignment type must be one of left, right, or center.')
 
+def product(pulses):
+    '''
+    reduce(operator.mul, pulses), building the PulseBlock once rather than
+    one copy per pulse when the pulses are on distinct channels and of the
+    same length (so that no further alignment is needed).
+    '''
+    if len(pulses) > 1 and all(isinstance(p, (Pulse, CompositePulse)) for p in pulses) and \
+            len(set(p.channel for p in pulses)) == len(pulses):
+        length = pulses[0].length
+        for p in pulses[1:]:
+            if not same_length(length, p.length):
+                break
+            length = max(length, p.length)
+        else:
+            return PulseBlock(*pulses)
+    return reduce(operator.mul, pulses)
+
 class CompoundGate(object):
     '''
     A wrapper around a python list to allow us to define '*' on lists.
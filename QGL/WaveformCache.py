@@ -0,0 +1,217 @@
+'''
+Cache of the waveform shapes evaluated by generate_waveforms.
+
+A shape depends only on its shape function and parameters (including the
+sampling rate), so the shapes computed for one channel or one compilation can
+be reused by every other. The cache has two tiers:
+
+* in memory, the most recently used shapes up to config.waveform_cache_size
+  bytes, keyed by the shape function and the parameters themselves;
+* optionally on disk (config.waveform_cache_disk), one .npy file per shape
+  under config.AWGDir/.qgl_waveforms, named after a digest of the source of
+  the shape function and the parameters, and memory-mapped when loaded.
+
+The cached shapes are shared and therefore read-only. The cache is shared by
+all threads (and CompileContexts) and guarded by a lock.
+
+Copyright 2020 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import config
+from . import CompileContexts
+from . import PulseShapes
+from .CompileCache import Uncacheable, _canonical
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = '.qgl_waveforms'
+
+stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'uncacheable': 0}
+
+# (shape function, parameters) -> shape, least recently used first
+_memory = OrderedDict()
+_memory_size = 0
+_lock = threading.RLock()
+
+
+def cache_dir():
+    return os.path.join(CompileContexts.awg_dir(), CACHE_DIR)
+
+
+def cache_stats():
+    '''
+    Returns the hit/miss/eviction counts for this session together with the
+    number of shapes and their total size (in bytes) in memory.
+    '''
+    return dict(stats, entries=len(_memory), size=_memory_size)
+
+
+def clear_cache(disk=True):
+    '''
+    Empties the memory tier and, with disk, removes the shapes on disk.
+    '''
+    global _memory_size
+    with _lock:
+        _memory.clear()
+        _memory_size = 0
+    if disk and os.path.exists(cache_dir()):
+        shutil.rmtree(cache_dir())
+
+
+def reset_stats():
+    for key in stats:
+        stats[key] = 0
+
+
+def shape_fingerprint(shape_fun, params):
+    '''
+    Digest of a shape that is stable across sessions: the source of the shape
+    function and the parameters. Raises Uncacheable for closures and lambdas.
+    '''
+    key = '{}({})'.format(_canonical(shape_fun, {}),
+                          _canonical(sorted(params.items()), {}))
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _memory_key(shape_fun, params):
+    try:
+        key = (shape_fun, frozenset(params.items()))
+        hash(key)
+    except TypeError:  # e.g. an array parameter
+        return None
+    return key
+
+
+def _remember(key, shape):
+    global _memory_size
+    if key is None or shape.nbytes > config.waveform_cache_size:
+        return
+    with _lock:
+        if key in _memory:
+            _memory_size -= _memory[key].nbytes
+        _memory[key] = shape
+        _memory_size += shape.nbytes
+        while _memory_size > config.waveform_cache_size:
+            _, old = _memory.popitem(last=False)
+            _memory_size -= old.nbytes
+            stats['evictions'] += 1
+
+
+def _disk_path(shape_fun, params):
+    try:
+        return os.path.join(cache_dir(), shape_fingerprint(shape_fun, params) + '.npy')
+    except Uncacheable:
+        return None
+
+
+def _load(path):
+    try:
+        return np.asarray(np.load(path, mmap_mode='r'))
+    except (OSError, ValueError):
+        logger.warning("Ignoring unreadable waveform cache file %s", path)
+        return None
+
+
+def _save(path, shape):
+    os.makedirs(cache_dir(), exist_ok=True)
+    # write to a temporary file first so that readers never see a partial file
+    fd, tmpName = tempfile.mkstemp(dir=cache_dir(), suffix='.npy')
+    with os.fdopen(fd, 'wb') as FID:
+        np.save(FID, shape)
+    os.replace(tmpName, path)
+
+
+def recall(key):
+    '''
+    Returns the shape kept in memory under key by remember(), or None.
+    '''
+    if not config.waveform_cache_enabled:
+        return None
+    with _lock:
+        if key not in _memory:
+            return None
+        _memory.move_to_end(key)
+        stats['hits'] += 1
+        return _memory[key]
+
+
+def remember(key, shape):
+    '''
+    Keeps in memory a shape computed outside of get_shapes (e.g. a composite
+    shape, see CompositeShapes), under a key of the caller's choosing.
+    '''
+    if config.waveform_cache_enabled:
+        shape.flags.writeable = False
+        stats['misses'] += 1
+        _remember(key, shape)
+
+
+def get_shapes(shape_fun, params):
+    '''
+    Returns [shape_fun(**p) for p in params], taking the shapes from the cache
+    where possible and evaluating the others together with
+    PulseShapes.batch_shapes.
+    '''
+    if not config.waveform_cache_enabled:
+        return PulseShapes.batch_shapes(shape_fun, params)
+
+    shapes = [None] * len(params)
+    keys = [_memory_key(shape_fun, p) for p in params]
+    paths = [None] * len(params)
+    missing = []
+    for ct, (key, p) in enumerate(zip(keys, params)):
+        if key is None:
+            stats['uncacheable'] += 1
+        else:
+            with _lock:
+                shapes[ct] = _memory.get(key)
+                if shapes[ct] is not None:
+                    _memory.move_to_end(key)
+                    stats['hits'] += 1
+            if shapes[ct] is not None:
+                continue
+        if config.waveform_cache_disk:
+            paths[ct] = _disk_path(shape_fun, p)
+            if paths[ct] is not None and os.path.exists(paths[ct]):
+                shapes[ct] = _load(paths[ct])
+                if shapes[ct] is not None:
+                    _remember(key, shapes[ct])
+                    stats['disk_hits'] += 1
+                    continue
+        missing.append(ct)
+
+    if missing:
+        computed = PulseShapes.batch_shapes(shape_fun, [params[ct] for ct in missing])
+        for ct, shape in zip(missing, computed):
+            # batched shapes are views of a larger array, which we do not keep
+            shape = np.array(shape)
+            shape.flags.writeable = False
+            shapes[ct] = shape
+            if keys[ct] is not None:
+                stats['misses'] += 1
+                _remember(keys[ct], shape)
+            if paths[ct] is not None:
+                _save(paths[ct], shape)
+    return shapes
@@ -0,0 +1,217 @@
+'''
+Struct-of-arrays form of the wires handed from the compiler to the translators.
+
+After pulses_to_waveforms, a wire is normally a list of sequences of
+Compiler.Waveform objects interleaved with control flow and block labels. For
+translators that declare WIRE_ARRAYS = True (APS2, APS3), the compiler builds a
+WireArrays instead: one NumPy column per waveform property (kind, shape key,
+amp, phase, frameChange, length, frequency, isTimeAmp, label id), with the
+sequences delimited by seq_starts and the other entries kept as objects. The
+translators convert the lengths to samples, find the distinct waveforms and
+compress the marker wires on the columns, and only then build the Waveform
+objects they emit instructions for (see to_wire).
+
+Copyright 2020 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import numpy as np
+
+from . import Compiler
+from .PulseSequencer import Pulse
+
+# values of the kind column
+WAVEFORM = 0
+ENTRY = 1
+
+COLUMNS = ['kind', 'key', 'amp', 'phase', 'frameChange', 'length',
+           'frequency', 'isTimeAmp', 'label', 'channel', 'entry']
+
+
+class WireArrays(object):
+    '''
+    The sequences of one physical channel as columns with one row per entry.
+    The rows of sequence ct are seq_starts[ct]:seq_starts[ct + 1]. label and
+    channel are indices into labels and channels, entry is the index of the
+    object of ENTRY rows in entries (-1 for waveforms) and maddr holds the
+    measurement address of each row.
+    '''
+    def __init__(self, seq_starts, labels, channels, entries, maddr, **columns):
+        self.seq_starts = seq_starts
+        self.labels = labels
+        self.channels = channels
+        self.entries = entries
+        self.maddr = maddr
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+
+    @classmethod
+    def from_pulses(cls, seqs):
+        '''
+        Builds the arrays of a physical wire of Pulses and other entries, as
+        pulses_to_waveforms would build its Waveforms.
+        '''
+        rows = []
+        seq_starts = [0]
+        for seq in seqs:
+            rows.extend(seq)
+            seq_starts.append(len(rows))
+        is_pulse = np.fromiter((isinstance(entry, Pulse) for entry in rows),
+                               np.bool_, len(rows))
+        wf_rows = np.flatnonzero(is_pulse)
+        pulses = [rows[ct] for ct in wf_rows.tolist()]
+        entries = [entry for entry in rows if not isinstance(entry, Pulse)]
+
+        def column(values, dtype=None):
+            values = np.asarray(values, dtype=dtype)
+            out = np.zeros(len(rows), dtype=values.dtype if len(values) else dtype)
+            out[wf_rows] = values
+            return out
+
+        labels, channels = {}, {}
+        label = column([labels.setdefault(p.label, len(labels)) for p in pulses], np.int64)
+        channel = column([channels.setdefault(p.channel, len(channels)) for p in pulses],
+                         np.int64)
+        kind = np.full(len(rows), ENTRY, dtype=np.int8)
+        kind[wf_rows] = WAVEFORM
+        entry = np.full(len(rows), -1, dtype=np.int64)
+        entry[~is_pulse] = np.arange(len(entries))
+        maddr = [None] * len(rows)
+        for ct, pulse in zip(wf_rows.tolist(), pulses):
+            maddr[ct] = pulse.maddr
+        return cls(np.array(seq_starts, dtype=np.int64), list(labels), list(channels),
+                   entries, maddr,
+                   kind=kind, entry=entry,
+                   key=column([p.hashshape() for p in pulses], np.int64),
+                   amp=column([p.amp for p in pulses]),
+                   phase=column([p.phase for p in pulses], np.float64),
+                   frameChange=column([p.frameChange for p in pulses], np.float64),
+                   length=column([p.shapeParams['length'] for p in pulses], np.float64),
+                   frequency=column([p.frequency for p in pulses], np.float64),
+                   isTimeAmp=column([p.isTimeAmp for p in pulses], np.bool_),
+                   label=label, channel=channel)
+
+    def __len__(self):
+        return len(self.seq_starts) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[ct] for ct in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        return self.sequence(self.seq_starts[idx], self.seq_starts[idx + 1])
+
+    def __iter__(self):
+        return iter(self.to_wire())
+
+    @property
+    def num_waveforms(self):
+        return int(np.count_nonzero(self.kind == WAVEFORM))
+
+    @property
+    def isZero(self):
+        return self.amp == 0
+
+    def waveform(self, row):
+        '''
+        The Compiler.Waveform of a waveform row.
+        '''
+        wf = Compiler.Waveform.__new__(Compiler.Waveform)
+        wf.label = self.labels[self.label[row]]
+        wf.key = int(self.key[row])
+        wf.amp = self.amp[row].item()
+        wf.length = self.length[row].item()
+        wf.phase = self.phase[row].item()
+        wf.frameChange = self.frameChange[row].item()
+        wf.isTimeAmp = bool(self.isTimeAmp[row])
+        wf.frequency = self.frequency[row].item()
+        wf.logicalChan = self.channels[self.channel[row]]
+        wf.maddr = self.maddr[row]
+        return wf
+
+    def sequence(self, start, stop):
+        # the columns as lists, to build the Waveforms at Python speed
+        seq = []
+        kind = self.kind[start:stop].tolist()
+        entry = self.entry[start:stop].tolist()
+        cols = [getattr(self, name)[start:stop].tolist() for name in
+                ['key', 'amp', 'length', 'phase', 'frameChange', 'isTimeAmp',
+                 'frequency', 'label', 'channel']]
+        for ct, row in enumerate(zip(*cols)):
+            if kind[ct] != WAVEFORM:
+                seq.append(self.entries[entry[ct]])
+                continue
+            wf = Compiler.Waveform.__new__(Compiler.Waveform)
+            (wf.key, wf.amp, wf.length, wf.phase, wf.frameChange, wf.isTimeAmp,
+             wf.frequency, label, channel) = row
+            wf.label = self.labels[label]
+            wf.logicalChan = self.channels[channel]
+            wf.maddr = self.maddr[start + ct]
+            seq.append(wf)
+        return seq
+
+    def to_wire(self):
+        '''
+        The wire as a list of sequences of Waveforms and other entries.
+        '''
+        starts = self.seq_starts.tolist()
+        return [self.sequence(start, stop) for start, stop in zip(starts[:-1], starts[1:])]
+
+    def convert_lengths_to_samples(self, sampling_rate, quantization=1):
+        '''
+        Vectorized PatternUtils.convert_lengths_to_samples.
+        '''
+        length = np.rint(self.length * sampling_rate).astype(np.int64)
+        length -= length % quantization
+        self.length = np.where(self.kind == WAVEFORM, length, 0)
+        return self
+
+    def unique_waveforms(self, signature):
+        '''
+        Rows of the first waveform with each distinct signature, in order of
+        appearance. signature is a list of columns (of the waveform rows) that
+        together determine the signature.
+        '''
+        rows = np.flatnonzero(self.kind == WAVEFORM)
+        cols = [np.asarray(col)[rows] for col in signature]
+        # a stable sort keeps the first row of each signature first
+        order = np.lexsort(cols[::-1])
+        new = np.ones(len(rows), dtype=np.bool_)
+        for col in cols:
+            col = col[order]
+            new[1:] &= col[1:] == col[:-1]
+        new[1:] = ~new[1:]
+        return rows[np.sort(order[new])]
+
+    def merge_adjacent(self, values):
+        '''
+        Merges the runs of adjacent waveforms of each sequence with equal
+        values (one per row) into their first waveform, as
+        APS2Pattern.compress_marker does.
+        '''
+        is_wf = self.kind == WAVEFORM
+        same = np.zeros(len(self.kind), dtype=np.bool_)
+        same[1:] = is_wf[1:] & is_wf[:-1] & (values[1:] == values[:-1])
+        # runs do not cross sequences
+        same[self.seq_starts[1:-1][self.seq_starts[1:-1] < len(same)]] = False
+        keep = np.flatnonzero(~same)
+        if len(keep) == len(same):
+            return self
+        length = np.add.reduceat(self.length, keep) if len(keep) else self.length[:0]
+        columns = {name: getattr(self, name)[keep] for name in COLUMNS}
+        columns['length'] = length
+        # the new start of each sequence is the number of rows kept before it
+        seq_starts = np.searchsorted(keep, self.seq_starts)
+        return WireArrays(seq_starts, self.labels, self.channels, self.entries,
+                          [self.maddr[ct] for ct in keep.tolist()], **columns)
@@ -3,6 +3,8 @@ from .ChannelLibraries import QubitFactory, MeasFactory, EdgeFactory, MarkerFact
 # from .ChannelLibraries import new_APS2, new_X6, new_APS2_rack, new_Alazar, new_qubit, set_control, set_measure, set_master, new_source
 from .PulsePrimitives import *
 from .Compiler import compile_to_hardware, set_log_level
+from .CompileContexts import CompileContext
+from .CompileQueue import compile_to_hardware_async
 from .PulseSequencer import align
 from .ControlFlow import repeat, repeatall, qif, qwhile, qdowhile, qfunction, qwait, qsync, Barrier
 from .BasicSequences import *
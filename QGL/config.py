@@ -34,6 +34,74 @@ pulse_primitives_lib = "standard"
 # This default can be overridden on a per-Edge case as a channel property
 cnot_implementation  = "CNOT_CR"
 
+# compile each distinct sequence once, copying its wires for the repeated ones
+# (e.g. the calibration sequences). The translators still write the
+# instructions of every sequence: repeated sequences do not share an
+# instruction block
+dedup_sequences = False
+
+# cache compiled experiments under AWGDir/.qgl_cache, so that compiling the
+# same sequences against an unchanged channel library reuses the previous files
+compile_cache_enabled = False
+# maximum total size (in bytes) of the compile cache before the least recently
+# used entries are evicted
+compile_cache_size = 2**30
+
+# hand the wires to the translators that support it (APS2, APS3) as
+# WireArrays, one NumPy column per waveform property, instead of lists of
+# Waveform objects
+wire_arrays = False
+
+# when merging the logical channels of a physical channel, align the pulses on
+# the sample grid of the physical channel (exact integer comparisons) rather
+# than compare their lengths in seconds within a tolerance
+sample_lengths = False
+
+# in compile_sequence, fill the idle time of a channel between two of its
+# entries with a single Id rather than one Id per block (for the channels whose
+# translator gives its sample grid, e.g. APS2 and APS3)
+merge_idle = False
+
+# keep the waveform shapes evaluated by the compiler (see QGL.WaveformCache), so
+# that the same shape is computed once for all channels and compilations
+waveform_cache_enabled = False
+# maximum total size (in bytes) of the shapes kept in memory before the least
+# recently used ones are evicted
+waveform_cache_size = 2**28
+# also keep the shapes on disk under AWGDir/.qgl_waveforms, for later sessions
+waveform_cache_disk = False
+
+# number of sequences compiled at a time when streaming (compile_to_hardware
+# with an iterator of sequences, or compile_to_hardware_streaming)
+stream_chunk_size = 1000
+# bytes of instructions and waveform data held in memory when streaming, beyond
+# which they are spilled to temporary files next to the sequence files
+stream_memory_budget = 2**28
+
+# number of background threads of compile_to_hardware_async (see
+# QGL.CompileQueue), and number of compilations waiting for them beyond which
+# submitting another blocks
+compile_queue_workers = 1
+compile_queue_size = 4
+
+# Unix socket of the compile server (see QGL.CompileServer); None for
+# compile.sock in qgl-compile-<user id> of the temporary directory, a directory
+# created readable by its owner only (0700)
+compile_server_socket = None
+
+# profile every compilation (see QGL.Profiler), keeping the last report in
+# Profiler.last_report
+profile_compile = False
+# also trace the Python allocations of each stage (slows down compilation)
+profile_trace_memory = False
+# save the profile report of a compilation in its -meta.json
+profile_in_meta = False
+
+# how to save the input program next to the sequence files: 'archive' (a
+# compact -program.qgl that ProgramArchive.load_program reads back), 'text' (a
+# pretty-printed -code.py), 'both' or None
+save_program = 'archive'
+
 def load_config():
     global config_file
     if os.getenv('BBN_CONFIG'):
@@ -17,6 +17,7 @@ limitations under the License.
 '''
 
 import os
+import heapq
 import logging
 from warnings import warn
 from copy import copy
@@ -27,10 +28,12 @@ import struct
 import sys
 import numpy as np
 
-from QGL import Compiler, ControlFlow, BlockLabel, PatternUtils
+from QGL import Compiler, ControlFlow, BlockLabel, PatternUtils, Profiler
 from QGL import PulseSequencer
 from QGL.PatternUtils import hash_pulse, flatten
 from QGL import TdmInstructions
+from QGL.WireArrays import WireArrays
+from QGL.drivers import APSStreaming
 
 # Python 2/3 compatibility: use 'int' that subclasses 'long'
 from builtins import int
@@ -106,6 +109,9 @@ USE_PHASE_OFFSET_INSTRUCTION = False
 # Whether to save the waveform offsets for partial compilation
 SAVE_WF_OFFSETS = False
 
+# Whether the compiler may hand us the wires as WireArrays
+WIRE_ARRAYS = True
+
 # Do we want a pulse file per instrument or per channel
 SEQFILE_PER_CHANNEL = False
 
@@ -515,14 +521,42 @@ def LoadCmpVram(addr, mask, label=None):
     return Instruction(header, payload, label=label)
 
 
-def preprocess(seqs, shapeLib):
-    seqs = PatternUtils.convert_lengths_to_samples(
-        seqs, SAMPLING_RATE, ADDRESS_UNIT, Compiler.Waveform)
+def convert_lengths_to_samples(seqs, quantization):
+    '''
+    Converts the waveform lengths of a wire (a list of sequences or a
+    WireArrays) to samples.
+    '''
+    if isinstance(seqs, WireArrays):
+        return seqs.convert_lengths_to_samples(SAMPLING_RATE, quantization)
+    return PatternUtils.convert_lengths_to_samples(
+        seqs, SAMPLING_RATE, quantization, Compiler.Waveform)
+
+
+def sample_grid():
+    '''
+    The sampling rate and the number of samples to which preprocess rounds down
+    the length of each entry.
+    '''
+    return SAMPLING_RATE, ADDRESS_UNIT
+
+
+def preprocess(seqs, shapeLib, modulation_state=None):
+    seqs = convert_lengths_to_samples(seqs, ADDRESS_UNIT)
     wfLib = build_waveforms(seqs, shapeLib)
-    inject_modulation_cmds(seqs)
+    if isinstance(seqs, WireArrays):
+        seqs = seqs.to_wire()
+    inject_modulation_cmds(seqs, modulation_state)
     return seqs, wfLib
 
 
+def preprocess_markers(seqs):
+    seqs = convert_lengths_to_samples(seqs, 1)
+    if isinstance(seqs, WireArrays):
+        return seqs.merge_adjacent(seqs.isZero).to_wire()
+    compress_marker(seqs)
+    return seqs
+
+
 def wf_sig(wf):
     '''
     Compute a signature of a Compiler.Waveform that identifies the relevant properties for
@@ -612,13 +646,17 @@ class ModulationCommand(object):
         instr.writeFlag = write_flag
         return instr
 
-def inject_modulation_cmds(seqs):
+def inject_modulation_cmds(seqs, state=None):
     """
     Inject modulation commands from phase, frequency and frameChange of waveforms
     in an IQ waveform sequence. Assume up to 2 NCOs for now.
+    state (optional) is a dictionary carrying the NCO frequency and phase from one
+    call to the next, when a program is translated in chunks.
     """
-    cur_freq = 0
-    cur_phase = 0
+    if state is None:
+        state = {}
+    cur_freq = state.get('freq', 0)
+    cur_phase = state.get('phase', 0)
     for ct,seq in enumerate(seqs):
         #check whether we have modulation commands
         freqs = np.unique([entry.frequency for entry in filter(lambda s: isinstance(s,Compiler.Waveform), seq)])
@@ -697,11 +735,22 @@ def inject_modulation_cmds(seqs):
 
         seqs[ct] = mod_seq
 
+    state.update(freq=cur_freq, phase=cur_phase)
+
 def build_waveforms(seqs, shapeLib):
     # apply amplitude (and optionally phase) and add the resulting waveforms to the library
     wfLib = {}
-    for wf in flatten(seqs):
-        if isinstance(wf, Compiler.Waveform) and wf_sig(wf) not in wfLib:
+    if isinstance(seqs, WireArrays):
+        # only look at the first waveform with each signature (see wf_sig)
+        ta = seqs.isZero | seqs.isTimeAmp
+        signature = [ta, np.where(ta, 0, seqs.key), seqs.amp, np.where(ta, 0, seqs.length)]
+        if not USE_PHASE_OFFSET_INSTRUCTION:
+            signature.append(np.rint(seqs.phase * 2**13))
+        wfs = (seqs.waveform(row) for row in seqs.unique_waveforms(signature).tolist())
+    else:
+        wfs = (wf for wf in flatten(seqs) if isinstance(wf, Compiler.Waveform))
+    for wf in wfs:
+        if wf_sig(wf) not in wfLib:
             shape = wf.amp * shapeLib[wf.key]
             if not USE_PHASE_OFFSET_INSTRUCTION:
                 shape *= np.exp(1j * wf.phase)
@@ -755,7 +804,8 @@ def create_seq_instructions(seqs, offsets, label = None):
     [wfSeq & modulationSeq, m1Seq, m2Seq, m3Seq, m4Seq]
 
     We take the strategy of greedily grabbing the next instruction that occurs in time, accross
-    all    waveform and marker channels.
+    all    waveform and marker channels, with a k-way merge of the time stamps of the
+    sequences.
     '''
 
     # timestamp all entries before filtering (where we lose time information on control flow)
@@ -764,14 +814,14 @@ def create_seq_instructions(seqs, offsets, label = None):
 
     synchronize_clocks(seqs)
 
-    # create (seq, startTime) pairs over all sequences
-    timeTuples = []
-    for ct, seq in enumerate(seqs):
-        timeTuples += [(entry.startTime, ct) for entry in seq]
-    timeTuples.sort()
+    # merge the (startTime, seq) pairs of all sequences in time order; the
+    # start times of each sequence are (nearly always) sorted already
+    timeTuples = heapq.merge(*[[(startTime, ct) for startTime in
+                                sorted(entry.startTime for entry in seq)]
+                               for ct, seq in enumerate(seqs)])
 
     # keep track of where we are in each sequence
-    indexes = np.zeros(len(seqs), dtype=np.int64)
+    indexes = [0] * len(seqs)
 
     # always start with SYNC (stealing label from beginning of sequence)
     # unless it is a subroutine (using last entry as return as tell)
@@ -784,22 +834,21 @@ def create_seq_instructions(seqs, offsets, label = None):
         if isinstance(seqs[first_non_empty][0], BlockLabel.BlockLabel):
             if not label:
                 label = seqs[first_non_empty][0]
-            timeTuples.pop(0)
+            next(timeTuples)
             indexes[first_non_empty] += 1
         instructions.append(Sync(label=label))
         label = None
 
-    while len(timeTuples) > 0:
+    next_tuple = next(timeTuples, None)
+    while next_tuple is not None:
         #pop off all entries that have the same time
         entries = []
-        start_time = 0
-        while True:
-            start_time, seq_idx = timeTuples.pop(0)
+        start_time = next_tuple[0]
+        while next_tuple is not None and next_tuple[0] == start_time:
+            seq_idx = next_tuple[1]
             entries.append((seqs[seq_idx][indexes[seq_idx]], seq_idx))
             indexes[seq_idx] += 1
-            next_start_time = timeTuples[0][0] if len(timeTuples) > 0 else -1
-            if start_time != next_start_time:
-                break
+            next_tuple = next(timeTuples, None)
 
         write_flags = [True] * len(entries)
         for ct, (entry, seq_idx) in enumerate(entries):
@@ -880,7 +929,7 @@ def create_seq_instructions(seqs, offsets, label = None):
                                                label=label))
 
             #clear label
-            if len(timeTuples)>0:
+            if next_tuple is not None:
                 label = None
 
     return instructions, label
@@ -1029,20 +1078,21 @@ def write_sequence_file(awgData, fileName):
     Main function to pack channel sequences into an APS2 file.
     '''
     # Convert QGL IR into a representation that is closer to the hardware.
+    Profiler.step('preprocess')
     awgData['ch1']['linkList'], wfLib = preprocess(
         awgData['ch1']['linkList'], awgData['ch1']['wfLib'])
+    Profiler.count(waveforms=len(wfLib))
 
     # compress marker data
+    Profiler.step('compress_markers')
     for field in ['m1', 'm2', 'm3', 'm4']:
         if 'linkList' in awgData[field].keys():
-            PatternUtils.convert_lengths_to_samples(awgData[field]['linkList'],
-                                                    SAMPLING_RATE, 1,
-                                                    Compiler.Waveform)
-            compress_marker(awgData[field]['linkList'])
+            awgData[field]['linkList'] = preprocess_markers(awgData[field]['linkList'])
         else:
             awgData[field]['linkList'] = []
 
     #Create the waveform vectors
+    Profiler.step('create_wf_vector')
     wfInfo = []
     wfInfo.append(create_wf_vector({key: wf.real
                                     for key, wf in wfLib.items()}, awgData[
@@ -1051,7 +1101,12 @@ def write_sequence_file(awgData, fileName):
                                     for key, wf in wfLib.items()}, awgData[
                                         'ch1']['linkList']))
 
+    # the offsets are per cache line when prefetching
+    Profiler.count(waveform_points=wfInfo[0][0].size,
+                   cache_lines=len(wfInfo[0][1]) if wfInfo[0][2] else 0)
+
     if SAVE_WF_OFFSETS:
+        Profiler.step('save_wf_offsets')
         #create a set of all waveform signatures in offset dictionaries
         #we could have multiple offsets for the same pulse becuase it could
         #be repeated in multiple cache lines
@@ -1083,11 +1138,14 @@ def write_sequence_file(awgData, fileName):
             pickle.dump(offsets, FID)
 
     # build instruction vector
+    Profiler.step('create_instr_data')
     seq_data = [awgData[s]['linkList']
                 for s in ['ch1', 'm1', 'm2', 'm3', 'm4']]
     instructions = create_instr_data(seq_data, wfInfo[0][1], wfInfo[0][2])
+    Profiler.count(instructions=instructions.size)
 
     #Open the binary file
+    Profiler.step('write_file')
     if os.path.isfile(fileName):
         os.remove(fileName)
 
@@ -1113,6 +1171,16 @@ def write_sequence_file(awgData, fileName):
             FID.write(np.uint64(data.size).tobytes()) # waveform data length for channel
             FID.write(data.tobytes())
 
+class SequenceFileWriter(APSStreaming.SequenceFileWriter):
+    '''
+    Writes an APS2 file from consecutive chunks of sequences, for programs too
+    long to translate at once (see Compiler.compile_to_hardware_streaming).
+    '''
+    def __init__(self, fileName, memory_budget=None):
+        super(SequenceFileWriter, self).__init__(sys.modules[__name__], b'APS2',
+                                                 ['m1', 'm2', 'm3', 'm4'],
+                                                 fileName, memory_budget)
+
 def read_sequence_file(fileName):
     """
     Reads a .aps2 sequence file and returns a dictionary of lists.
@@ -21,7 +21,7 @@ import struct
 import numpy as np
 from warnings import warn
 from itertools import chain, zip_longest
-from QGL import Compiler, ControlFlow, BlockLabel, PatternUtils
+from QGL import Compiler, ControlFlow, BlockLabel, PatternUtils, Profiler
 from QGL.PatternUtils import hash_pulse, flatten
 from copy import copy, deepcopy
 
@@ -661,6 +661,7 @@ def write_sequence_file(awgData, fileName, miniLLRepeat=1):
 	Main function to pack channel LLs into an APS1 file.
 	'''
     #Preprocess the sequence data to handle APS restrictions
+    Profiler.step('preprocess')
     LLs12, repeat12, wfLib12 = preprocess(awgData['ch12']['linkList'],
                                           awgData['ch12']['wfLib'],
                                           awgData['ch12']['correctionT'])
@@ -671,12 +672,16 @@ def write_sequence_file(awgData, fileName, miniLLRepeat=1):
     if repeat12 != 0:
         miniLLRepeat *= repeat12
 
+    Profiler.count(waveforms=len(wfLib12) + len(wfLib34))
+
     #Merge the the marker data into the IQ linklists
+    Profiler.step('merge_markers')
     merge_APS_markerData(LLs12, awgData['ch1m1']['linkList'], 1)
     merge_APS_markerData(LLs12, awgData['ch2m1']['linkList'], 2)
     merge_APS_markerData(LLs34, awgData['ch3m1']['linkList'], 1)
     merge_APS_markerData(LLs34, awgData['ch4m1']['linkList'], 2)
 
+    Profiler.step('write_file')
     if os.path.isfile(fileName):
         os.remove(fileName)
 
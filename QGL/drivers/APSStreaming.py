@@ -0,0 +1,430 @@
+'''
+Translation of programs a chunk at a time for the APS2 and APS3 drivers, which
+share their instruction set and waveform cache (see
+Compiler.compile_to_hardware_streaming).
+
+Copyright 2020 Raytheon BBN Technologies
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import os
+from warnings import warn
+from itertools import zip_longest
+from array import array
+
+import numpy as np
+
+from QGL import Compiler, PatternUtils, Profiler
+
+
+def quantize_waveform(wf, driver):
+    '''
+    Clips a real waveform to [-1, 1], repeats TA pairs and trims it to an
+    integer number of ADDRESS_UNITs of the driver, and converts it to DAC
+    values, as create_wf_vector does.
+    '''
+    wf = np.clip(wf, -1.0, 1.0)
+    if wf.size == 1:
+        wf = wf.repeat(driver.ADDRESS_UNIT)
+    trim = wf.size % driver.ADDRESS_UNIT
+    if trim:
+        wf = wf[:-trim]
+    return np.int16(driver.MAX_WAVEFORM_VALUE * wf)
+
+
+class WaveformIds(object):
+    '''
+    Stands in for the waveform offsets of create_seq_instructions, putting the
+    number of each waveform (in order of first appearance) in the address field
+    of its instructions until the waveform layout is known.
+    '''
+    def __init__(self, wf_ids, address_unit):
+        self.wf_ids = wf_ids
+        self.address_unit = address_unit
+
+    def __getitem__(self, sig):
+        return self.wf_ids[sig] * self.address_unit
+
+
+class SequenceFileWriter(object):
+
+    '''
+    Writes the file of an APS2 or APS3 from consecutive chunks of sequences,
+    for programs too long to translate at once. The translator subclasses it,
+    passing itself as driver (for its constants and instructions), its target
+    hardware tag and its marker channels.
+
+    write() translates the awgData of each chunk as it arrives. Its waveform
+    addresses and branch targets are placeholders until close() knows the
+    waveform layout (packed, or in prefetched cache lines) and the addresses of
+    the instructions, and writes the same file as write_sequence_file would
+    for all the sequences at once.
+
+    Instructions and waveform data beyond memory_budget bytes are spilled to
+    temporary files in the directory of fileName.
+    '''
+    def __init__(self, driver, target, markers, fileName, memory_budget=None):
+        if driver.SAVE_WF_OFFSETS:
+            raise ValueError("{}.SAVE_WF_OFFSETS cannot be combined with compiling "
+                             "in chunks (chunk_size, or an iterator of sequences)".format(
+                             driver.__name__.split('.')[-1]))
+        self.driver = driver
+        self.target = target
+        self.markers = markers
+        self.fileName = fileName
+        tmpdir = os.path.dirname(fileName) or None
+        budget = memory_budget // 3 if memory_budget is not None else None
+        self.instructions = PatternUtils.SpillBuffer(np.uint64, budget, tmpdir)
+        self.wf_data = [PatternUtils.SpillBuffer(np.int16, budget, tmpdir)
+                        for _ in range(2)]
+        # waveform signatures numbered in order of first appearance, and where
+        # their samples start in wf_data
+        self.wf_ids = {}
+        self.wf_starts = array('q', [0])
+        self.max_pts_needed = 0
+        # cache line assignment, in case the waveforms end up not fitting the
+        # cache: the line offsets and the first sequence on each line
+        self.wf_idx = 0
+        self.line_offsets = [{}]
+        self.cache_line_changes = array('q')
+        self.cache_lines = array('q')
+        self.num_wf_seqs = 0
+        # sequences before the subroutines, with the first address of each
+        # label and the targets of branches
+        self.seq_starts = array('q')
+        self.symbols = {}
+        self.target_idx = array('q')
+        self.targets = []
+        # instructions of the subroutines
+        self.subroutines_start = None
+        self.subroutines = []
+        self.num_seqs = 0
+        self.label = None
+        self.modulation_state = {}
+
+    def write(self, awgData):
+        '''
+        Translates the next chunk of sequences and appends it to the program.
+        '''
+        driver = self.driver
+        Profiler.step('preprocess')
+        awgData['ch1']['linkList'], wfLib = driver.preprocess(
+            awgData['ch1']['linkList'], awgData['ch1']['wfLib'], self.modulation_state)
+        seqs = awgData['ch1']['linkList']
+        num_wfs = len(self.wf_ids)
+        self.add_waveforms(wfLib)
+        Profiler.count(waveforms=len(self.wf_ids) - num_wfs)
+        Profiler.step('assign_cache_lines')
+        self.assign_cache_lines(seqs)
+
+        # compress marker data
+        Profiler.step('compress_markers')
+        for field in self.markers:
+            if 'linkList' in awgData[field].keys():
+                awgData[field]['linkList'] = driver.preprocess_markers(awgData[field]['linkList'])
+            else:
+                awgData[field]['linkList'] = []
+
+        seq_data = [awgData[s]['linkList']
+                    for s in ['ch1'] + self.markers]
+        Profiler.step('create_instructions')
+        num_instrs = len(self.instructions)
+        offsets = WaveformIds(self.wf_ids, driver.ADDRESS_UNIT)
+        for seq in zip_longest(*seq_data, fillvalue=[]):
+            new_instrs, self.label = driver.create_seq_instructions(list(seq), offsets,
+                                                             label=self.label)
+            self.add_instructions(new_instrs)
+        Profiler.count(instructions=len(self.instructions) - num_instrs)
+
+    def add_waveforms(self, wfLib):
+        driver = self.driver
+        for sig, wf in wfLib.items():
+            if sig in self.wf_ids:
+                continue
+            if len(self.wf_ids) > 0xffffff:
+                raise RuntimeError("Too many distinct waveforms to stream")
+            self.wf_ids[sig] = len(self.wf_ids)
+            self.max_pts_needed += driver.ADDRESS_UNIT if len(wf) == 1 else len(wf)
+            self.wf_data[0].append(quantize_waveform(wf.real, driver))
+            self.wf_data[1].append(quantize_waveform(wf.imag, driver))
+            self.wf_starts.append(len(self.wf_data[0]))
+
+    def assign_cache_lines(self, seqs):
+        driver = self.driver
+        # fill in one cache line at a time, as create_wf_vector does
+        CACHE_LINE_LENGTH = int(np.round(driver.WAVEFORM_CACHE_SIZE / 2)) - 1
+        for seq in seqs:
+            entries = [(self.wf_ids[driver.wf_sig(entry)], entry.length) for entry in seq
+                       if isinstance(entry, Compiler.Waveform)]
+            pts_to_add = sum(length for wf_id, length in entries
+                             if wf_id not in self.line_offsets[-1])
+            if (self.wf_idx % CACHE_LINE_LENGTH) + pts_to_add > CACHE_LINE_LENGTH:
+                self.wf_idx = int(CACHE_LINE_LENGTH * (
+                    (self.wf_idx + CACHE_LINE_LENGTH) // CACHE_LINE_LENGTH))
+                self.line_offsets.append({})
+            for wf_id, _ in entries:
+                if wf_id not in self.line_offsets[-1]:
+                    self.line_offsets[-1][wf_id] = self.wf_idx
+                    self.wf_idx += self.wf_starts[wf_id + 1] - self.wf_starts[wf_id]
+            cache_line = int(self.wf_idx // CACHE_LINE_LENGTH)
+            if not self.cache_lines or self.cache_lines[-1] != cache_line:
+                self.cache_line_changes.append(self.num_wf_seqs)
+                self.cache_lines.append(cache_line)
+            self.num_wf_seqs += 1
+
+    def add_instructions(self, instrs):
+        driver = self.driver
+        #Use last instruction being return as mark of start of subroutines
+        if self.subroutines_start is None and instrs and (instrs[-1].header >> 4) == driver.RET:
+            self.subroutines_start = self.num_seqs
+        self.num_seqs += 1
+        if self.subroutines_start is not None:
+            self.subroutines.append(instrs)
+            return
+        start = len(self.instructions)
+        self.seq_starts.append(start)
+        for ct, instr in enumerate(instrs):
+            if instr.label and instr.label not in self.symbols:
+                self.symbols[instr.label] = start + ct
+            if instr.target:
+                self.target_idx.append(start + ct)
+                self.targets.append(instr.target)
+        self.instructions.append(np.fromiter((instr.flatten() for instr in instrs),
+                                             np.uint64, len(instrs)))
+
+    def wf_offsets(self, wf_ids, seq_idx):
+        '''
+        Offsets of the waveforms wf_ids played by the sequences seq_idx.
+        '''
+        if not self.need_prefetch:
+            return np.asarray(self.wf_starts, dtype=np.int64)[wf_ids]
+        lines = np.asarray(self.cache_lines)[np.searchsorted(
+            self.cache_line_changes, seq_idx, 'right') - 1]
+        return np.array([self.line_offsets[line][wf_id] for wf_id, line in
+                         zip(wf_ids.tolist(), lines.tolist())], dtype=np.int64)
+
+    def wf_prefetch(self, change):
+        driver = self.driver
+        next_cache_line = self.cache_lines[(change + 1) % len(self.cache_lines)]
+        return driver.WaveformPrefetch(int(next_cache_line * driver.WAVEFORM_CACHE_SIZE / 2))
+
+    def close(self):
+        '''
+        Lays out the waveforms, resolves the addresses of the instructions and
+        writes the file.
+        '''
+        try:
+            self.write_file()
+        finally:
+            self.instructions.close()
+            for data in self.wf_data:
+                data.close()
+
+    def write_file(self):
+        driver = self.driver
+        # see create_wf_vector and create_instr_data
+        Profiler.step('layout')
+        self.need_prefetch = (self.max_pts_needed > driver.WAVEFORM_CACHE_SIZE) and (self.num_wf_seqs > 0)
+        cache_line_changes = list(self.cache_line_changes) if self.need_prefetch else []
+        instructions = self.instructions.array()
+        seqs_end = len(instructions)
+
+        #if we need wf prefetching and have moved waveform cache lines then
+        #inject prefetch for the next line, stealing the label of the sequence
+        insertions = {}
+        stolen = set()
+        for change, ct in enumerate(cache_line_changes):
+            if ct >= len(self.seq_starts):
+                break
+            insertions[self.seq_starts[ct]] = [self.wf_prefetch(change)]
+            stolen.add(self.seq_starts[ct])
+
+        subroutine_instrs = []
+        if self.subroutines_start is not None:
+            for sub_ct, sub in enumerate(self.subroutines):
+                ct = self.subroutines_start + sub_ct
+                for instr in sub:
+                    if (instr.header >> 4) == driver.WFM and ((instr.payload >> driver.WFM_OP_OFFSET) & 0x3) == driver.PLAY:
+                        offset = self.wf_offsets(np.array([instr.payload & 0xffffff]), [ct])[0]
+                        instr.payload = (instr.payload & ~0xffffff) | ((int(offset) // driver.ADDRESS_UNIT) & 0xffffff)
+                if ct in cache_line_changes:
+                    sub.insert(0, self.wf_prefetch(cache_line_changes.index(ct)))
+                    if not sub[0].label:
+                        sub[0].label = sub[1].label
+                        sub[1].label = None
+
+            #group the subroutines in cache lines
+            subroutine_cache_line = {}
+            CACHE_LINE_LENGTH = 128
+            offset = 0
+            for sub in self.subroutines:
+                #TODO for now we don't properly handle prefetching mulitple cache lines
+                if len(sub) > CACHE_LINE_LENGTH:
+                    warn("Subroutines longer than {} instructions may not be prefetched correctly")
+                #Don't unecessarily split across a cache line
+                if (len(sub) + offset > CACHE_LINE_LENGTH) and (
+                        len(sub) < CACHE_LINE_LENGTH):
+                    pad_instrs = 128 - ((offset + 128) % 128)
+                    subroutine_instrs += [driver.NoOp()] * pad_instrs
+                    offset = 0
+                if offset == 0:
+                    line_label = sub[0].label
+                subroutine_cache_line[sub[0].label] = line_label
+                subroutine_instrs += sub
+                offset += len(sub) % CACHE_LINE_LENGTH
+
+            #inject prefetch commands before waits
+            wait_idx = []
+            for start in range(0, seqs_end, 2**16):
+                block = instructions[start:start + 2**16]
+                wait_idx += (np.flatnonzero((block >> np.uint64(60)) == driver.WAIT) + start).tolist()
+            target_idx = np.asarray(self.target_idx, dtype=np.int64)
+            calls = [(idx, self.targets[ct]) for ct, idx in enumerate(target_idx.tolist())
+                     if (int(instructions[idx]) >> 60) == driver.CALL]
+            call_ct = 0
+            last_prefetch = None
+            wait_idx.append(seqs_end)
+            while call_ct < len(calls) and calls[call_ct][0] < wait_idx[0]:
+                call_ct += 1
+            for start, stop in zip(wait_idx[:-1], wait_idx[1:]):
+                needed_lines = set()
+                while call_ct < len(calls) and calls[call_ct][0] < stop:
+                    needed_lines.add(subroutine_cache_line[calls[call_ct][1]])
+                    call_ct += 1
+                if len(needed_lines) > 8:
+                    raise RuntimeError(
+                        "Unable to prefetch more than 8 cache lines")
+                for needed_line in needed_lines:
+                    if needed_line != last_prefetch:
+                        insertions.setdefault(start, []).append(driver.Prefetch(needed_line))
+                        last_prefetch = needed_line
+
+        # addresses of the instructions with the injected ones
+        insert_idx = np.array(sorted(insertions), dtype=np.int64)
+        num_inserted = np.cumsum([0] + [len(insertions[idx]) for idx in insert_idx.tolist()],
+                                 dtype=np.int64)
+        def address(idx, before=False):
+            return idx + num_inserted[np.searchsorted(insert_idx, idx,
+                                                      'left' if before else 'right')]
+        seqs_length = seqs_end + int(num_inserted[-1])
+        num_instructions = seqs_length
+        if self.subroutines_start is not None:
+            #pad out instruction vector to ensure circular cache never loads a subroutine
+            pad_instrs = 7 * 128 + (128 - ((seqs_length + 128) % 128))
+            num_instructions += pad_instrs + len(subroutine_instrs)
+        assert num_instructions < driver.MAX_NUM_INSTRUCTIONS, \
+        'Oops! too many instructions: {0}'.format(num_instructions)
+        Profiler.count(instructions=num_instructions - seqs_end,
+                       cache_lines=len(self.line_offsets) if self.need_prefetch else 0)
+
+        #turn symbols into integers addresses, as resolve_symbols does
+        symbols = {label: int(address(idx, idx in stolen))
+                   for label, idx in self.symbols.items()}
+        subroutines_address = num_instructions - len(subroutine_instrs)
+        for ct, instr in enumerate(subroutine_instrs):
+            if instr.label and instr.label not in symbols:
+                symbols[instr.label] = subroutines_address + ct
+        target_idx = np.asarray(self.target_idx, dtype=np.int64)
+        target_addresses = [address(target_idx)]
+        targets = list(self.targets)
+        target_instrs = []
+        for idx in insert_idx.tolist():
+            for ct, instr in enumerate(insertions[idx]):
+                if instr.target:
+                    target_addresses.append([address(idx, True) + ct])
+                    targets.append(instr.target)
+                    target_instrs.append(instr)
+        for ct, instr in enumerate(subroutine_instrs):
+            if instr.target:
+                target_addresses.append([subroutines_address + ct])
+                targets.append(instr.target)
+                target_instrs.append(instr)
+        # find next available label. The TDM may miss some labels if branches
+        # only contain waveforms (which are ignored)
+        resolved = np.zeros(len(targets), dtype=np.uint64)
+        value = None
+        for ct in np.argsort(np.concatenate(target_addresses), kind='stable')[::-1].tolist():
+            if targets[ct] in symbols:
+                value = symbols[targets[ct]]
+            if value is None:
+                raise KeyError(targets[ct])
+            resolved[ct] = value & 0xffffffff
+        for ct, instr in enumerate(target_instrs):
+            instr.address = int(resolved[len(target_idx) + ct])
+
+        #Open the binary file
+        Profiler.step('write_file')
+        if os.path.isfile(self.fileName):
+            os.remove(self.fileName)
+
+        with open(self.fileName, 'wb') as FID:
+            FID.write(self.target)                 # target hardware
+            FID.write(np.float32(4.0).tobytes())   # Version
+            FID.write(np.float32(4.0).tobytes())   # minimum firmware version
+            FID.write(np.uint16(2).tobytes())      # number of channels
+            FID.write(np.uint64(num_instructions).tobytes()) # instructions length
+
+            start = 0
+            for stop in insert_idx.tolist() + [seqs_end]:
+                self.write_instructions(FID, instructions, start, stop,
+                                        target_idx, resolved)
+                for instr in insertions.get(stop, []):
+                    FID.write(np.uint64(instr.flatten()).tobytes())
+                start = stop
+            if self.subroutines_start is not None:
+                FID.write(np.full(pad_instrs, driver.NoOp().flatten(), dtype=np.uint64).tobytes())
+                FID.write(np.array([instr.flatten() for instr in subroutine_instrs],
+                                   dtype=np.uint64).tobytes())
+
+            for chanct in range(2):
+                #Write the waveformLib to file
+                data = self.wf_data[chanct].array()
+                if self.need_prefetch:
+                    CACHE_LINE_LENGTH = int(np.round(driver.WAVEFORM_CACHE_SIZE / 2)) - 1
+                    FID.write(np.uint64(CACHE_LINE_LENGTH * len(self.line_offsets)).tobytes())
+                    for line, offsets in enumerate(self.line_offsets):
+                        wfVec = np.zeros(CACHE_LINE_LENGTH, dtype=np.int16)
+                        for wf_id, idx in offsets.items():
+                            idx -= line * CACHE_LINE_LENGTH
+                            wf = data[self.wf_starts[wf_id]:self.wf_starts[wf_id + 1]]
+                            wfVec[idx:idx + wf.size] = wf
+                        FID.write(wfVec.tobytes())
+                else:
+                    if data.size == 0:
+                        #If there are no waveforms, ensure that there is some element
+                        #so that the waveform group gets written to file.
+                        data = np.array([0], dtype=np.int16)
+                    FID.write(np.uint64(data.size).tobytes()) # waveform data length for channel
+                    for start in range(0, data.size, 2**20):
+                        FID.write(data[start:start + 2**20].tobytes())
+
+    def write_instructions(self, FID, instructions, start, stop, target_idx, resolved):
+        driver = self.driver
+        # write the instructions in [start, stop) with their final waveform
+        # offsets and branch targets
+        seq_starts = np.asarray(self.seq_starts, dtype=np.int64)
+        for block_start in range(start, stop, 2**16):
+            block_stop = min(block_start + 2**16, stop)
+            block = np.array(instructions[block_start:block_stop])
+            wfms = np.flatnonzero(((block >> np.uint64(60)) == driver.WFM) &
+                (((block >> np.uint64(driver.WFM_OP_OFFSET)) & np.uint64(0x3)) == driver.PLAY))
+            if wfms.size:
+                wf_ids = (block[wfms] & np.uint64(0xffffff)).astype(np.int64)
+                seq_idx = np.searchsorted(seq_starts, block_start + wfms, 'right') - 1
+                offsets = self.wf_offsets(wf_ids, seq_idx)
+                block[wfms] = (block[wfms] & ~np.uint64(0xffffff)) | \
+                    ((offsets // driver.ADDRESS_UNIT) & 0xffffff).astype(np.uint64)
+            lo, hi = np.searchsorted(target_idx, [block_start, block_stop])
+            block[target_idx[lo:hi] - block_start] |= resolved[lo:hi]
+            FID.write(block.tobytes())
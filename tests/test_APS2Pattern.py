@@ -1,10 +1,12 @@
 import unittest
 import os
 import pickle
+import json
 import numpy as np
 from copy import copy
 
 from QGL import *
+from QGL import config
 from QGL.drivers import APS2Pattern
 
 
@@ -92,6 +94,61 @@ class APSPatternUtils(unittest.TestCase):
             instrOpCode = (actual.header >> 4) & 0xf
             assert (instrOpCode == expected)
 
+    def test_merge_marker_toggles(self):
+        q1 = self.q1
+
+        pulse = Compiler.Waveform()
+        pulse.length = 24
+        pulse.key = 12345
+        high = Compiler.Waveform(BLANK(q1, 12))
+        high.length = 12
+        low = copy(high)
+        low.amp = 0
+
+        num_pulses = 500
+        seq_1 = [qwait()] + [copy(pulse) for _ in range(num_pulses)]
+        seq_2 = [qwait()] + [copy(w) for _ in range(num_pulses) for w in [high, low]]
+        offsets = {APS2Pattern.wf_sig(pulse): 0}
+
+        instructions = APS2Pattern.create_seq_instructions(
+            [seq_1, seq_2, [], [], []], offsets)[0]
+
+        # the waveform and the marker starting at the same time, in engine
+        # order, then the marker toggling in the middle of the waveform
+        instr_types = [APS2Pattern.SYNC, APS2Pattern.WAIT] + [
+            APS2Pattern.WFM, APS2Pattern.MARKER, APS2Pattern.MARKER] * num_pulses
+        assert [(instr.header >> 4) & 0xf for instr in instructions] == instr_types
+        assert [instr.payload >> 32 & 1 for instr in instructions[3::3]] == [1] * num_pulses
+
+    def test_merge_idle(self):
+        q1 = self.q1
+        APS2Pattern.SAVE_WF_OFFSETS = False
+
+        def times(merge_idle):
+            # delays off the 4-sample grid of the APS2
+            seqs = [[X90(q1), Id(q1, delay), Y(q1), Id(q1, delay), X90(q1), MEAS(q1)]
+                    for delay in [0.4515e-6, 0.9015e-6, 1.3515e-6]]
+            config.merge_idle = merge_idle
+            try:
+                mf = compile_to_hardware(seqs, 'MergeIdle/MergeIdle')
+            finally:
+                config.merge_idle = False
+            with open(mf, 'r') as FID:
+                meta = json.load(FID)
+            control = APS2Pattern.read_sequence_file(meta['instruments']['Maxwell_U4'])
+            measure = APS2Pattern.read_sequence_file(meta['instruments']['Maxwell_U2'])
+            def busy(seq):
+                # the (start, end) time stamps of the non-zero samples
+                ends = np.cumsum([count for count, _ in seq])
+                return [(end - count, end) for end, (count, amp) in zip(ends, seq) if amp != 0]
+            # end of the last control pulse and start of the measurement
+            return [(busy(control_seq)[-1][1], busy(measure_seq)[0][0])
+                    for control_seq, measure_seq in zip(control['ch1'], measure['ch1'])]
+
+        expected = times(False)
+        assert all(end == start for end, start in expected)
+        assert times(True) == expected
+
     def test_inplace_updates(self):
         q1 = self.q1
         APS2Pattern.SAVE_WF_OFFSETS = True
@@ -132,6 +189,73 @@ class APSPatternUtils(unittest.TestCase):
         for actual, expected in zip(waveforms, spam_waveforms):
             assert (actual.all() == expected.all())
 
+    def test_concurrent_sequence_files(self):
+        q1 = self.q1
+
+        def compile(name, **kwargs):
+            seqs = [[Utheta(q1, amp=amp), MEAS(q1)] for amp in np.linspace(-1, 1, 11)]
+            mf = compile_to_hardware(seqs, 'AWGWorkers/' + name, **kwargs)
+            with open(mf, 'r') as FID:
+                return json.load(FID)
+
+        serial = compile('serial')
+        parallel = compile('parallel', awg_workers=2, max_inflight_awgs=1)
+
+        assert serial['instruments'].keys() == parallel['instruments'].keys()
+        for awg, fileName in serial['instruments'].items():
+            with open(fileName, 'rb') as FID:
+                expected = FID.read()
+            with open(parallel['instruments'][awg], 'rb') as FID:
+                assert FID.read() == expected
+
+    def test_streaming_compile(self):
+        q1 = self.q1
+        # not supported when streaming
+        APS2Pattern.SAVE_WF_OFFSETS = False
+
+        def make_seqs():
+            # enough distinct waveforms to need prefetched cache lines
+            return ([Utheta(q1, length=1e-6, amp=amp), X90(q1), MEAS(q1)]
+                    for amp in np.linspace(0.1, 0.9, 120))
+
+        def read_outputs(mf):
+            with open(mf, 'r') as FID:
+                meta = json.load(FID)
+            outputs = {}
+            for awg, fileName in meta['instruments'].items():
+                with open(fileName, 'rb') as FID:
+                    outputs[awg] = FID.read()
+            return outputs, meta['num_sequences']
+
+        expected = read_outputs(compile_to_hardware(list(make_seqs()), 'Stream/full'))
+        # spill the streamed instructions and waveforms to disk as well
+        streamed = Compiler.compile_to_hardware_streaming(make_seqs(), 'Stream/streamed',
+                                                          chunk_size=7, memory_budget=2**12)
+        assert read_outputs(streamed) == expected
+
+        # so are the sequences of translators that cannot write in chunks
+        writer = APS2Pattern.SequenceFileWriter
+        del APS2Pattern.SequenceFileWriter
+        try:
+            with self.assertWarns(UserWarning):
+                mf = compile_to_hardware(make_seqs(), 'Stream/unstreamable')
+        finally:
+            APS2Pattern.SequenceFileWriter = writer
+        assert read_outputs(mf) == expected
+
+        # TDM sequences are compiled at once
+        expected = read_outputs(compile_to_hardware(list(make_seqs()), 'Stream/tdm', tdm_seq=True))
+        with self.assertWarns(UserWarning):
+            mf = compile_to_hardware(make_seqs(), 'Stream/tdm', tdm_seq=True)
+        assert read_outputs(mf) == expected
+
+        APS2Pattern.SAVE_WF_OFFSETS = True
+        try:
+            with self.assertRaises(ValueError):
+                compile_to_hardware(make_seqs(), 'Stream/offsets')
+        finally:
+            APS2Pattern.SAVE_WF_OFFSETS = False
+
 
 if __name__ == "__main__":
     unittest.main()
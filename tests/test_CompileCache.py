@@ -0,0 +1,132 @@
+import unittest
+import os
+import json
+import tempfile
+import numpy as np
+
+from QGL import *
+from QGL import config, CompileCache
+from QGL.drivers import APS2Pattern
+
+
+class CompileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cl = ChannelLibrary(db_resource_name=":memory:")
+        self.cl.clear()
+        self.q1 = self.cl.new_qubit(label='q1')
+        aps2 = self.cl.new_APS2_rack("Maxwell",
+                                     [f"192.168.1.{i}" for i in [23, 24]],
+                                     tdm_ip="192.168.1.11")
+        self.cl.set_master(aps2.px("TDM"))
+        dig = self.cl.new_X6("MyX6", address=0)
+        self.cl.set_measure(self.q1, aps2.tx(1), dig.channels[1], gate=False,
+                            trig_channel=aps2.tx(1).ch("m2"))
+        self.cl.set_control(self.q1, aps2.tx(2))
+        self.cl.update_channelDict()
+
+        self.awg_dir = config.AWGDir
+        config.AWGDir = tempfile.mkdtemp(prefix="AWG")
+        config.compile_cache_enabled = True
+        CompileCache.reset_stats()
+
+    def tearDown(self):
+        config.compile_cache_enabled = False
+        config.AWGDir = self.awg_dir
+
+    def compile(self, amps=np.linspace(-1, 1, 11), name='Rabi'):
+        seqs = [[Utheta(self.q1, amp=amp), MEAS(self.q1)] for amp in amps]
+        return compile_to_hardware(seqs, 'Cache/' + name)
+
+    def read_outputs(self, metafile):
+        with open(metafile, 'r') as FID:
+            meta = json.load(FID)
+        outputs = {}
+        for fileName in meta['instruments'].values():
+            with open(fileName, 'rb') as FID:
+                outputs[fileName] = FID.read()
+        return outputs
+
+    def test_hit(self):
+        mf = self.compile()
+        expected = self.read_outputs(mf)
+        assert CompileCache.stats['misses'] == 1
+
+        # clobber the outputs to check that they are restored
+        for fileName in expected:
+            os.remove(fileName)
+        assert self.compile() == mf
+        assert self.read_outputs(mf) == expected
+        assert CompileCache.stats['hits'] == 1
+
+    def test_invalidation(self):
+        self.compile()
+        self.q1.pulse_params['piAmp'] = 0.5
+        self.compile()
+        assert CompileCache.stats['misses'] == 2
+
+        APS2Pattern.USE_PHASE_OFFSET_INSTRUCTION = True
+        try:
+            self.compile()
+        finally:
+            APS2Pattern.USE_PHASE_OFFSET_INSTRUCTION = False
+        assert CompileCache.stats['misses'] == 3
+
+        config.merge_idle = True
+        try:
+            self.compile()
+        finally:
+            config.merge_idle = False
+        assert CompileCache.stats['misses'] == 4
+
+        self.compile(amps=np.linspace(-1, 1, 12))
+        assert CompileCache.stats['misses'] == 5
+        assert CompileCache.stats['hits'] == 0
+
+    def test_eviction(self):
+        self.compile(name='first')
+        size = CompileCache.cache_stats()['size']
+        config.compile_cache_size = int(1.5 * size)
+        try:
+            self.compile(name='second')
+        finally:
+            config.compile_cache_size = 2**30
+        stats = CompileCache.cache_stats()
+        assert stats['evictions'] == 1
+        assert stats['entries'] == 1
+
+        # the most recent compilation is still cached
+        self.compile(name='second')
+        assert CompileCache.stats['hits'] == 1
+
+    def test_incremental(self):
+        config.compile_cache_enabled = False
+        q1 = self.q1
+        def compile(name, **kwargs):
+            seqs = [[X(q1), Y90(q1), MEAS(q1)] for _ in range(5)]
+            mf = compile_to_hardware(seqs, 'Cache/' + name, **kwargs)
+            with open(mf, 'r') as FID:
+                return json.load(FID)['instruments']
+
+        files = compile('incremental', incremental=True)
+        stamps = {awg: os.stat(f).st_mtime_ns for awg, f in files.items()}
+
+        # the measurement AWG does not depend on the control pulse amplitude
+        q1.pulse_params['piAmp'] = 0.5
+        files = compile('incremental', incremental=True)
+        assert os.stat(files['Maxwell_U1']).st_mtime_ns == stamps['Maxwell_U1']
+        assert os.stat(files['Maxwell_U2']).st_mtime_ns != stamps['Maxwell_U2']
+
+        expected = compile('full')
+        assert files.keys() == expected.keys()
+        for awg in files:
+            with open(files[awg], 'rb') as FID, open(expected[awg], 'rb') as FID2:
+                assert FID.read() == FID2.read()
+
+    def test_uncacheable(self):
+        seqs = [[Utheta(self.q1, shape_fun=lambda **kwargs: PulseShapes.gaussian(**kwargs)), MEAS(self.q1)]]
+        compile_to_hardware(seqs, 'Cache/lambda')
+        assert CompileCache.stats['uncacheable'] == 1
+        assert CompileCache.cache_stats()['entries'] == 0
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import os
+import json
+import tempfile
+import threading
+
+from QGL import *
+from QGL import config, BlockLabel, ControlFlow, Compiler
+
+
+class CompileContextTest(unittest.TestCase):
+    def setUp(self):
+        self.cl = ChannelLibrary(db_resource_name=":memory:")
+        self.cl.clear()
+        self.q1 = self.cl.new_qubit(label='q1')
+        aps2 = self.cl.new_APS2_rack("Maxwell",
+                                     [f"192.168.1.{i}" for i in [23, 24]],
+                                     tdm_ip="192.168.1.11")
+        self.cl.set_master(aps2.px("TDM"))
+        dig = self.cl.new_X6("MyX6", address=0)
+        self.cl.set_measure(self.q1, aps2.tx(1), dig.channels[1], gate=False,
+                            trig_channel=aps2.tx(1).ch("m2"))
+        self.cl.set_control(self.q1, aps2.tx(2))
+        self.cl.update_channelDict()
+
+    def make_seqs(self):
+        q1 = self.q1
+        @qfunction
+        def echo(amp):
+            return [Utheta(q1, amp=amp), X(q1), Utheta(q1, amp=amp)]
+        return [[X90(q1), echo(0.1 * ct), MEAS(q1)] + repeat(3, [Y90(q1)]) + [MEAS(q1)]
+                for ct in range(5)]
+
+    def read_outputs(self, metafile):
+        with open(metafile, 'r') as FID:
+            meta = json.load(FID)
+        outputs = {}
+        for fileName in meta['instruments'].values():
+            with open(fileName, 'rb') as FID:
+                outputs[os.path.basename(fileName)] = FID.read()
+        return outputs
+
+    def test_state(self):
+        numlabels = BlockLabel.newlabel.numlabels
+        pulse = X(self.q1)
+        with CompileContext() as ctx:
+            assert ctx.channelLib is self.cl
+            assert ctx.AWGDir == config.AWGDir
+            assert BlockLabel.newlabel() == BlockLabel.BlockLabel('A')
+            assert X(self.q1) is not pulse
+            assert X(self.q1) is X(self.q1)
+            seq = self.make_seqs()[0]
+            target = seq[1].target
+            body = ControlFlow.qfunction_specialization(target)
+            assert body[-1] == ControlFlow.Return()
+            numlabels_ctx = ctx.numlabels
+            # entered again
+            with ctx:
+                assert BlockLabel.newlabel() == BlockLabel.BlockLabel(
+                    BlockLabel.asciibase(numlabels_ctx))
+        assert BlockLabel.newlabel.numlabels == numlabels
+        assert X(self.q1) is pulse
+        assert ControlFlow.qfunction_specialization(target) is not body
+        assert ctx.numlabels == numlabels_ctx + 1
+
+    def test_threads(self):
+        def compile_in(ctx, results, name):
+            try:
+                with ctx:
+                    results[name] = compile_to_hardware(self.make_seqs(), 'Context/test')
+            except Exception as e:
+                results[name] = e
+
+        contexts = [CompileContext(AWGDir=tempfile.mkdtemp(prefix="AWG")) for _ in range(3)]
+        results = {}
+        compile_in(contexts[0], results, 'main')
+
+        # the compilations of the threads both get half way before either
+        # goes on
+        barrier = threading.Barrier(2, timeout=20)
+        generate_waveforms = Compiler.generate_waveforms
+        def meet(physWires):
+            barrier.wait()
+            return generate_waveforms(physWires)
+        threads = [threading.Thread(target=compile_in, args=(ctx, results, ct))
+                   for ct, ctx in enumerate(contexts[1:])]
+        Compiler.generate_waveforms = meet
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            Compiler.generate_waveforms = generate_waveforms
+
+        expected = self.read_outputs(results['main'])
+        assert expected
+        for ct, ctx in enumerate(contexts[1:]):
+            assert isinstance(results[ct], str), results[ct]
+            assert results[ct].startswith(ctx.AWGDir)
+            assert self.read_outputs(results[ct]) == expected
+
+        # the context argument of compile_to_hardware
+        ctx = CompileContext(AWGDir=tempfile.mkdtemp(prefix="AWG"))
+        with ctx:
+            seqs = self.make_seqs()
+        metafile = compile_to_hardware(seqs, 'Context/test', context=ctx)
+        assert metafile.startswith(ctx.AWGDir)
+        assert self.read_outputs(metafile) == expected
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import os
+import json
+import queue
+import tempfile
+import threading
+
+from QGL import *
+from QGL import config
+from QGL.CompileQueue import CompileQueue
+from QGL.CompileContexts import CompileCancelled
+
+
+class CompileQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.cl = ChannelLibrary(db_resource_name=":memory:")
+        self.cl.clear()
+        self.q1 = self.cl.new_qubit(label='q1')
+        aps2 = self.cl.new_APS2_rack("Maxwell",
+                                     [f"192.168.1.{i}" for i in [23, 24]],
+                                     tdm_ip="192.168.1.11")
+        self.cl.set_master(aps2.px("TDM"))
+        dig = self.cl.new_X6("MyX6", address=0)
+        self.cl.set_measure(self.q1, aps2.tx(1), dig.channels[1], gate=False,
+                            trig_channel=aps2.tx(1).ch("m2"))
+        self.cl.set_control(self.q1, aps2.tx(2))
+        self.cl.update_channelDict()
+
+    def make_seqs(self):
+        q1 = self.q1
+        return [[X90(q1), Utheta(q1, amp=0.1 * ct), MEAS(q1)] + repeat(3, [Y90(q1)]) +
+                [MEAS(q1)] for ct in range(5)]
+
+    def read_outputs(self, metafile):
+        with open(metafile, 'r') as FID:
+            meta = json.load(FID)
+        outputs = {}
+        for fileName in meta['instruments'].values():
+            with open(fileName, 'rb') as FID:
+                outputs[os.path.basename(fileName)] = FID.read()
+        return outputs
+
+    def test_result(self):
+        expected = self.read_outputs(compile_to_hardware(self.make_seqs(), 'Queue/test'))
+        future = compile_to_hardware_async(self.make_seqs(), 'Queue/test',
+                                           context=CompileContext(AWGDir=tempfile.mkdtemp()))
+        metafile = future.result()
+        assert metafile.startswith(future.context.AWGDir)
+        assert self.read_outputs(metafile) == expected
+
+    def test_queue(self):
+        started = threading.Event()
+        release = threading.Event()
+        def blocked_seqs():
+            started.set()
+            release.wait()
+            yield from self.make_seqs()
+
+        with CompileQueue(workers=1, max_pending=1) as compile_queue:
+            running = compile_queue.submit(blocked_seqs(), 'Queue/running')
+            assert started.wait(10)
+            waiting = compile_queue.submit(self.make_seqs(), 'Queue/waiting')
+            # the queue is full
+            with self.assertRaises(queue.Full):
+                compile_queue.submit(self.make_seqs(), 'Queue/full', block=False)
+
+            assert waiting.cancel()
+            assert running.cancel()
+            release.set()
+            with self.assertRaises(CompileCancelled):
+                running.result(10)
+            assert waiting.cancelled()
+
+            # the queue carries on
+            assert os.path.exists(compile_queue.submit(self.make_seqs(), 'Queue/next').result())
+
+if __name__ == "__main__":
+    unittest.main()
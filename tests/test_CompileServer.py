@@ -0,0 +1,105 @@
+import unittest
+import os
+import json
+import time
+import socket
+import tempfile
+import threading
+
+from QGL import *
+from QGL import config
+from QGL.CompileServer import (CompileServer, CompileClient, LocalClient, CompileServerError,
+                               peer_uid, private_directory)
+
+
+class CompileServerTest(unittest.TestCase):
+    def setUp(self):
+        self.cl = ChannelLibrary(db_resource_name=":memory:")
+        self.cl.clear()
+        self.q1 = self.cl.new_qubit(label='q1')
+        aps2 = self.cl.new_APS2_rack("Maxwell",
+                                     [f"192.168.1.{i}" for i in [23, 24]],
+                                     tdm_ip="192.168.1.11")
+        self.cl.set_master(aps2.px("TDM"))
+        dig = self.cl.new_X6("MyX6", address=0)
+        self.cl.set_measure(self.q1, aps2.tx(1), dig.channels[1], gate=False,
+                            trig_channel=aps2.tx(1).ch("m2"))
+        self.cl.set_control(self.q1, aps2.tx(2))
+        self.cl.update_channelDict()
+
+    def make_seqs(self):
+        q1 = self.q1
+        @qfunction
+        def echo(amp):
+            return [Utheta(q1, amp=amp), X(q1), Utheta(q1, amp=amp)]
+        return [[X90(q1), echo(0.1 * ct), MEAS(q1)] + repeat(3, [Y90(q1)]) + [MEAS(q1)]
+                for ct in range(5)]
+
+    def read_outputs(self, metafile):
+        with open(metafile, 'r') as FID:
+            meta = json.load(FID)
+        outputs = {}
+        for fileName in meta['instruments'].values():
+            with open(fileName, 'rb') as FID:
+                outputs[os.path.basename(fileName)] = FID.read()
+        return outputs
+
+    def test_local_client(self):
+        expected = self.read_outputs(compile_to_hardware(self.make_seqs(), 'Server/test'))
+        client = LocalClient()
+        with CompileContext(AWGDir=tempfile.mkdtemp(prefix="AWG")) as ctx:
+            metafile, timings = client.compile(self.make_seqs(), 'Server/test')
+        assert metafile.startswith(ctx.AWGDir)
+        assert self.read_outputs(metafile) == expected
+        assert set(timings) == {'load', 'compile', 'total'}
+
+        metafile, timings = client.compile(self.make_seqs(), 'Server/test', profile=True,
+                                           extra_meta={'note': 'profiled'})
+        assert timings['profile']['name'] == 'compile_to_hardware'
+        with open(metafile, 'r') as FID:
+            assert json.load(FID)['extra_meta']['note'] == 'profiled'
+
+        with self.assertRaises(CompileServerError):
+            client.compile(self.make_seqs(), 'Server/test', no_such_argument=True)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "requires Unix sockets")
+    def test_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'qgl.sock')
+        server = CompileServer()
+        thread = threading.Thread(target=server.serve_forever, args=(path,))
+        thread.start()
+        try:
+            for _ in range(100):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.05)
+            assert os.stat(path).st_mode & 0o777 == 0o600
+            with CompileClient(path) as client:
+                if hasattr(socket, 'SO_PEERCRED'):
+                    client.connect()
+                    assert peer_uid(client.sock) == os.getuid()
+                for _ in range(2):
+                    metafile, timings = client.compile(self.make_seqs(), 'Server/socket')
+                    assert os.path.exists(metafile)
+        finally:
+            server.shutdown()
+            thread.join()
+        assert not os.path.exists(path)
+
+        # not a socket: left alone
+        with open(path, 'w') as FID:
+            FID.write('data')
+        with self.assertRaises(CompileServerError):
+            server.serve_forever(path)
+        assert os.path.exists(path)
+
+        # the default socket is in a directory of its own
+        directory = os.path.join(tempfile.mkdtemp(), 'qgl')
+        private_directory(directory)
+        assert os.stat(directory).st_mode & 0o777 == 0o700
+        os.chmod(directory, 0o755)
+        with self.assertRaises(CompileServerError):
+            private_directory(directory)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,10 @@
 import unittest
 import numpy as np
+from types import SimpleNamespace
 
 from QGL import *
+from QGL import config, Profiler, PatternUtils
+from QGL.BasicSequences.helpers import create_cal_seqs
 
 
 class CompileUtils(unittest.TestCase):
@@ -52,6 +55,23 @@ class CompileUtils(unittest.TestCase):
         assert ([self.q2gate in entry.pulses.keys() for entry in seq] ==
                 [False, True, True])
 
+    def test_apply_gating_constraints(self):
+        gate = self.q1gate
+        # only the gating parameters of the physical channel are needed
+        phys = SimpleNamespace(label='q1-gate-phys', gate_buffer=5e-9, gate_min_width=30e-9)
+        blank = lambda length: TAPulse("BLANK", gate, length, 1, 0, 0)
+        seqs = [[qwait(), blank(20e-9), blank(20e-9), Id(gate, 10e-9), blank(20e-9),
+                 Id(gate, 100e-9), blank(10e-9), Id(gate, 50e-9)],
+                [qwait(), Id(gate, 10e-9), Id(gate, 10e-9)]]
+        gated = PatternUtils.apply_gating_constraints(phys, seqs)
+        # globbed, expanded by the buffer (the last entry is not contracted),
+        # and the 5ns gap filled
+        assert [p.label if isinstance(p, Pulse) else p.instruction for p in gated[0]] == \
+            ['WAIT', 'BLANK', 'Id', 'BLANK', 'Id']
+        lengths = [p.length for p in gated[0][1:]]
+        assert np.allclose(lengths, [5e-9 + 25e-9, 95e-9, 15e-9, 50e-9], atol=1e-15, rtol=0)
+        assert gated[1] == [qwait(), Id(gate, 20e-9)]
+
     def test_add_slave_trigger(self):
         q1 = self.q1
         trigger = self.trigger
@@ -66,6 +86,25 @@ class CompileUtils(unittest.TestCase):
         PatternUtils.add_slave_trigger([seq2], trigger)
         assert (seq2 == [qwait(), align('left', X90(q1), t)])
 
+    def test_decorate(self):
+        q1 = self.q1
+        q2 = self.q2
+        def make_seq():
+            return [qwait(), MEAS(q1), X90(q1), qwait(), qwait(), X(q1) * Y(q2),
+                    X(q1) * Y(q2, length=60e-9), Id(q1), MEAS(q1) * MEAS(q2), qwait()]
+        seq = make_seq()
+        PatternUtils.add_digitizer_trigger([seq])
+        PatternUtils.add_parametric_pulses(seq)
+        PatternUtils.add_gate_pulses(seq)
+        PatternUtils.add_slave_trigger([seq], self.trigger)
+        fused = make_seq()
+        PatternUtils.decorate([fused], self.trigger)
+        assert fused == seq
+        for entry, expected in zip(fused, seq):
+            if hasattr(entry, 'pulses'):
+                assert list(entry.pulses.keys()) == list(expected.pulses.keys())
+                assert entry.length == expected.length
+
     def test_concatenate_entries(self):
         q1 = self.q1
         seq = [X90(q1, length=20e-9), Y90(q1, length=40e-9)]
@@ -112,6 +151,19 @@ class CompileUtils(unittest.TestCase):
         self.assertAlmostEqual(max_length, 120e-9)
         self.assertTrue(all(np.isclose(e.length, max_length, atol=1e-10) for e in entries))
 
+    def test_pull_uniform_entries_samples(self):
+        # lengths that only match on the sample grid
+        q1 = self.q1
+        q1.pulse_params['length'] = 20e-9
+        q2 = self.q2
+        entryIterators = [iter([X90(q1), Y90(q1), X90(q1)]), iter([Y(q2, length=40.3e-9)])]
+        entries = [next(e) for e in entryIterators]
+        entries, max_length = Compiler.pull_uniform_entries(entries, entryIterators,
+                                                            sampling_rate=1.2e9)
+        self.assertAlmostEqual(max_length, 40.3e-9)
+        assert [e.label for e in entries] == ['X90+Y90', 'Y']
+        assert next(entryIterators[0]) == X90(q1)
+
     def test_merge_channels(self):
         q1 = self.q1
         q1.pulse_params['length'] = 20e-9
@@ -177,5 +229,86 @@ class CompileUtils(unittest.TestCase):
         for p, frame_change in zip(out_seq, expected_frame_change):
             assert p.frameChange == frame_change
 
+    def test_frame_update_time_amp(self):
+        # frame changes skip over TA pulses, unless there are only TA pulses
+        q1 = self.q1
+        out_seq = Compiler.compile_sequence([X(q1), Id(q1), Z90(q1), Id(q1), Z90(q1)])[q1]
+        assert [p.frameChange for p in out_seq] == [-np.pi, 0.0, 0.0]
+        out_seq = Compiler.compile_sequence([Id(q1), Id(q1), Z90(q1), X(q1)])[q1]
+        assert [p.frameChange for p in out_seq] == [-0.5*np.pi, 0.0, 0.0]
+
+    def test_idle_channels(self):
+        q1 = self.q1
+        q2 = self.q2
+        seq = [X(q1), Y(q1, length=20e-9), Z90(q1), X(q1)*Y(q2), X90(q1)]
+        wires = Compiler.compile_sequence(seq)
+        assert [p.label for p in wires[q2]] == ['Id', 'Id', 'Y', 'Id']
+        assert [p.length for p in wires[q2]] == [30e-9, 20e-9, 30e-9, 30e-9]
+        # the pulses of the used channels are unchanged
+        assert wires[q1] == [X(q1), Y(q1, length=20e-9)._replace(frameChange=-0.5*np.pi),
+                             X(q1), X90(q1)]
+        config.merge_idle = True
+        try:
+            # the idle time is merged on the sample grid of the translator
+            wires = Compiler.compile_sequence(seq)
+            assert [p.label for p in wires[q2]] == ['Id', 'Id', 'Y', 'Id']
+            q2.phys_chan.translator = 'APS2Pattern'
+            wires = Compiler.compile_sequence(seq)
+        finally:
+            config.merge_idle = False
+        assert [p.label for p in wires[q2]] == ['Id', 'Y', 'Id']
+        assert np.isclose(wires[q2][0].length, 50e-9)
+
+    def test_delay(self):
+        q1 = self.q1
+        seqs = [[qwait(), X(q1), qsync(), Y(q1), qwait()], [X(q1)]]
+        PatternUtils.delay(seqs, 10e-9)
+        assert [p.label if isinstance(p, Pulse) else p.instruction for p in seqs[0]] == \
+            ['WAIT', 'Id', 'X', 'SYNC', 'Id', 'Y', 'WAIT']
+        assert seqs[0][1].length == 10e-9 and seqs[0][1].channel == q1
+        assert seqs[1] == [X(q1)]
+
+    def test_parallel_compile_sequences(self):
+        q1 = self.q1
+        q2 = self.q2
+        def make_seqs():
+            return [[X(q1), Z90(q1), Y90(q2), MEAS(q1)*MEAS(q2)] +
+                    repeat(ct + 1, [X90(q1) + Y90(q1)]) +
+                    [Utheta(q2, amp=0.1*ct), MEAS(q2)] for ct in range(10)]
+        numlabels = BlockLabel.newlabel.numlabels
+        serial = Compiler.compile_sequences(make_seqs())
+        BlockLabel.newlabel.numlabels = numlabels
+        parallel = Compiler.compile_sequences(make_seqs(), workers=3)
+
+        assert serial.keys() == parallel.keys()
+        for chan in serial:
+            assert parallel[chan] == serial[chan]
+            # channels must come back as the library objects, not copies
+            for entry in Compiler.flatten(parallel[chan]):
+                if isinstance(entry, Pulse):
+                    assert entry.channel is chan
+
+    def test_dedup_sequences(self):
+        q1 = self.q1
+        q2 = self.q2
+        def make_seqs():
+            return create_cal_seqs((q1, q2), 3) + [[X(q1), Y(q2), MEAS(q1)*MEAS(q2)]]
+        numlabels = BlockLabel.newlabel.numlabels
+        config.dedup_sequences = True
+        try:
+            with Profiler.profiling():
+                deduped = Compiler.compile_sequences(make_seqs())
+        finally:
+            config.dedup_sequences = False
+        # the four calibration states, and the first and last sequences, which
+        # get the label and GOTO of the loop
+        assert Profiler.last_report['counts']['unique_sequences'] == 6
+
+        BlockLabel.newlabel.numlabels = numlabels
+        expected = Compiler.compile_sequences(make_seqs())
+        assert deduped == expected
+        # the repeated sequences get their own wires
+        assert deduped[q1][0] is not deduped[q1][1]
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+from functools import reduce
+import operator
+import numpy as np
+
+from QGL import *
+from QGL import config, CompositeShapes, WaveformCache
+
+
+calls = []
+
+def counted_gaussian(**params):
+    calls.append(params['length'])
+    return PulseShapes.gaussian(**params)
+
+
+class CountedStack(CompositeShapes.StackShape):
+    __slots__ = []
+    combined = 0
+
+    def combine(self, shapes):
+        CountedStack.combined += 1
+        return super(CountedStack, self).combine(shapes)
+
+
+class CompositeShapesTest(unittest.TestCase):
+    def setUp(self):
+        self.cl = ChannelLibrary(db_resource_name=":memory:")
+        self.cl.clear()
+        self.q1gate = Channels.LogicalMarkerChannel(label='q1-gate', channel_db=self.cl.channelDatabase)
+        self.q1phys = Channels.PhysicalChannel(label='q1-phys', sampling_rate=1.2e9, channel_db=self.cl.channelDatabase)
+        self.q1 = Qubit(label='q1', gate_chan=self.q1gate, channel_db=self.cl.channelDatabase)
+        self.q1.phys_chan = self.q1phys
+        self.q1.pulse_params['length'] = 30e-9
+        self.cl.update_channelDict()
+        CompositeShapes.clear_cache()
+        config.waveform_cache_enabled = True
+        WaveformCache.clear_cache(disk=False)
+        WaveformCache.reset_stats()
+
+    def tearDown(self):
+        config.waveform_cache_enabled = False
+
+    def terms(self):
+        pulses = [X90(self.q1), Y90(self.q1, length=20e-9), X(self.q1)]
+        return [(p.amp * np.exp(1j * p.phase), p) for p in pulses]
+
+    def test_shapes(self):
+        terms = self.terms()
+        stack = CompositeShapes.StackShape(terms)
+        assert np.array_equal(stack(), np.hstack([c * p.shape for c, p in terms]))
+        same = [(c, p) for c, p in terms if len(p.shape) == len(terms[0][1].shape)]
+        total = CompositeShapes.SumShape(same)
+        assert np.array_equal(total(), reduce(operator.add, [c * p.shape for c, p in same]))
+
+    def test_shared(self):
+        first = CompositeShapes.StackShape(self.terms())
+        second = CompositeShapes.StackShape(self.terms())
+        assert first is not second and first.id == second.id
+        shape = first()
+        misses = WaveformCache.cache_stats()['misses']
+        assert second() is shape
+        assert WaveformCache.cache_stats()['misses'] == misses
+        # a new compilation numbers the nodes afresh
+        CompositeShapes.clear_cache()
+        assert np.array_equal(second(), shape)
+
+    def test_evaluated_once(self):
+        # without the WaveformCache too
+        config.waveform_cache_enabled = False
+        del calls[:]
+        CountedStack.combined = 0
+        q1 = self.q1
+        def terms():
+            pulses = [Utheta(q1, amp=0.5, shape_fun=counted_gaussian),
+                      Utheta(q1, amp=0.5, length=20e-9, shape_fun=counted_gaussian)]
+            return [(p.amp, p) for p in pulses]
+        inner = [CountedStack(terms()) for _ in range(3)]
+        outer = [CountedStack([(1.0, Utheta(q1, amp=0.5, shape_fun=stack, length=50e-9)),
+                               (0.5, terms()[0][1])]) for stack in inner]
+        shapes = [stack() for stack in inner + outer]
+        assert all(np.array_equal(shape, shapes[0]) for shape in shapes[:3])
+        assert all(shape is shapes[3] for shape in shapes[3:])
+        # two leaves, one inner and one outer concatenation
+        assert sorted(calls) == [20e-9, 30e-9]
+        assert CountedStack.combined == 2
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import json
+import tempfile
+import numpy as np
+
+from QGL import *
+from QGL import config, Profiler
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.cl = ChannelLibrary(db_resource_name=":memory:")
+        self.cl.clear()
+        self.q1 = self.cl.new_qubit(label='q1')
+        aps2 = self.cl.new_APS2_rack("Maxwell",
+                                     [f"192.168.1.{i}" for i in [23, 24]],
+                                     tdm_ip="192.168.1.11")
+        self.cl.set_master(aps2.px("TDM"))
+        dig = self.cl.new_X6("MyX6", address=0)
+        self.cl.set_measure(self.q1, aps2.tx(1), dig.channels[1], gate=False,
+                            trig_channel=aps2.tx(1).ch("m2"))
+        self.cl.set_control(self.q1, aps2.tx(2))
+        self.cl.update_channelDict()
+
+        self.awg_dir = config.AWGDir
+        config.AWGDir = tempfile.mkdtemp(prefix="AWG")
+
+    def tearDown(self):
+        config.profile_in_meta = False
+        config.AWGDir = self.awg_dir
+
+    def test_stages(self):
+        with Profiler.profiling('outer', trace_memory=True):
+            for ct in range(3):
+                with Profiler.stage('chunk'):
+                    Profiler.step('first')
+                    Profiler.count(items=2)
+                    Profiler.step('second')
+                    data = [np.zeros(1000) for _ in range(10)]
+        report = Profiler.last_report
+        assert Profiler.active is None
+        assert report['name'] == 'outer'
+        chunk = report['stages']['chunk']
+        assert chunk['calls'] == 3
+        assert list(chunk['stages'].keys()) == ['first', 'second']
+        assert chunk['stages']['first']['counts'] == {'items': 6}
+        assert chunk['stages']['second']['traced_peak'] >= 80000
+        assert report['wall'] >= chunk['wall'] >= chunk['stages']['second']['wall']
+
+    def test_compile_report(self):
+        config.profile_in_meta = True
+        seqs = [[Utheta(self.q1, amp=amp), MEAS(self.q1)] for amp in np.linspace(-1, 1, 11)]
+        mf, report = compile_to_hardware(seqs, 'Profile/Rabi', profile=True)
+
+        stages = report['stages']
+        assert stages['compile_sequences']['counts']['sequences'] == 11
+        assert stages['map_to_physical']['counts']['pulses'] > 0
+        assert stages['generate_waveforms']['counts']['unique_shapes'] > 0
+        awg = stages['write_sequence_files']['stages']['Maxwell_U2']
+        assert awg['stages']['preprocess']['counts']['waveforms'] > 0
+        assert awg['stages']['create_instr_data']['counts']['instructions'] > 0
+        assert awg['stages']['create_wf_vector']['counts']['cache_lines'] == 0
+
+        with open(mf, 'r') as FID:
+            meta = json.load(FID)
+        assert meta['profile']['stages'].keys() == stages.keys()
+
+if __name__ == "__main__":
+    unittest.main()
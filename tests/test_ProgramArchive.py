@@ -0,0 +1,105 @@
+import unittest
+import os
+import json
+import tempfile
+import numpy as np
+
+from QGL import *
+from QGL import config, ProgramArchive
+from QGL.PulseSequencer import CompoundGate
+
+
+class ProgramArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.cl = ChannelLibrary(db_resource_name=":memory:")
+        self.cl.clear()
+        self.q1 = self.cl.new_qubit(label='q1')
+        self.q2 = self.cl.new_qubit(label='q2')
+        aps2 = self.cl.new_APS2_rack("Maxwell",
+                                     [f"192.168.1.{i}" for i in [23, 24, 25]],
+                                     tdm_ip="192.168.1.11")
+        self.cl.set_master(aps2.px("TDM"))
+        dig = self.cl.new_X6("MyX6", address=0)
+        self.cl.set_measure(self.q1, aps2.tx(1), dig.channels[1], gate=False,
+                            trig_channel=aps2.tx(1).ch("m2"))
+        self.cl.set_control(self.q1, aps2.tx(2))
+        self.cl.set_control(self.q2, aps2.tx(3))
+        self.cl.update_channelDict()
+
+        self.awg_dir = config.AWGDir
+        config.AWGDir = tempfile.mkdtemp(prefix="AWG")
+
+    def tearDown(self):
+        config.save_program = 'archive'
+        config.AWGDir = self.awg_dir
+
+    def make_seqs(self):
+        q1, q2 = self.q1, self.q2
+
+        @qfunction
+        def echo(q):
+            return [X90(q), Id(q, length=1e-7), Y90(q)]
+
+        return [[Utheta(q1, amp=amp), X90(q1) + Y90(q1), X(q1) * Y(q2),
+                 CompoundGate([X(q1), Y(q1)], label='XY'), echo(q1),
+                 qwait(), MEAS(q1)] for amp in np.linspace(-1, 1, 11)]
+
+    def test_round_trip(self):
+        seqs = self.make_seqs()
+        fileName = os.path.join(config.AWGDir, 'program.qgl')
+        ProgramArchive.save_program(seqs, fileName)
+
+        archive = ProgramArchive.ProgramArchive(fileName)
+        assert len(archive) == len(seqs)
+        # one row per distinct pulse, including those of the qfunction
+        assert len(archive.pulses) == 11 + 7
+        assert sorted(archive.channels) == ['M-q1', 'q1', 'q2']
+        pulses = archive.pulses
+        utheta = pulses[pulses['label'] == archive.strings.index('Utheta')]
+        np.testing.assert_allclose(utheta['amp'], np.linspace(-1, 1, 11))
+
+        assert archive[3] == seqs[3]
+        assert archive[-2:] == seqs[-2:]
+        target = seqs[0][4].target
+        assert archive.functions == {target: ControlFlow.qfunction_seq[target]}
+        assert ProgramArchive.load_program(fileName) == seqs
+
+        with ProgramArchive.ProgramArchive(fileName) as archive:
+            assert archive[0] == seqs[0]
+        assert archive._map.closed
+
+    def test_unarchivable(self):
+        shape = lambda **params: PulseShapes.gaussian(**params)
+        seqs = [[Utheta(self.q1, amp=0.5, shape_fun=shape), MEAS(self.q1)]]
+        fileName = os.path.join(config.AWGDir, 'lambda.qgl')
+        with self.assertRaises(ProgramArchive.ProgramArchiveError):
+            ProgramArchive.save_program(seqs, fileName)
+        assert not os.path.exists(fileName)
+
+        # the compiler saves the program as text instead
+        with self.assertWarns(UserWarning):
+            compile_to_hardware(seqs, 'Lambda/lambda')
+        assert os.path.exists(os.path.join(config.AWGDir, 'Lambda', 'lambda-code.py'))
+        assert not os.path.exists(os.path.join(config.AWGDir, 'Lambda', 'lambda-program.qgl'))
+
+    def test_compile(self):
+        def outputs(mf):
+            with open(mf, 'r') as FID:
+                meta = json.load(FID)
+            files = {}
+            for awg, fileName in meta['instruments'].items():
+                with open(fileName, 'rb') as FID:
+                    files[awg] = FID.read()
+            return files
+
+        config.save_program = 'both'
+        mf = compile_to_hardware(self.make_seqs(), 'Archive/original')
+        assert os.path.exists(os.path.join(config.AWGDir, 'Archive', 'original-code.py'))
+
+        seqs = ProgramArchive.load_program(
+            os.path.join(config.AWGDir, 'Archive', 'original-program.qgl'))
+        assert outputs(compile_to_hardware(seqs, 'Archive/reloaded')) == outputs(mf)
+
+
+if __name__ == "__main__":
+    unittest.main()
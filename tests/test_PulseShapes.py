@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+
+from QGL import PulseShapes
+
+
+class PulseShapesTest(unittest.TestCase):
+    def check_batch(self, shape_fun, params):
+        shapes = PulseShapes.batch_shapes(shape_fun, params)
+        assert len(shapes) == len(params)
+        for shape, p in zip(shapes, params):
+            expected = shape_fun(**p)
+            assert shape.dtype == expected.dtype
+            # the same to the last bit
+            assert np.array_equal(shape, expected)
+
+    def test_batched_shapes(self):
+        rng = np.random.RandomState(0)
+        lengths = [20e-9, 32e-9, 1e-7, 3.3e-7]
+        rates = [1.2e9, 1e9]
+        self.check_batch(PulseShapes.gaussian, [
+            {'length': l, 'sampling_rate': r, 'cutoff': c, 'amp': a}
+            for l in lengths for r in rates for c in [2, 3.5] for a in [1, 0.3]])
+        self.check_batch(PulseShapes.drag, [
+            {'length': l, 'sampling_rate': 1.2e9, 'drag_scaling': d, 'sigma': 5e-9}
+            for l in lengths for d in rng.uniform(-1, 1, 5)])
+        self.check_batch(PulseShapes.tanh, [
+            {'length': l, 'sampling_rate': 1.2e9, 'sigma': 5e-9, 'cutoff': 2, 'amp': a}
+            for l in lengths[1:] + [0.0] for a in [1, 0.7]])
+        self.check_batch(PulseShapes.exp_decay, [
+            {'length': l, 'sampling_rate': 1.2e9, 'sigma': s, 'steady_state': 0.3}
+            for l in lengths for s in [1e-8, 5e-8]])
+        self.check_batch(PulseShapes.CLEAR, [
+            {'length': 1e-6, 'sampling_rate': 1.2e9, 'sigma': 1e-7, 'amp': a,
+             'amp1': 0.5, 'amp2': -0.2, 'step_length': s}
+            for a in [1, 0.5] for s in [50e-9, 100e-9]])
+        self.check_batch(PulseShapes.arb_axis_drag, [
+            {'length': l, 'sampling_rate': 1.2e9, 'cutoff': 2, 'drag_scaling': 0.1,
+             'nutFreq': 40e6 + 0j, 'rotAngle': r, 'polarAngle': p, 'aziAngle': 0.3}
+            for l in lengths for r in rng.uniform(0, np.pi, 3) for p in [0, 0.7, np.pi / 2]] +
+            # a Z rotation
+            [{'length': 0, 'nutFreq': 40e6, 'rotAngle': 0.5, 'polarAngle': 0}])
+        # not batched
+        self.check_batch(PulseShapes.constant, [{'length': l} for l in lengths])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,7 @@ import unittest
 
 from QGL import *
 from QGL.PulseSequencer import *
+from QGL import PulseSequencer
 import QGL.config
 try:
   from helpers import setup_test_lib
@@ -31,6 +32,41 @@ class PulseTypes(unittest.TestCase):
         assert( type(X(q3) * CNOT_CR(q1, q2)) == CompoundGate )
         assert( type(CNOT_CR(q1, q2) * CNOT_CR(q3, q4)) == CompoundGate )
 
+    def test_fingerprints(self):
+        q1 = self.q1
+        p = Utheta(q1, amp=0.5)
+        same = Utheta(q1, amp=0.5)
+        assert p is not same
+        assert hash(p) == hash(same) and p.hashshape() == same.hashshape()
+        # cached for the pulse, but not carried over to modified copies
+        assert not hasattr(p, '__dict__')
+        assert PulseSequencer._hash_cache[id(p)] == [p, p.hashshape(), hash(p)]
+        # a compilation uses the table of its context, and empties it (even
+        # when it fails, here for want of physical channels)
+        ctx = CompileContext()
+        with ctx:
+            hash(p)
+            assert id(p) in ctx.pulse_hashes
+            with self.assertRaises(ValueError):
+                compile_to_hardware([[p, MEAS(q1)]], 'Fingerprints/fingerprints')
+            assert not ctx.pulse_hashes
+        longer = p._replace(shapeParams=dict(p.shapeParams, length=2 * p.length))
+        assert longer.hashshape() != p.hashshape()
+        assert hash(-p) != hash(p)
+        assert {p: 1}[same] == 1
+
+    def test_factories(self):
+        cl = ChannelLibraries.channelLib
+        assert QubitFactory('q1') is self.q1
+        # channels added to the database directly are still found
+        q5 = Channels.Qubit(label='q5', channel_db=cl.channelDatabase)
+        assert QubitFactory('q5') is q5
+        self.q4.label = 'q6'
+        self.assertRaises(Exception, QubitFactory, 'q4')
+        assert QubitFactory('q6') is self.q4
+        self.q4.label = 'q4'
+        assert EdgeFactory(self.q1, self.q2) is EdgeFactory(self.q2, self.q1)
+
 # Added to support simple python invocation
 #
 if __name__ == "__main__":
@@ -0,0 +1,67 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+
+from QGL import config, PulseShapes, WaveformCache
+
+
+class WaveformCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.awg_dir = config.AWGDir
+        config.AWGDir = tempfile.mkdtemp(prefix="AWG")
+        config.waveform_cache_enabled = True
+        WaveformCache.clear_cache()
+        WaveformCache.reset_stats()
+
+    def tearDown(self):
+        WaveformCache.clear_cache()
+        config.waveform_cache_enabled = False
+        config.waveform_cache_disk = False
+        config.waveform_cache_size = 2**28
+        config.AWGDir = self.awg_dir
+
+    def params(self, amps):
+        return [{'length': 1e-7, 'sampling_rate': 1.2e9, 'cutoff': 2, 'amp': a}
+                for a in amps]
+
+    def test_memory(self):
+        params = self.params([1, 0.5])
+        first = WaveformCache.get_shapes(PulseShapes.gaussian, params)
+        assert WaveformCache.stats['misses'] == 2
+        second = WaveformCache.get_shapes(PulseShapes.gaussian, self.params([0.5, 0.25]))
+        assert second[0] is first[1]
+        assert WaveformCache.stats['hits'] == 1
+        for shape, p in zip(second, self.params([0.5, 0.25])):
+            assert np.array_equal(shape, PulseShapes.gaussian(**p))
+            assert not shape.flags.writeable
+
+        # room for two shapes only
+        config.waveform_cache_size = 2 * first[0].nbytes
+        WaveformCache.get_shapes(PulseShapes.gaussian, self.params([0.1]))
+        assert WaveformCache.stats['evictions'] == 2
+        assert WaveformCache.cache_stats()['entries'] == 2
+
+    def test_disk(self):
+        config.waveform_cache_disk = True
+        params = self.params([1, 0.5])
+        first = WaveformCache.get_shapes(PulseShapes.gaussian, params)
+        assert len(os.listdir(WaveformCache.cache_dir())) == 2
+
+        # as in a new session
+        WaveformCache.clear_cache(disk=False)
+        second = WaveformCache.get_shapes(PulseShapes.gaussian, params)
+        assert WaveformCache.stats['disk_hits'] == 2
+        for a, b in zip(first, second):
+            assert np.array_equal(a, b)
+
+        # closures are not cached on disk
+        scale = 2
+        def shape_fun(**params):
+            return scale * PulseShapes.gaussian(**params)
+        WaveformCache.get_shapes(shape_fun, params)
+        assert len(os.listdir(WaveformCache.cache_dir())) == 2
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import json
+import tempfile
+import numpy as np
+
+from QGL import *
+from QGL import config
+from QGL.WireArrays import WireArrays
+from QGL.BlockLabel import BlockLabel
+
+
+class WireArraysTest(unittest.TestCase):
+    def setUp(self):
+        self.cl = ChannelLibrary(db_resource_name=":memory:")
+        self.cl.clear()
+        self.q1 = self.cl.new_qubit(label='q1')
+        self.q2 = self.cl.new_qubit(label='q2')
+        aps2 = self.cl.new_APS2_rack("Maxwell",
+                                     [f"192.168.1.{i}" for i in [23, 24, 25]],
+                                     tdm_ip="192.168.1.11")
+        self.cl.set_master(aps2.px("TDM"))
+        dig = self.cl.new_X6("MyX6", address=0)
+        self.cl.set_measure(self.q1, aps2.tx(1), dig.channels[1], gate=False,
+                            trig_channel=aps2.tx(1).ch("m2"))
+        self.cl.set_control(self.q1, aps2.tx(2))
+        self.cl.set_control(self.q2, aps2.tx(3))
+        self.cl.update_channelDict()
+
+        self.awg_dir = config.AWGDir
+        config.AWGDir = tempfile.mkdtemp(prefix="AWG")
+
+    def tearDown(self):
+        config.wire_arrays = False
+        config.AWGDir = self.awg_dir
+
+    def test_wire(self):
+        q1 = self.q1
+        label = BlockLabel('start')
+        seqs = [[label, X(q1), Id(q1, 1e-7), Id(q1, 2e-7), qwait()], [],
+                [Utheta(q1, amp=0.5), Y(q1, frameChange=0.3), X(q1)]]
+        wire = WireArrays.from_pulses(seqs)
+        assert len(wire) == 3 and wire.num_waveforms == 6
+        out = wire.to_wire()
+        assert out[0][0] is label and out[1] == []
+        assert out[2][1] == Compiler.Waveform(seqs[2][1])
+
+        wire.convert_lengths_to_samples(1.2e9, 4)
+        assert out[0][2].length == Compiler.Waveform(seqs[0][2]).length
+        assert wire[0][2].length == 120
+
+        # X appears twice, with the same signature
+        rows = wire.unique_waveforms([wire.key, wire.amp, wire.length])
+        assert len(rows) == 5
+
+        # runs of zero and non-zero waveforms are merged, within each sequence
+        merged = wire.merge_adjacent(wire.isZero)
+        assert [len(seq) for seq in merged] == [4, 0, 1]
+        assert merged[0][2].length == 120 + 240
+
+    def test_compile(self):
+        def outputs(mf):
+            with open(mf, 'r') as FID:
+                meta = json.load(FID)
+            files = {}
+            for awg, fileName in meta['instruments'].items():
+                with open(fileName, 'rb') as FID:
+                    files[awg] = FID.read()
+            return files
+
+        def seqs():
+            q1, q2 = self.q1, self.q2
+            return [[Utheta(q1, amp=amp), X90(q1) + Y90(q1), Z90(q1), X(q1) * Y(q2),
+                     Id(q1, 1e-7), MEAS(q1)] for amp in np.linspace(-1, 1, 11)]
+
+        config.wire_arrays = False
+        BlockLabel.numlabels = 0
+        expected = outputs(compile_to_hardware(seqs(), 'WireArrays/lists'))
+        config.wire_arrays = True
+        BlockLabel.numlabels = 0
+        assert outputs(compile_to_hardware(seqs(), 'WireArrays/arrays')) == expected
+
+
+if __name__ == "__main__":
+    unittest.main()